@@ -7,6 +7,13 @@ class OpeningHoursInline(admin.TabularInline):
     extra = 1
 
 
+class RendelesTetelInline(admin.TabularInline):
+    model = RendelesTetel
+    extra = 0
+    readonly_fields = ['termek', 'termek_nev', 'mennyiseg', 'egysegar']
+    can_delete = False
+
+
 @admin.register(Bufe)
 class BufeAdmin(admin.ModelAdmin):
     list_display = ['nev', 'rendkivuli_zarva']
@@ -44,6 +51,7 @@ class RendelesAdmin(admin.ModelAdmin):
     search_fields = ['user__username', 'user__email']
     readonly_fields = ['leadva']
     date_hierarchy = 'leadva'
+    inlines = [RendelesTetelInline]
     actions = ['archive_selected', 'dearchive_selected']
     
     @admin.action(description='Archív kijelölt rendelések')
@@ -56,6 +64,19 @@ class RendelesAdmin(admin.ModelAdmin):
         count = queryset.update(archived=False)
         self.message_user(request, f'{count} rendelés dearchiválva.')
 
+@admin.register(SzunetFoglaltsag)
+class SzunetFoglaltsagAdmin(admin.ModelAdmin):
+    list_display = ['datum', 'szunet', 'foglalt', 'kapacitas']
+    list_filter = ['szunet']
+    date_hierarchy = 'datum'
+    readonly_fields = ['foglalt']
+
+@admin.register(Esemeny)
+class EsemenyAdmin(admin.ModelAdmin):
+    list_display = ['id', 'seq', 'tipus', 'letrehozva', 'kikuldve']
+    list_filter = ['tipus']
+    readonly_fields = ['seq', 'tipus', 'adat', 'letrehozva', 'kikuldve']
+
 # Később lesz implementálva a chat funkció
 # @admin.register(Chatszoba)
 # class ChatszobaAdmin(admin.ModelAdmin):
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class BufeConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'bufe'
+
+    def ready(self):
+        from . import signals
@@ -0,0 +1,137 @@
+"""
+Menu snapshot for the student pages.
+
+index and create_order render the menu from an immutable snapshot of the
+categories and their available products instead of querying them on every
+request. A snapshot is kept in this process and in the shared cache under the
+current menu generation. Every product, category or büfé change bumps the
+generation once its transaction has committed (see signals.py), whether it
+came from the admin API, the admin WebSocket or the Django admin. The next
+request then builds a fresh snapshot and the other processes find it in the
+shared cache. A request with a current snapshot reads one cache key and runs
+no catalog queries.
+
+The snapshot's version is the live catalog version (events.catalog_version)
+it was built at, so a page rendered from a snapshot catches up over the
+catalog WebSocket like any other.
+"""
+import threading
+import time
+from dataclasses import dataclass
+
+from django.core.cache import cache
+
+from .events import catalog_version
+from .models import Kategoria, Termek
+
+
+GENERATION_KEY = 'bufe:menu:generation'
+# Seconds a snapshot is kept in the shared cache; a new generation replaces it anyway
+SNAPSHOT_TIMEOUT = 60 * 60
+
+
+@dataclass(frozen=True)
+class MenuTermek:
+    """An available product as the menu shows it"""
+    id: int
+    nev: str
+    ar: int
+    hutve: bool
+    kisult: bool
+    max_rendelesenkent: int
+
+
+@dataclass(frozen=True)
+class MenuKategoria:
+    """A category with its available products, in menu order"""
+    id: int
+    nev: str
+    termekek: tuple
+
+
+@dataclass(frozen=True)
+class MenuSnapshot:
+    """Categories that have available products, and the catalog version they were read at"""
+    bufe_id: int
+    version: int
+    kategoriak: tuple
+
+    @property
+    def termekek_by_kategoria(self):
+        """Categories mapped to their products, the shape the templates iterate"""
+        return {kategoria: kategoria.termekek for kategoria in self.kategoriak}
+
+
+_lock = threading.Lock()
+_snapshots = {}  # bufe id -> (generation, snapshot) of this process
+
+
+def current_generation():
+    """
+    Current menu generation from the shared cache. A missing key (never
+    set, evicted or flushed) starts again from the clock, a value no earlier
+    generation had, so an old snapshot is never mistaken for a current one.
+    """
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, time.time_ns(), timeout=None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def invalidate_menu():
+    """Make every process rebuild the menu on its next request"""
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        # Not set at all: the next read starts a new generation
+        current_generation()
+
+
+def build_snapshot(bufe):
+    """Read the menu of a büfé: two queries, whatever its size"""
+    # Read first: a change committed meanwhile only makes the snapshot look older
+    version = catalog_version()
+
+    termekek = {}
+    for termek in Termek.objects.filter(kategoria__bufe=bufe, elerheto=True):
+        termekek.setdefault(termek.kategoria_id, []).append(MenuTermek(
+            id=termek.id,
+            nev=termek.nev,
+            ar=termek.ar,
+            hutve=termek.hutve,
+            kisult=termek.kisult,
+            max_rendelesenkent=termek.max_rendelesenkent,
+        ))
+
+    return MenuSnapshot(
+        bufe_id=bufe.id,
+        version=version,
+        kategoriak=tuple(
+            MenuKategoria(id=kategoria.id, nev=kategoria.nev, termekek=tuple(termekek[kategoria.id]))
+            for kategoria in Kategoria.objects.filter(bufe=bufe)
+            if kategoria.id in termekek
+        )
+    )
+
+
+def get_menu(bufe):
+    """
+    The menu snapshot of a büfé: from this process, else from the shared
+    cache, else built and stored in both.
+    """
+    generation = current_generation()
+    with _lock:
+        local = _snapshots.get(bufe.id)
+    if local and local[0] == generation:
+        return local[1]
+
+    key = f'bufe:menu:{bufe.id}:{generation}'
+    snapshot = cache.get(key)
+    if snapshot is None:
+        snapshot = build_snapshot(bufe)
+        cache.set(key, snapshot, SNAPSHOT_TIMEOUT)
+
+    with _lock:
+        _snapshots[bufe.id] = (generation, snapshot)
+    return snapshot
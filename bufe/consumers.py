@@ -1,18 +1,92 @@
 """
 WebSocket consumers for real-time order notifications.
 """
+import asyncio
 import json
+import time
+from collections import deque
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from django.contrib.auth.models import User
-from .models import Bufe, Rendeles
+from django.conf import settings
+from django.db import transaction
+from .models import Bufe, Termek
+from .forms import CartValidator
+from .ordering import OrderRejected, aplace_order, closed_reason
+from .events import CATALOG_GROUP, catalog_version, sync_reply, student_group_name
+from .serializers import CATALOG_FIELDS, COMPACT_KEYS, COMPACT_SUBPROTOCOL, encode_frame, serialize_product
+from .utils import broadcast_sender, connection_tracker, is_bufeadmin, check_domain_access
 
 
-class OrderConsumer(AsyncWebsocketConsumer):
+class HeartbeatMixin:
+    """
+    Server driven heartbeat for a WebSocket consumer.
+    Every BUFE_WS_HEARTBEAT_INTERVAL seconds the consumer sends a bare 'ping'
+    text frame, which clients answer with a bare 'pong' - neither side parses
+    JSON for it. Any frame from the client counts as a sign of life; a
+    connection silent for BUFE_WS_HEARTBEAT_TIMEOUT seconds is reaped: it
+    leaves its groups at once, so the group fan-out stops sending to it, and
+    is closed.
+    """
+    
+    # Name the connection is counted under in connection_tracker
+    connection_kind = None
+    
+    def start_heartbeat(self):
+        """Call once the connection is accepted"""
+        self.last_seen = time.monotonic()
+        connection_tracker.register(self.connection_kind, self.channel_name)
+        self.heartbeat_task = asyncio.create_task(self.heartbeat())
+    
+    def stop_heartbeat(self):
+        """Call from disconnect"""
+        task = getattr(self, 'heartbeat_task', None)
+        if task and task is not asyncio.current_task():
+            task.cancel()
+        connection_tracker.unregister(self.connection_kind, self.channel_name)
+    
+    def is_heartbeat(self, text_data):
+        """
+        Record a sign of life.
+        
+        Returns:
+            bool: True for a heartbeat reply, which needs no further handling
+        """
+        self.last_seen = time.monotonic()
+        return text_data == 'pong'
+    
+    async def heartbeat(self):
+        interval = settings.BUFE_WS_HEARTBEAT_INTERVAL
+        timeout = settings.BUFE_WS_HEARTBEAT_TIMEOUT
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                if time.monotonic() - self.last_seen > timeout:
+                    connection_tracker.reaped(self.connection_kind)
+                    # Leave the groups now; the close handshake may never complete
+                    await self.disconnect(None)
+                    await self.close()
+                    return
+                await self.send(text_data='ping')
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Heartbeat stopped for {self.channel_name}: {e}")
+
+
+class OrderConsumer(HeartbeatMixin, AsyncWebsocketConsumer):
     """
     WebSocket consumer for broadcasting order updates to bufeadmin users.
+    
+    Dashboards acknowledge the last sequence number they applied. A client
+    with BUFE_WS_MAX_IN_FLIGHT frames unacknowledged is falling behind: new
+    events are held back and collapsed into the latest state per order until
+    it catches up, then sent as one frame. Past BUFE_WS_MAX_BACKLOG held
+    orders the backlog is dropped and the client is told to reload. Clients
+    that never acknowledge (older pages) are sent everything as before.
     """
     
+    connection_kind = 'admin'
+    
     async def connect(self):
         """
         Handle WebSocket connection.
@@ -27,18 +101,35 @@ class OrderConsumer(AsyncWebsocketConsumer):
         
         # Join the orders broadcast group
         self.room_group_name = 'bufe_orders'
+        self.acked_seq = None
+        self.reset_flow()
         
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
         
-        await self.accept()
+        # Compact framing only for clients that ask for it; JSON stays the default
+        self.compact = COMPACT_SUBPROTOCOL in self.scope.get('subprotocols', [])
+        if self.compact:
+            await self.accept(subprotocol=COMPACT_SUBPROTOCOL)
+            # The key dictionary goes first and uncompacted, before any event
+            await self.send(text_data=json.dumps({
+                'type': 'dictionary',
+                'keys': {short: key for key, short in COMPACT_KEYS.items()}
+            }))
+        else:
+            await self.accept()
+        
+        # Outbox events are sent from a background thread through this loop
+        broadcast_sender.bind_loop(asyncio.get_running_loop())
+        self.start_heartbeat()
     
     async def disconnect(self, close_code):
         """
         Handle WebSocket disconnection.
         """
+        self.stop_heartbeat()
         # Leave the orders broadcast group
         if hasattr(self, 'room_group_name'):
             await self.channel_layer.group_discard(
@@ -50,45 +141,142 @@ class OrderConsumer(AsyncWebsocketConsumer):
         """
         Handle messages received from WebSocket.
         """
+        if self.is_heartbeat(text_data):
+            return
         try:
             data = json.loads(text_data)
             message_type = data.get('type')
             
             if message_type == 'ping':
-                # Respond to ping with pong
-                await self.send(text_data=json.dumps({
+                # Pages loaded before the server heartbeat still ping
+                await self.send_frame({
                     'type': 'pong'
-                }))
+                })
             elif message_type == 'add_product':
                 # Handle add product request
                 await self.handle_add_product(data)
+            elif message_type == 'sync':
+                # Reconnecting client catching up from its last sequence number
+                await self.handle_sync(data)
+            elif message_type == 'ack':
+                await self.handle_ack(data)
         except Exception as e:
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'type': 'error',
                 'message': str(e)
-            }))
+            })
     
-    async def order_update(self, event):
+    async def order_events(self, event):
         """
-        Handle order update events from the group.
-        Send the order data to the WebSocket.
+        Handle a coalesced frame of order / product events from the group.
+        All events of the window are sent in one WebSocket message, encoded
+        once (in both framings) by the broadcast sender.
         """
-        await self.send(text_data=json.dumps({
-            'type': 'order_update',
-            'action': event['action'],
-            'order': event['order']
-        }))
+        self.received_seq = event['seq']
+        if self.resync_pending:
+            # The client is reloading; its next sync request covers these
+            connection_tracker.count(self.connection_kind, 'dropped', event['count'])
+            return
+        if self.backlog or not self.can_send():
+            await self.hold_back(json.loads(event['text'])['events'])
+            return
+        await self.send(text_data=event['compact'] if self.compact else event['text'])
+        self.track_in_flight(event['seq'])
     
-    async def product_update(self, event):
+    def reset_flow(self):
+        self.in_flight = deque()  # Last sequence number of every unacknowledged frame
+        self.backlog = {}
+        self.received_seq = 0
+        self.resync_pending = False
+    
+    def track_in_flight(self, seq):
+        """Remember a sent frame until it is acked; clients that never ack aren't tracked"""
+        if self.acked_seq is not None:
+            self.in_flight.append(seq)
+    
+    def can_send(self):
+        return self.acked_seq is None or len(self.in_flight) < settings.BUFE_WS_MAX_IN_FLIGHT
+    
+    async def hold_back(self, events):
         """
-        Handle product update events from the group.
-        Send the product data to the WebSocket.
+        Queue events for a client that is falling behind, keeping only the
+        latest state of every order and product.
         """
-        await self.send(text_data=json.dumps({
-            'type': 'product_update',
-            'action': event['action'],
-            'product': event['product']
-        }))
+        for item in events:
+            if item['type'] == 'orders_update':
+                for order in item['orders']:
+                    self.queue_event(('order', order['id']), {
+                        'type': 'order_update',
+                        'action': item['action'],
+                        'order': order,
+                        'seq': item['seq']
+                    })
+            elif item['type'] == 'order_update' and item['action'] == 'archive_all':
+                # The client reloads the whole list for this one
+                self.backlog = {key: queued for key, queued in self.backlog.items() if key[0] != 'order'}
+                self.queue_event(('archive_all',), item)
+            elif item['type'] == 'order_update':
+                self.queue_event(('order', item['order']['id']), item)
+            else:
+                self.queue_event((item['type'], item['product']['id']), item)
+        
+        if len(self.backlog) > settings.BUFE_WS_MAX_BACKLOG:
+            connection_tracker.count(self.connection_kind, 'dropped', len(self.backlog))
+            connection_tracker.count(self.connection_kind, 'resyncs')
+            self.backlog = {}
+            self.resync_pending = True
+            await self.send_frame({'type': 'resync'})
+    
+    def queue_event(self, key, item):
+        previous = self.backlog.pop(key, None)
+        if previous is not None:
+            connection_tracker.count(self.connection_kind, 'coalesced')
+            if previous['action'] in ('new', 'add') and item['action'] == 'update':
+                # The client has not seen the order / product yet
+                item = {**item, 'action': previous['action']}
+        self.backlog[key] = item
+    
+    async def handle_ack(self, data):
+        """
+        The client has applied everything up to 'seq'; send what was held
+        back once it has room again.
+        """
+        try:
+            self.acked_seq = int(data.get('seq'))
+        except (TypeError, ValueError):
+            return
+        while self.in_flight and self.in_flight[0] <= self.acked_seq:
+            self.in_flight.popleft()
+        if self.backlog and self.can_send():
+            events = list(self.backlog.values())
+            self.backlog = {}
+            # Collapsed events leave gaps; the frame stands for everything up to 'seq'
+            await self.send_frame({
+                'type': 'batch',
+                'coalesced': True,
+                'seq': self.received_seq,
+                'events': events
+            })
+            self.track_in_flight(self.received_seq)
+    
+    async def send_frame(self, frame):
+        """Send a frame in the encoding this client negotiated"""
+        await self.send(text_data=encode_frame(frame, self.compact))
+    
+    async def handle_sync(self, data):
+        """
+        Send the events a reconnecting client missed since the sequence
+        number it last applied, or ask it to reload the full order list
+        when those events can no longer be replayed.
+        """
+        try:
+            seq = int(data.get('seq'))
+        except (TypeError, ValueError):
+            seq = None
+        
+        # The reply covers everything held back or dropped so far
+        self.reset_flow()
+        await self.send_frame(await self.get_sync_reply(seq))
     
     async def handle_add_product(self, data):
         """
@@ -108,83 +296,52 @@ class OrderConsumer(AsyncWebsocketConsumer):
             
             # Validate required fields
             if not product_data['nev'] or not product_data['kategoria_id']:
-                await self.send(text_data=json.dumps({
+                await self.send_frame({
                     'type': 'add_product_response',
                     'success': False,
                     'error': 'Hiányzó kötelező mezők (név, kategória)'
-                }))
+                })
                 return
             
             # Create product
             product = await self.create_product(product_data)
             
             if product:
-                # Send success response
-                await self.send(text_data=json.dumps({
+                # Send success response; the broadcast to all admin clients
+                # was written to the outbox together with the product (signals.py)
+                await self.send_frame({
                     'type': 'add_product_response',
                     'success': True,
-                    'product': {
-                        'id': product.id,
-                        'nev': product.nev,
-                        'kategoria_id': product.kategoria.id,
-                        'kategoria_nev': product.kategoria.nev,
-                        'ar': product.ar,
-                        'max_rendelesenkent': product.max_rendelesenkent,
-                        'hutve': product.hutve,
-                        'elerheto': product.elerheto,
-                        'kisult': product.kisult
-                    }
-                }))
-                
-                # Broadcast to all admin clients
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'product_update',
-                        'action': 'add',
-                        'product': {
-                            'id': product.id,
-                            'nev': product.nev,
-                            'kategoria_id': product.kategoria.id,
-                            'kategoria_nev': product.kategoria.nev,
-                            'ar': product.ar,
-                            'max_rendelesenkent': product.max_rendelesenkent,
-                            'hutve': product.hutve,
-                            'elerheto': product.elerheto,
-                            'kisult': product.kisult
-                        }
-                    }
-                )
+                    'product': serialize_product(product)
+                })
             else:
-                await self.send(text_data=json.dumps({
+                await self.send_frame({
                     'type': 'add_product_response',
                     'success': False,
                     'error': 'Hiba a termék létrehozásában'
-                }))
+                })
                 
         except Exception as e:
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'type': 'add_product_response',
                 'success': False,
                 'error': str(e)
-            }))
+            })
+    
+    @database_sync_to_async
+    def get_sync_reply(self, seq):
+        """
+        Replay of the missed events, read from the outbox.
+        """
+        return sync_reply(seq)
     
     @database_sync_to_async
     def is_bufeadmin(self):
         """
         Check if the current user is a bufeadmin.
+        Shares the membership cache of the views and templates.
         """
-        if not self.user.is_authenticated:
-            return False
-        
-        try:
-            bufe = Bufe.objects.first()
-            if not bufe:
-                return False
-            
-            return bufe.bufeadmin.filter(id=self.user.id).exists()
-        except Exception:
-            return False
+        return is_bufeadmin(self.user)
     
     @database_sync_to_async
     def create_product(self, product_data):
@@ -192,21 +349,224 @@ class OrderConsumer(AsyncWebsocketConsumer):
         Create a new product in the database.
         """
         try:
-            from .models import Termek, Kategoria
+            from .models import Kategoria
             
             kategoria = Kategoria.objects.get(id=product_data['kategoria_id'])
             
-            termek = Termek.objects.create(
-                nev=product_data['nev'],
-                kategoria=kategoria,
-                ar=int(product_data['ar']),
-                max_rendelesenkent=int(product_data['max_rendelesenkent']),
-                hutve=bool(product_data['hutve']),
-                elerheto=bool(product_data['elerheto']),
-                kisult=bool(product_data['kisult'])
-            )
+            with transaction.atomic():
+                termek = Termek.objects.create(
+                    nev=product_data['nev'],
+                    kategoria=kategoria,
+                    ar=int(product_data['ar']),
+                    max_rendelesenkent=int(product_data['max_rendelesenkent']),
+                    hutve=bool(product_data['hutve']),
+                    elerheto=bool(product_data['elerheto']),
+                    kisult=bool(product_data['kisult'])
+                )
             
             return termek
         except Exception as e:
             print(f"Error creating product: {e}")
             return None
+
+
+class StudentOrderConsumer(HeartbeatMixin, AsyncWebsocketConsumer):
+    """
+    WebSocket consumer pushing status changes of a student's own orders
+    to their order_detail / my_orders pages.
+    """
+    
+    connection_kind = 'student'
+    
+    async def connect(self):
+        """
+        Handle WebSocket connection.
+        Every student only joins the group of their own orders.
+        """
+        self.user = self.scope["user"]
+        
+        has_access, reason = check_domain_access(self.user)
+        if not has_access:
+            await self.close()
+            return
+        
+        self.room_group_name = student_group_name(self.user.id)
+        
+        await self.channel_layer.group_add(
+            self.room_group_name,
+            self.channel_name
+        )
+        
+        await self.accept()
+        
+        broadcast_sender.bind_loop(asyncio.get_running_loop())
+        self.start_heartbeat()
+    
+    async def disconnect(self, close_code):
+        """
+        Handle WebSocket disconnection.
+        """
+        self.stop_heartbeat()
+        if hasattr(self, 'room_group_name'):
+            await self.channel_layer.group_discard(
+                self.room_group_name,
+                self.channel_name
+            )
+    
+    async def receive(self, text_data):
+        """
+        Students mostly listen; a ping is answered to keep the connection
+        alive. With BUFE_WS_ORDER_PLACEMENT the create_order page places
+        orders here as well, answered by one small frame instead of the
+        form POST, redirect and order page.
+        """
+        if self.is_heartbeat(text_data):
+            return
+        try:
+            data = json.loads(text_data)
+            message_type = data.get('type')
+        except (ValueError, AttributeError):
+            return
+        
+        if message_type == 'ping':
+            await self.send(text_data=json.dumps({'type': 'pong'}))
+        elif message_type == 'place_order' and settings.BUFE_WS_ORDER_PLACEMENT:
+            reply = await self.get_placement_reply(data)
+            await self.send(text_data=json.dumps(reply))
+    
+    async def get_placement_reply(self, data):
+        """
+        Place an order from a compact request:
+        {'type': 'place_order', 'ref': ..., 'key': idempotency key,
+         'cart': {termek_id: db}, 'szunet': ..., 'idozitve': ..., 'megjegyzes': ...}
+        The cart is turned back into the create_order form fields, so the
+        order is validated by CartValidator and RendelesForm like the form's.
+        Any failure is answered with an 'order_rejected' frame, so the page
+        learns about it and the connection stays open.
+        """
+        ref = data.get('ref')
+        try:
+            return await self.place_from_request(ref, data)
+        except OrderRejected as e:
+            return {'type': 'order_rejected', 'ref': ref, 'errors': e.errors}
+        except Exception as e:
+            print(f"Error placing order over WebSocket: {e}")
+            return {
+                'type': 'order_rejected',
+                'ref': ref,
+                'errors': ["Hiba történt a rendelés leadása során. Kérjük, próbálja újra."]
+            }
+    
+    async def place_from_request(self, ref, data):
+        reason = await self.get_closed_reason()
+        if reason:
+            return {'type': 'order_rejected', 'ref': ref, 'errors': [reason]}
+        
+        cart = data.get('cart') if isinstance(data.get('cart'), dict) else {}
+        form_data = {
+            f'{CartValidator.FIELD_PREFIX}{termek_id}': str(db)
+            for termek_id, db in cart.items()
+        }
+        form_data.update({
+            'idempotency_key': data.get('key') or '',
+            'szunet_valasztas': data.get('szunet') or '',
+            'idozitve': data.get('idozitve') or '',
+            'megjegyzes': data.get('megjegyzes') or '',
+        })
+        
+        rendeles, created = await aplace_order(self.user, form_data)
+        return {
+            'type': 'order_placed',
+            'ref': ref,
+            'order_id': rendeles.id,
+            'vegosszeg': rendeles.vegosszeg,
+        }
+    
+    @database_sync_to_async
+    def get_closed_reason(self):
+        return closed_reason(Bufe.objects.first())
+    
+    async def order_status(self, event):
+        """
+        Handle status changes of the student's orders (already encoded).
+        """
+        await self.send(text_data=event['text'])
+
+
+
+class CatalogConsumer(HeartbeatMixin, AsyncWebsocketConsumer):
+    """
+    Public, read-only WebSocket pushing product price and availability
+    changes to the create_order pages. All pages share one group, so a change
+    is serialized once and fanned out by the channel layer.
+    """
+    
+    connection_kind = 'catalog'
+    
+    async def connect(self):
+        """
+        Handle WebSocket connection. Only public catalog data is sent,
+        so no login is required.
+        """
+        await self.channel_layer.group_add(
+            CATALOG_GROUP,
+            self.channel_name
+        )
+        
+        await self.accept()
+        
+        broadcast_sender.bind_loop(asyncio.get_running_loop())
+        self.start_heartbeat()
+    
+    async def disconnect(self, close_code):
+        """
+        Handle WebSocket disconnection.
+        """
+        self.stop_heartbeat()
+        await self.channel_layer.group_discard(
+            CATALOG_GROUP,
+            self.channel_name
+        )
+    
+    async def receive(self, text_data):
+        """
+        Handle the catalog version check and pings.
+        A page sends {'type': 'hello', 'version': n} with the catalog version
+        it was rendered with (or last received) on every (re)connect.
+        """
+        if self.is_heartbeat(text_data):
+            return
+        try:
+            data = json.loads(text_data)
+            message_type = data.get('type')
+        except (ValueError, AttributeError):
+            return
+        
+        if message_type == 'ping':
+            await self.send(text_data=json.dumps({'type': 'pong'}))
+        elif message_type == 'hello':
+            snapshot = await self.get_snapshot(data.get('version'))
+            if snapshot:
+                await self.send(text_data=json.dumps(snapshot))
+    
+    @database_sync_to_async
+    def get_snapshot(self, version):
+        """
+        Current price and availability of every product, or None when the
+        client's version is still current.
+        """
+        current = catalog_version()
+        if version == current:
+            return None
+        return {
+            'type': 'catalog_snapshot',
+            'version': current,
+            'products': list(Termek.objects.values(*CATALOG_FIELDS))
+        }
+    
+    async def catalog_update(self, event):
+        """
+        Handle product changes coalesced by the broadcast sender.
+        The frame is encoded once for all ordering pages.
+        """
+        await self.send(text_data=event['text'])
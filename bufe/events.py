@@ -0,0 +1,455 @@
+"""
+Transactional outbox for the admin order WebSocket.
+
+Order and product events are not sent to the channel layer directly. They are
+written as Esemeny rows in the same transaction as the change they describe,
+so a rolled back change never produces an event and a committed one never
+loses it. After commit the background broadcast sender (utils.py) waits a
+few milliseconds and then publishes every pending row as one batch frame;
+rows left over (a crash, a channel layer error) are retried.
+
+The relay numbers the rows as it publishes them, under the relay lock. Only
+committed rows are visible to it, so sequence numbers follow commit order and
+have no gaps, whatever the database: a rolled back insert never gets one, and a
+transaction committing after a later one is simply numbered after it. (Row IDs
+can't be used for this: other databases than SQLite leave gaps for rolled back
+inserts and hand them out before commit.) A reconnecting dashboard sends the
+last sequence it has applied and gets the missed events straight from the
+table; a full snapshot from /bufe/admin/api/orders/ is needed only when the gap
+is larger than BUFE_SYNC_REPLAY_SIZE or already pruned.
+
+Product events are also pushed, reduced to price and availability, to the
+public catalog group the ordering pages listen on. The catalog version is the
+sequence number of the latest product event.
+
+Every group message carries its WebSocket frame already encoded (see
+text_message), so a frame is serialized once no matter how many consumers
+forward it. Frames for the admin group are also encoded in the compact form
+some dashboards negotiate.
+"""
+import asyncio
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.redis import RedisCache
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Esemeny
+from .serializers import compact_product, encode_frame
+
+
+ORDERS_GROUP = 'bufe_orders'
+CATALOG_GROUP = 'bufe_catalog'
+
+# Seconds a send handed to the server's event loop may take
+SEND_TIMEOUT = 5
+
+# Serializes relay runs within the process, so rows are published in order
+_relay_lock = threading.Lock()
+
+# Cache entry serializing relay runs across worker processes (shared cache only)
+RELAY_LOCK_KEY = 'bufe_outbox_relay'
+# Seconds after which the lock of a crashed worker expires; a running relay
+# extends it every third of this
+RELAY_LOCK_TIMEOUT = 30
+
+# Compare-and-delete and compare-and-extend of the lock entry in Redis, so a
+# worker never removes or prolongs a lock that has passed to another worker
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+_EXTEND_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class RelayLockEntry:
+    """
+    The cache entry of one relay run, owned through a random token.
+    With a Redis cache every step is a single atomic command or script. Any
+    other cache is this process's own (LocMemCache), where no other process
+    sees the entry and the thread lock around it makes each step atomic.
+    """
+
+    def __init__(self):
+        self.token = uuid.uuid4().hex
+        backend = caches['default']
+        if isinstance(backend, RedisCache):
+            self.key = backend.make_and_validate_key(RELAY_LOCK_KEY)
+            self.redis = backend._cache.get_client(self.key, write=True)
+        else:
+            self.redis = None
+
+    def acquire(self):
+        if self.redis is not None:
+            return bool(self.redis.set(self.key, self.token, nx=True, px=int(RELAY_LOCK_TIMEOUT * 1000)))
+        return cache.add(RELAY_LOCK_KEY, self.token, RELAY_LOCK_TIMEOUT)
+
+    def extend(self):
+        """Restart the timeout; False when the entry is no longer ours"""
+        if self.redis is not None:
+            return bool(self.redis.eval(_EXTEND_SCRIPT, 1, self.key, self.token, int(RELAY_LOCK_TIMEOUT * 1000)))
+        return cache.get(RELAY_LOCK_KEY) == self.token and cache.touch(RELAY_LOCK_KEY, RELAY_LOCK_TIMEOUT)
+
+    def release(self):
+        if self.redis is not None:
+            self.redis.eval(_RELEASE_SCRIPT, 1, self.key, self.token)
+        elif cache.get(RELAY_LOCK_KEY) == self.token:
+            cache.delete(RELAY_LOCK_KEY)
+
+
+@contextmanager
+def relay_lock():
+    """
+    Let one relay run at a time, so every row goes out once and in order.
+    The thread lock covers this process; with several workers sharing a
+    cache (REDIS_URL) the cache entry covers the other processes too. While
+    the relay runs, a watchdog thread keeps extending the entry, so a long
+    publish does not let it expire under the running relay.
+
+    Yields:
+        threading.Event: Set when the entry was lost all the same (e.g. the
+            process stalled for longer than RELAY_LOCK_TIMEOUT); the relay
+            must stop publishing
+
+    Raises:
+        RuntimeError: Another worker held the lock for longer than SEND_TIMEOUT;
+            the rows stay pending and that worker or a retry publishes them
+    """
+    with _relay_lock:
+        entry = RelayLockEntry()
+        deadline = time.monotonic() + SEND_TIMEOUT
+        while not entry.acquire():
+            if time.monotonic() > deadline:
+                raise RuntimeError("Another worker is still publishing the outbox")
+            time.sleep(0.01)
+
+        done = threading.Event()
+        lost = threading.Event()
+
+        def keep_alive():
+            while not done.wait(RELAY_LOCK_TIMEOUT / 3):
+                if not entry.extend():
+                    lost.set()
+                    return
+
+        watchdog = threading.Thread(target=keep_alive, name='bufe-relay-lock', daemon=True)
+        watchdog.start()
+        try:
+            yield lost
+        finally:
+            done.set()
+            watchdog.join()
+            entry.release()
+
+
+def record_event(event):
+    """
+    Write an event to the outbox as part of the current transaction and
+    schedule the relay for when it commits.
+
+    Args:
+        event (dict): Group message, e.g. {'type': 'order_update', ...}
+
+    Returns:
+        Esemeny: The outbox row; the relay gives it its sequence number
+    """
+    esemeny = Esemeny.objects.create(tipus=event['type'], adat=event)
+    transaction.on_commit(_schedule_publish)
+    return esemeny
+
+
+def record_events(events):
+    """
+    Write several events to the outbox with a single insert.
+
+    Args:
+        events (list): Group messages, in the order they should be published
+    """
+    Esemeny.objects.bulk_create([Esemeny(tipus=event['type'], adat=event) for event in events])
+    transaction.on_commit(_schedule_publish)
+
+
+def _schedule_publish():
+    from .utils import broadcast_sender
+    broadcast_sender.notify()
+
+
+def student_group_name(user_id):
+    """Group of the order pages a student has open"""
+    return f'bufe_user_{user_id}'
+
+
+def text_message(handler, frame, compact=False):
+    """
+    Group message carrying an already encoded WebSocket frame.
+
+    Args:
+        handler (str): Consumer method that forwards the frame
+        frame (dict): What the clients receive
+        compact (bool): Also include the compact encoding, for groups with
+            clients that may have negotiated it
+    """
+    message = {'type': handler, 'text': encode_frame(frame)}
+    if compact:
+        message['compact'] = encode_frame(frame, compact=True)
+    return message
+
+
+def order_events_message(events):
+    """
+    Group message for the admin group: one batch frame of sequenced events.
+    The last sequence number and the event count travel alongside the
+    encoded frame for the consumers' flow control.
+    """
+    message = text_message('order_events', {'type': 'batch', 'events': events}, compact=True)
+    message['seq'] = events[-1]['seq']
+    message['count'] = len(events)
+    return message
+
+
+def group_send(channel_layer, message, loop=None, group=ORDERS_GROUP):
+    """
+    Send a message to a group (the admin group by default). Given the ASGI
+    server's event loop, the send runs on that loop - the in-memory channel
+    layer only delivers to consumers waiting in the loop it is called from.
+    """
+    if loop is not None and loop.is_running():
+        asyncio.run_coroutine_threadsafe(
+            channel_layer.group_send(group, message),
+            loop
+        ).result(timeout=SEND_TIMEOUT)
+    else:
+        async_to_sync(channel_layer.group_send)(group, message)
+
+
+def student_updates(events):
+    """
+    Order status changes among the given events, grouped by the student who
+    placed the order. Only what the student's own pages show is included.
+
+    Returns:
+        dict: {user_id: [{'id', 'allapot', 'allapot_display'}, ...]}
+    """
+    updates = {}
+    for esemeny in events:
+        adat = esemeny.adat
+        if adat.get('action') != 'update':
+            continue
+        if adat['type'] == 'order_update':
+            orders = [adat['order']]
+        elif adat['type'] == 'orders_update':
+            orders = adat['orders']
+        else:
+            continue
+        for order in orders:
+            if 'user' not in order:
+                continue
+            # A later change of the same order replaces the earlier one
+            updates.setdefault(order['user']['id'], {})[order['id']] = {
+                'id': order['id'],
+                'allapot': order['allapot'],
+                'allapot_display': order['allapot_display']
+            }
+    return {user_id: list(orders.values()) for user_id, orders in updates.items()}
+
+
+def publish_student_updates(channel_layer, events, loop=None):
+    """
+    Push status changes only to the students who own the orders.
+    Best effort: the order pages show the current state on the next load.
+    """
+    for user_id, orders in student_updates(events).items():
+        try:
+            group_send(channel_layer, text_message('order_status', {
+                'type': 'order_status',
+                'orders': orders
+            }), loop=loop, group=student_group_name(user_id))
+        except Exception as e:
+            print(f"Error pushing order status to student {user_id}: {e}")
+
+
+def catalog_changes(events):
+    """
+    Price and availability changes among the given events, one entry per
+    product with its latest state. A deleted product is sent as unavailable.
+
+    Returns:
+        tuple: (version, products) - version is 0 when there is no product event
+    """
+    version = 0
+    products = {}
+    for esemeny in events:
+        if esemeny.tipus != 'product_update':
+            continue
+        version = esemeny.seq
+        product = esemeny.adat['product']
+        if esemeny.adat.get('action') == 'delete':
+            products[product['id']] = {'id': product['id'], 'elerheto': False}
+        else:
+            products[product['id']] = compact_product(product)
+    return version, list(products.values())
+
+
+def publish_catalog_updates(channel_layer, events, loop=None):
+    """
+    Push product changes to the ordering pages as one compact frame.
+    Best effort: a page whose version is behind gets a snapshot on reconnect.
+    """
+    version, products = catalog_changes(events)
+    if not products:
+        return
+    try:
+        group_send(channel_layer, text_message('catalog_update', {
+            'type': 'catalog_update',
+            'version': version,
+            'products': products
+        }), loop=loop, group=CATALOG_GROUP)
+    except Exception as e:
+        print(f"Error pushing catalog update: {e}")
+
+
+def number_pending():
+    """
+    Give the unsent rows that have no sequence number yet the next ones, in
+    ID order. Must run under relay_lock, the only place numbers are handed out;
+    rows numbered by a run that then failed to send keep their numbers.
+    """
+    pending = list(Esemeny.objects.filter(kikuldve__isnull=True, seq__isnull=True).order_by('id'))
+    if not pending:
+        return
+    latest = get_latest_seq()
+    for offset, esemeny in enumerate(pending, start=1):
+        esemeny.seq = latest + offset
+    Esemeny.objects.bulk_update(pending, ['seq'])
+
+
+def publish_pending(batch_size=None, loop=None):
+    """
+    Number and publish every unsent outbox row to the admin group, oldest
+    first, and prune rows that are too old to be replayed. Up to batch_size events
+    (BUFE_BROADCAST_MAX_BATCH) travel together as one 'order_events' frame;
+    status changes are also pushed to the students who own the orders and
+    product changes to the catalog group.
+
+    Returns:
+        int: Number of events published
+
+    Raises:
+        Whatever the channel layer raised; unsent events stay pending
+    """
+    channel_layer = get_channel_layer()
+    if not channel_layer:
+        return 0
+    if batch_size is None:
+        batch_size = settings.BUFE_BROADCAST_MAX_BATCH
+
+    published = 0
+    with relay_lock() as lost:
+        while True:
+            if lost.is_set():
+                raise RuntimeError("The outbox relay lock expired while publishing")
+            number_pending()
+            # Rows committed since number_pending wait for the next round
+            batch = list(Esemeny.objects.filter(
+                kikuldve__isnull=True,
+                seq__isnull=False
+            ).order_by('seq')[:batch_size])
+            if not batch:
+                break
+
+            # On error the batch stays unsent for the next run, keeping the order intact
+            group_send(channel_layer, order_events_message([esemeny.to_message() for esemeny in batch]), loop=loop)
+            publish_student_updates(channel_layer, batch, loop=loop)
+            publish_catalog_updates(channel_layer, batch, loop=loop)
+            Esemeny.objects.filter(id__in=[esemeny.id for esemeny in batch]).update(kikuldve=timezone.now())
+            published += len(batch)
+
+        if published:
+            prune_outbox()
+    return published
+
+
+def prune_outbox():
+    """Delete sent events that are older than the last BUFE_OUTBOX_RETENTION"""
+    latest = get_latest_seq()
+    Esemeny.objects.filter(
+        seq__lte=latest - settings.BUFE_OUTBOX_RETENTION,
+        kikuldve__isnull=False
+    ).delete()
+
+
+def get_latest_seq():
+    """Latest sequence number handed out, 0 if there is none"""
+    return Esemeny.objects.filter(seq__isnull=False).order_by('-seq').values_list('seq', flat=True).first() or 0
+
+
+def catalog_version():
+    """Sequence number of the latest numbered product event, 0 if there is none"""
+    return Esemeny.objects.filter(
+        tipus='product_update',
+        seq__isnull=False
+    ).order_by('-seq').values_list('seq', flat=True).first() or 0
+
+
+def sync_cursor():
+    """Position a client has caught up to after loading a full snapshot"""
+    return {'seq': get_latest_seq()}
+
+
+def events_since(seq):
+    """
+    Events recorded after the given sequence number.
+
+    Args:
+        seq (int): Last sequence number the client has applied
+
+    Returns:
+        list or None: Missed event messages in order, or None when they are
+        no longer all available and the client needs a full snapshot
+    """
+    if seq is None:
+        return None
+
+    latest = get_latest_seq()
+    if seq == latest:
+        return []
+    if seq > latest or latest - seq > settings.BUFE_SYNC_REPLAY_SIZE:
+        return None
+
+    events = list(Esemeny.objects.filter(seq__gt=seq).order_by('seq'))
+    if not events or events[0].seq != seq + 1:
+        # The start of the gap has already been pruned
+        return None
+    return [esemeny.to_message() for esemeny in events]
+
+
+def sync_reply(seq):
+    """
+    Frame answering a client that has applied events up to seq: a replay of
+    the missed events read from the outbox, or a snapshot notice when they
+    are no longer all available.
+    """
+    events = events_since(seq)
+    if events is None:
+        return {
+            'type': 'sync_snapshot',
+            **sync_cursor()
+        }
+    return {
+        'type': 'sync_replay',
+        'events': events
+    }
@@ -1,7 +1,8 @@
 from django import forms
 from django.core.validators import MinValueValidator
-from .models import Rendeles, Termek
+from .models import Rendeles, Termek, SzunetFoglaltsag, SZUNET_CHOICES
 import json
+import uuid
 
 
 class OrderItemForm(forms.Form):
@@ -36,25 +37,83 @@ class OrderItemForm(forms.Form):
         return cleaned_data
 
 
+class CartValidator:
+    """
+    Validates the quantity_<termek_id> fields of an order form in one pass.
+    All referenced products are loaded with a single query, and every
+    per-line problem is collected instead of stopping at the first one.
+    """
+    
+    FIELD_PREFIX = 'quantity_'
+    
+    def __init__(self, data):
+        self.data = data
+        self.cart_items = []
+        self.termekek = {}
+        self.errors = []
+    
+    def parse_quantities(self):
+        """Collect positive quantities keyed by product id"""
+        quantities = {}
+        for key, value in self.data.items():
+            if not key.startswith(self.FIELD_PREFIX):
+                continue
+            try:
+                termek_id = int(key[len(self.FIELD_PREFIX):])
+                quantity = int(value) if value else 0
+            except (TypeError, ValueError):
+                self.errors.append("Érvénytelen mennyiség a kosárban.")
+                continue
+            if quantity > 0:
+                quantities[termek_id] = quantity
+        return quantities
+    
+    def is_valid(self):
+        quantities = self.parse_quantities()
+        self.termekek = Termek.objects.in_bulk(quantities.keys()) if quantities else {}
+        
+        for termek_id, quantity in quantities.items():
+            termek = self.termekek.get(termek_id)
+            if termek is None:
+                self.errors.append("A kiválasztott termék nem található.")
+            elif not termek.elerheto:
+                self.errors.append(f"{termek.nev} már nem elérhető.")
+            elif quantity > termek.max_rendelesenkent:
+                self.errors.append(
+                    f"{termek.nev}: Maximum {termek.max_rendelesenkent} darab rendelhető."
+                )
+            else:
+                self.cart_items.append({
+                    'termek_id': termek_id,
+                    'db': quantity
+                })
+        
+        if not quantities:
+            self.errors.append("Kérem válasszon ki legalább egy terméket!")
+        
+        return not self.errors
+
+
 class RendelesForm(forms.ModelForm):
     """Form for creating an order"""
     
-    BREAK_CHOICES = [
-        ('', '--- Válasszon szünetet ---'),
-        ('09:10', '1. óra utáni szünet (9:10)'),
-        ('10:05', '3. óra utáni szünet (10:05)'),
-        ('11:05', '4. óra utáni szünet (11:05)'),
-        ('12:00', '5. óra utáni szünet (12:00)'),
-        ('13:05', '6. óra utáni szünet (13:05)'),
-        ('14:10', '7. óra utáni szünet (14:10)'),
-    ]
+    BREAK_CHOICES = [('', '--- Válasszon szünetet ---')] + SZUNET_CHOICES
+    
+    idempotency_key = forms.CharField(
+        max_length=64,
+        required=False,
+        widget=forms.HiddenInput()
+    )
     
     szunet_valasztas = forms.ChoiceField(
         choices=BREAK_CHOICES,
         required=False,
         label='Szünet választása',
         widget=forms.Select(attrs={'class': 'form-control'}),
-        help_text='Válasszon a szünetek közül, vagy adjon meg egyedi időpontot alább'
+        help_text='Válasszon a szünetek közül, vagy adjon meg egyedi időpontot alább',
+        error_messages={
+            'invalid_choice': 'A választott szünet betelt, kérjük válasszon másikat.'
+        }
     )
     
     class Meta:
@@ -84,30 +143,53 @@ class RendelesForm(forms.ModelForm):
         super().__init__(*args, **kwargs)
         self.fields['idozitve'].required = True
         self.fields['megjegyzes'].required = False
+        # Fresh key for every rendered form, so a resubmitted form can be recognized
+        if not self.is_bound:
+            self.initial.setdefault('idempotency_key', uuid.uuid4().hex)
         # Reorder fields to show break selection first
         self.order_fields(['szunet_valasztas', 'idozitve', 'megjegyzes'])
+        # Only offer breaks that still have room
+        self.fields['szunet_valasztas'].choices = self.available_break_choices()
     
-    def clean(self):
-        """Validate form data"""
+    @staticmethod
+    def next_break_datetime(szunet, now=None):
+        """
+        The next occurrence of a break at least 10 minutes from now:
+        today if there is still time, otherwise tomorrow.
+        """
         from datetime import datetime, timedelta
         
+        now = now or datetime.now()
+        break_time = datetime.strptime(szunet, '%H:%M').time()
+        scheduled_datetime = datetime.combine(now.date(), break_time)
+        if scheduled_datetime < now + timedelta(minutes=10):
+            scheduled_datetime += timedelta(days=1)
+        return scheduled_datetime
+    
+    @classmethod
+    def break_fill_levels(cls):
+        """Fill level of the next occurrence of every break"""
+        return SzunetFoglaltsag.fill_levels({
+            szunet: cls.next_break_datetime(szunet).date()
+            for szunet, label in SZUNET_CHOICES
+        })
+    
+    def available_break_choices(self):
+        levels = self.break_fill_levels()
+        return [
+            (szunet, label) for szunet, label in self.BREAK_CHOICES
+            if not szunet or levels[szunet]['szabad'] != 0
+        ]
+    
+    def clean(self):
+        """Validate form data"""
         cleaned_data = super().clean()
         szunet_valasztas = cleaned_data.get('szunet_valasztas')
         idozitve = cleaned_data.get('idozitve')
         
         # If break is selected, convert it to datetime
         if szunet_valasztas:
-            now = datetime.now()
-            break_time = datetime.strptime(szunet_valasztas, '%H:%M').time()
-            
-            # Combine with today's date
-            scheduled_datetime = datetime.combine(now.date(), break_time)
-            
-            # If the time has already passed today, schedule for tomorrow
-            if scheduled_datetime < now + timedelta(minutes=10):
-                scheduled_datetime += timedelta(days=1)
-            
-            cleaned_data['idozitve'] = scheduled_datetime
+            cleaned_data['idozitve'] = self.next_break_datetime(szunet_valasztas)
         
         return cleaned_data
     
@@ -0,0 +1,179 @@
+"""
+Write-coalescing order ingestion for break-time bursts.
+
+With BUFE_BATCHED_ORDER_INGEST enabled, orders placed over the student
+WebSocket are handed, once validated, to a single writer thread instead of
+each opening its own transaction. The writer collects the orders arriving
+within a short window and inserts them with one bulk_create, so a burst costs
+one transaction and commit per batch rather than per order. The 'new' order
+events are written to the outbox in the same transaction as the batch.
+
+Only async callers can batch: a consumer awaits its order without holding the
+sync thread Django and Channels share, so the other connections' orders are
+validated and queued meanwhile. The create_order form is not batched: a sync
+view waiting for the writer would block that one thread and every batch would
+hold a single order, and making the view async would not help, because the
+sync-only WhiteNoise middleware runs every HTTP request on that thread as well.
+Form POSTs therefore keep writing their orders themselves, and the setting only
+has an effect together with BUFE_WS_ORDER_PLACEMENT.
+"""
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import transaction, IntegrityError, close_old_connections
+from django.db.models import prefetch_related_objects
+
+from .models import Rendeles, RendelesTetel
+from .serializers import serialize_order
+from .events import record_events
+from .utils import broadcast_order_update
+
+
+def write_batch(entries):
+    """
+    Insert a batch of orders and their lines in one transaction.
+    
+    Args:
+        entries (list): (rendeles, termekek, future) tuples. Each future is
+            resolved with the saved order, or with the exception it raised.
+    """
+    for rendeles, termekek, future in entries:
+        rendeles.vegosszeg = rendeles.calculate_total(termekek)
+    
+    orders = [rendeles for rendeles, termekek, future in entries]
+    
+    try:
+        with transaction.atomic():
+            Rendeles.objects.bulk_create(orders)
+            tetelek = []
+            for rendeles, termekek, future in entries:
+                tetelek.extend(rendeles.build_tetelek(termekek))
+            RendelesTetel.objects.bulk_create(tetelek)
+            
+            # Outbox events commit together with the orders
+            prefetch_related_objects(orders, 'tetelek')
+            record_events([
+                {'type': 'order_update', 'action': 'new', 'order': serialize_order(rendeles)}
+                for rendeles in orders
+            ])
+    except IntegrityError:
+        # A single conflicting order (e.g. a retried idempotency key)
+        # must not fail the rest of the batch - write them one by one
+        for rendeles, termekek, future in entries:
+            rendeles.pk = None
+            rendeles._state.adding = True
+            try:
+                with transaction.atomic():
+                    rendeles.save(termekek=termekek)
+                    broadcast_order_update(serialize_order(rendeles), action='new')
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(rendeles)
+        return
+    except Exception as e:
+        for rendeles, termekek, future in entries:
+            future.set_exception(e)
+        return
+    
+    for rendeles, termekek, future in entries:
+        future.set_result(rendeles)
+
+
+class OrderIngestQueue:
+    """
+    In-process queue drained by a single background writer thread.
+    """
+    
+    def __init__(self, batch_window=None, max_batch=None, timeout=None):
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    def _ensure_writer(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            if self.batch_window is None:
+                self.batch_window = settings.BUFE_INGEST_BATCH_WINDOW_MS / 1000
+            if self.max_batch is None:
+                self.max_batch = settings.BUFE_INGEST_MAX_BATCH
+            if self.timeout is None:
+                self.timeout = settings.BUFE_INGEST_TIMEOUT
+            self._thread = threading.Thread(
+                target=self._run,
+                name='bufe-order-ingest',
+                daemon=True
+            )
+            self._thread.start()
+    
+    async def submit(self, rendeles, termekek):
+        """
+        Queue an unsaved order and wait, without blocking a thread, until the
+        writer has inserted it.
+        
+        Args:
+            rendeles: Unsaved Rendeles object
+            termekek (dict): {termek_id: Termek} map of the order's products
+        
+        Returns:
+            Rendeles: The same object, now saved with its ID assigned
+        
+        Raises:
+            TimeoutError: The writer did not take the order within the timeout;
+                it has been withdrawn and will never be written
+            Whatever writing the order raised
+        """
+        self._ensure_writer()
+        future = Future()
+        self._queue.put((rendeles, termekek, future))
+        
+        waiter = asyncio.wrap_future(future)
+        done, pending = await asyncio.wait({waiter}, timeout=self.timeout)
+        if not done and future.cancel():
+            raise TimeoutError("The order was not written in time")
+        # Taken by the writer before the timeout: its outcome is the order's
+        return await waiter
+    
+    def qsize(self):
+        return self._queue.qsize()
+    
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+    
+    def _run(self):
+        while True:
+            # Orders withdrawn after a timeout are dropped; the rest can no longer be withdrawn
+            batch = [entry for entry in self._collect_batch() if entry[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                write_batch(batch)
+            except Exception as e:
+                for entry in batch:
+                    if not entry[2].done():
+                        entry[2].set_exception(e)
+            finally:
+                close_old_connections()
+
+
+order_ingest_queue = OrderIngestQueue()
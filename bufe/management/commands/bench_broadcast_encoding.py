@@ -0,0 +1,108 @@
+import json
+import time
+
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+
+from bufe.consumers import OrderConsumer
+from bufe.events import text_message
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure the CPU time one broadcast event costs on the consumer side as the '
+        'number of connected dashboards grows: encoding the frame in every consumer '
+        'versus forwarding the frame encoded once by the broadcast sender'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--connections',
+            default='1,10,100,500',
+            help='Comma separated connection counts to measure (default: 1,10,100,500)',
+        )
+        parser.add_argument(
+            '--events',
+            type=int,
+            default=200,
+            help='Events broadcast per measurement (default: 200)',
+        )
+        parser.add_argument(
+            '--items',
+            type=int,
+            default=3,
+            help='Lines per order in the sample events (default: 3)',
+        )
+
+    def handle(self, *args, **options):
+        events = [self.sample_event(i, options['items']) for i in range(options['events'])]
+
+        self.stdout.write(f"{'connections':>12} {'per consumer':>14} {'pre-encoded':>14} {'speedup':>8}")
+        for connections in [int(count) for count in options['connections'].split(',')]:
+            legacy = self.measure(connections, events, pre_encoded=False)
+            current = self.measure(connections, events, pre_encoded=True)
+            self.stdout.write(
+                f'{connections:>12} {legacy * 1e6:>11.1f} us {current * 1e6:>11.1f} us {legacy / current:>7.1f}x'
+            )
+        self.stdout.write('CPU time per broadcast event, summed over all connections')
+
+    def sample_event(self, seq, items):
+        """An order event shaped like serialize_order output"""
+        return {
+            'type': 'order_update',
+            'action': 'update',
+            'seq': seq,
+            'order': {
+                'id': seq,
+                'user': {
+                    'id': seq % 500,
+                    'username': f'diak{seq % 500}',
+                    'full_name': 'Teszt Elek',
+                    'email': f'diak{seq % 500}@szlgbp.hu'
+                },
+                'items': [{
+                    'termek_id': i,
+                    'termek_nev': f'Termék {i}',
+                    'termek_ar': 350,
+                    'mennyiseg': 2,
+                    'osszeg': 700
+                } for i in range(items)],
+                'vegosszeg': 700 * items,
+                'allapot': 'visszaigasolva',
+                'allapot_display': 'Visszaigazolva',
+                'szunet': '10:45 - 11:00',
+                'megjegyzes': '',
+                'idopont': '2026-10-16T10:00:00+02:00',
+            }
+        }
+
+    def measure(self, connections, events, pre_encoded):
+        """Average CPU seconds one event costs across all connections"""
+        consumers = []
+        for i in range(connections):
+            consumer = OrderConsumer()
+            consumer.send = self.discard
+            consumers.append(consumer)
+
+        async def run():
+            start = time.process_time()
+            for event in events:
+                if pre_encoded:
+                    message = text_message('order_events', {'type': 'batch', 'events': [event]})
+                    for consumer in consumers:
+                        await consumer.order_events(message)
+                else:
+                    # What every consumer did before the frame was encoded at the source
+                    message = {'type': 'order_events', 'events': [event]}
+                    for consumer in consumers:
+                        await consumer.send(text_data=json.dumps({
+                            'type': 'batch',
+                            'events': message['events']
+                        }))
+            return (time.process_time() - start) / len(events)
+
+        return async_to_sync(run)()
+
+    @staticmethod
+    async def discard(text_data=None, bytes_data=None, close=False):
+        """Stands in for the WebSocket; the transport cost is the same either way"""
@@ -0,0 +1,92 @@
+import zlib
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from bufe.models import Bufe, Kategoria, Termek, Rendeles
+from bufe.serializers import encode_frame, serialize_orders, serialize_product
+
+
+class Command(BaseCommand):
+    help = (
+        'Report the bytes per update the admin WebSocket sends in plain JSON and in the '
+        'compact framing, with and without deflate, for frames built from real orders '
+        'seeded inside a rolled back transaction'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--items',
+            type=int,
+            default=3,
+            help='Lines per order (default: 3)',
+        )
+        parser.add_argument(
+            '--replay',
+            type=int,
+            default=50,
+            help='Events in the sync replay frame (default: 50)',
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            frames = self.build_frames(options)
+
+            self.stdout.write(
+                f"{'frame':<22} {'events':>6} {'json':>8} {'compact':>8} {'saved':>6} "
+                f"{'json+defl':>10} {'compact+defl':>13}"
+            )
+            for name, frame in frames:
+                events = len(frame.get('events', [None]))
+                text = len(encode_frame(frame).encode())
+                compact = len(encode_frame(frame, compact=True).encode())
+                self.stdout.write(
+                    f'{name:<22} {events:>6} {text / events:>8.0f} {compact / events:>8.0f} '
+                    f'{1 - compact / text:>6.0%} {self.deflated(encode_frame(frame)) / events:>10.0f} '
+                    f'{self.deflated(encode_frame(frame, compact=True)) / events:>13.0f}'
+                )
+            self.stdout.write('Bytes per update (per event for batch and replay frames)')
+
+            # Leave the database exactly as it was
+            transaction.set_rollback(True)
+
+    def build_frames(self, options):
+        bufe = Bufe.objects.create(nev='Benchmark büfé')
+        kategoria = Kategoria.objects.create(nev='Szendvicsek', bufe=bufe)
+        termekek = [
+            Termek.objects.create(nev=f'Sonkás-sajtos szendvics {i}', kategoria=kategoria, ar=450, max_rendelesenkent=5)
+            for i in range(options['items'])
+        ]
+        orders = []
+        for i in range(options['replay']):
+            user = User.objects.create_user(
+                username=f'bench_frame_{i}',
+                email=f'bench_frame_{i}@szlgbp.hu',
+                first_name='Elek',
+                last_name=f'Kovács {i}'
+            )
+            orders.append(Rendeles.objects.create(
+                user=user,
+                items=[{'termek_id': termek.id, 'db': 2} for termek in termekek],
+                megjegyzes='Ketchup nélkül'
+            ))
+
+        events = [
+            {'type': 'order_update', 'action': 'new', 'order': order, 'seq': seq}
+            for seq, order in enumerate(serialize_orders(orders), start=1)
+        ]
+        return [
+            ('single order event', {'type': 'batch', 'events': events[:1]}),
+            ('batch of 10 orders', {'type': 'batch', 'events': events[:10]}),
+            ('sync replay', {'type': 'sync_replay', 'events': events}),
+            ('product event', {'type': 'batch', 'events': [
+                {'type': 'product_update', 'action': 'update', 'product': serialize_product(termekek[0]), 'seq': 1}
+            ]}),
+        ]
+
+    @staticmethod
+    def deflated(text):
+        """Size after raw deflate, roughly what permessage-deflate would send"""
+        compressor = zlib.compressobj(wbits=-15)
+        return len(compressor.compress(text.encode()) + compressor.flush())
@@ -0,0 +1,165 @@
+import json
+import secrets
+import statistics
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.urls import reverse
+
+from bufe.consumers import StudentOrderConsumer
+from bufe.models import Bufe, Kategoria, Termek, Rendeles
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare placing an order through the create_order form (POST, redirect and the '
+        'order_detail page) with placing it over the student WebSocket (one request and '
+        'one reply frame): server time and bytes sent back per order, in process without '
+        'network. Uses the configured database; the benchmark data is deleted afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--orders',
+            type=int,
+            default=200,
+            help='Orders placed through each path (default: 200)',
+        )
+        parser.add_argument(
+            '--items',
+            type=int,
+            default=3,
+            help='Lines per order (default: 3)',
+        )
+
+    def handle(self, *args, **options):
+        fixture = self.create_fixture(options)
+        try:
+            form = self.measure_form(fixture, options)
+            socket = async_to_sync(self.measure_socket)(fixture, options)
+        finally:
+            self.delete_fixture(fixture)
+
+        self.stdout.write(f"{'path':<10} {'orders/s':>9} {'p50':>9} {'p95':>9} {'bytes/order':>12}")
+        for name, result in (('form', form), ('websocket', socket)):
+            self.stdout.write(
+                f"{name:<10} {result['throughput']:>9.1f} {result['p50']:>7.1f}ms {result['p95']:>7.1f}ms "
+                f"{result['bytes']:>12.0f}"
+            )
+        self.stdout.write(
+            f"WebSocket placement: {form['p50'] / socket['p50']:.1f}x faster at p50, "
+            f"{form['bytes'] / socket['bytes']:.0f}x fewer bytes"
+        )
+
+    # Fixture
+
+    def create_fixture(self, options):
+        prefix = f'bench_{secrets.token_hex(3)}'
+        bufe = Bufe.objects.first()
+        created_bufe = bufe is None
+        if created_bufe:
+            bufe = Bufe.objects.create(nev='Benchmark büfé')
+        # The orders go to the first büfé, so it is opened for the run and closed again afterwards
+        was_closed = bufe.rendkivuli_zarva
+        Bufe.objects.filter(id=bufe.id).update(rendkivuli_zarva=False)
+
+        kategoria = Kategoria.objects.create(nev=f'{prefix} kategória', bufe=bufe)
+        termekek = [
+            Termek.objects.create(nev=f'{prefix} szendvics {i}', kategoria=kategoria, ar=450, max_rendelesenkent=5)
+            for i in range(options['items'])
+        ]
+        user = User.objects.create_user(username=f'{prefix}_diak', email=f'{prefix}_diak@szlgbp.hu')
+        return {
+            'bufe': bufe,
+            'created_bufe': created_bufe,
+            'was_closed': was_closed,
+            'kategoria': kategoria,
+            'termekek': termekek,
+            'user': user,
+        }
+
+    def delete_fixture(self, fixture):
+        Rendeles.objects.filter(user=fixture['user']).delete()
+        for termek in fixture['termekek']:
+            termek.delete()
+        fixture['kategoria'].delete()
+        fixture['user'].delete()
+        if fixture['created_bufe']:
+            fixture['bufe'].delete()
+        elif fixture['was_closed']:
+            Bufe.objects.filter(id=fixture['bufe'].id).update(rendkivuli_zarva=True)
+
+    def idozitve(self):
+        return (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%dT%H:%M')
+
+    # The two paths
+
+    def measure_form(self, fixture, options):
+        client = Client(HTTP_HOST=settings.ALLOWED_HOSTS[0])
+        client.force_login(fixture['user'])
+        latencies, sizes = [], []
+        start = time.perf_counter()
+        for i in range(options['orders']):
+            data = {
+                'idempotency_key': uuid.uuid4().hex,
+                'idozitve': self.idozitve(),
+                'megjegyzes': '',
+                **{f'quantity_{termek.id}': '1' for termek in fixture['termekek']},
+            }
+            sent = time.perf_counter()
+            response = client.post(reverse('bufe:create_order'), data)
+            if response.status_code != 302:
+                raise RuntimeError(f"The form did not place the order (status {response.status_code})")
+            page = client.get(response.url)
+            latencies.append((time.perf_counter() - sent) * 1000)
+            sizes.append(len(response.content) + len(page.content))
+        return self.summary(latencies, sizes, time.perf_counter() - start)
+
+    async def measure_socket(self, fixture, options):
+        communicator = WebsocketCommunicator(StudentOrderConsumer.as_asgi(), '/ws/bufe/my-orders/')
+        communicator.scope['user'] = fixture['user']
+        connected, _ = await communicator.connect()
+        if not connected:
+            raise RuntimeError("The student WebSocket refused the benchmark user")
+
+        latencies, sizes = [], []
+        start = time.perf_counter()
+        try:
+            for i in range(options['orders']):
+                sent = time.perf_counter()
+                await communicator.send_to(text_data=json.dumps({
+                    'type': 'place_order',
+                    'ref': i,
+                    'key': uuid.uuid4().hex,
+                    'cart': {str(termek.id): 1 for termek in fixture['termekek']},
+                    'idozitve': self.idozitve(),
+                }))
+                reply = await communicator.receive_from(timeout=10)
+                while reply == 'ping':
+                    # Server heartbeat on a long run
+                    await communicator.send_to(text_data='pong')
+                    reply = await communicator.receive_from(timeout=10)
+                latencies.append((time.perf_counter() - sent) * 1000)
+                sizes.append(len(reply.encode()))
+                if json.loads(reply)['type'] != 'order_placed':
+                    raise RuntimeError(f"The WebSocket did not place the order: {reply}")
+        finally:
+            await communicator.disconnect()
+        return self.summary(latencies, sizes, time.perf_counter() - start)
+
+    @staticmethod
+    def summary(latencies, sizes, elapsed):
+        percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        return {
+            'throughput': len(latencies) / elapsed,
+            'p50': percentiles[49],
+            'p95': percentiles[94],
+            'bytes': statistics.mean(sizes),
+        }
@@ -0,0 +1,147 @@
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from bufe.models import Bufe, Kategoria, Termek, Rendeles
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a large number of orders inside a rolled back transaction and report '
+        'query plans and latency of the hot Rendeles queries, with and without '
+        'the composite indexes'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--orders',
+            type=int,
+            default=100000,
+            help='Number of orders to seed (default: 100000)',
+        )
+        parser.add_argument(
+            '--users',
+            type=int,
+            default=1500,
+            help='Number of students the orders are spread across (default: 1500)',
+        )
+        parser.add_argument(
+            '--active',
+            type=int,
+            default=300,
+            help='Number of non-archived orders (default: 300)',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=20,
+            help='Runs per query when measuring latency (default: 20)',
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            student = self.seed(options)
+            self.stdout.write(self.style.SUCCESS('\n=== With indexes ==='))
+            self.run_queries(student, options['repeat'])
+
+            self.drop_indexes()
+            self.stdout.write(self.style.WARNING('\n=== Without indexes ==='))
+            self.run_queries(student, options['repeat'])
+
+            # Leave the database exactly as it was
+            transaction.set_rollback(True)
+
+    def seed(self, options):
+        self.stdout.write(f"Seeding {options['orders']} orders for {options['users']} students...")
+        started = time.perf_counter()
+
+        bufe = Bufe.objects.create(nev='Benchmark Büfé')
+        kategoria = Kategoria.objects.create(nev='Benchmark', bufe=bufe)
+        termekek = Termek.objects.bulk_create([
+            Termek(nev=f'Benchmark termék {i}', kategoria=kategoria, ar=100 + i * 10, max_rendelesenkent=5)
+            for i in range(30)
+        ])
+        users = User.objects.bulk_create([
+            User(username=f'bench_{i}', email=f'bench_{i}@szlgbp.hu')
+            for i in range(options['users'])
+        ])
+        users = list(User.objects.filter(username__startswith='bench_'))
+
+        states = [state for state, label in Rendeles.ORDER_STATES]
+        now = datetime.now()
+        active_from = options['orders'] - options['active']
+
+        # leadva is auto_now_add; switch it off so the history can be spread over months
+        leadva_field = Rendeles._meta.get_field('leadva')
+        leadva_field.auto_now_add = False
+        try:
+            batch = []
+            for i in range(options['orders']):
+                leadva = now - timedelta(minutes=(options['orders'] - i) * 2)
+                batch.append(Rendeles(
+                    user=random.choice(users),
+                    items=[{'termek_id': random.choice(termekek).id, 'db': random.randint(1, 3)}],
+                    allapot=random.choice(states),
+                    leadva=leadva,
+                    idozitve=leadva + timedelta(minutes=random.randint(10, 240)),
+                    archived=i < active_from,
+                    vegosszeg=random.randint(100, 2000),
+                ))
+                if len(batch) == 5000:
+                    Rendeles.objects.bulk_create(batch)
+                    batch = []
+            Rendeles.objects.bulk_create(batch)
+        finally:
+            leadva_field.auto_now_add = True
+
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute('ANALYZE')
+
+        self.stdout.write(f'Seeded in {time.perf_counter() - started:.1f}s')
+        return Rendeles.objects.filter(archived=False).values_list('user', flat=True).first()
+
+    def get_queries(self, student_id):
+        slot_start = datetime.now().replace(hour=10, minute=0, second=0, microsecond=0)
+        return [
+            ('admin_dashboard / api_get_orders',
+             Rendeles.objects.filter(archived=False).order_by('-leadva')),
+            ('my_orders',
+             Rendeles.objects.filter(user_id=student_id, archived=False).order_by('-leadva')),
+            ('index recent orders',
+             Rendeles.objects.filter(user_id=student_id, archived=False).order_by('-leadva')[:5]),
+            ('api_archive_all_done',
+             Rendeles.objects.filter(allapot__in=['atadva', 'torolve', 'visszavonva'], archived=False)),
+            ('break slot view',
+             Rendeles.objects.filter(
+                 archived=False,
+                 idozitve__gte=slot_start,
+                 idozitve__lt=slot_start + timedelta(minutes=15)
+             )),
+        ]
+
+    def run_queries(self, student_id, repeat):
+        for name, queryset in self.get_queries(student_id):
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                list(queryset.values_list('id', flat=True))
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+
+            self.stdout.write(self.style.MIGRATE_HEADING(f'\n{name}'))
+            self.stdout.write(f'  plan: {queryset.explain()}')
+            self.stdout.write(
+                f'  median {statistics.median(timings):.2f} ms, '
+                f'p95 {timings[int(len(timings) * 0.95) - 1]:.2f} ms'
+            )
+
+    def drop_indexes(self):
+        with connection.cursor() as cursor:
+            for index in Rendeles._meta.indexes:
+                cursor.execute(f'DROP INDEX {connection.ops.quote_name(index.name)}')
@@ -0,0 +1,313 @@
+import asyncio
+import base64
+import http.client
+import json
+import os
+import secrets
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.urls import reverse
+
+from bufe.models import Bufe, Kategoria, Termek, Rendeles
+from .runworkers import IN_MEMORY_LAYER
+
+
+class Command(BaseCommand):
+    help = (
+        'Start 1, 2, 4 and 8 daphne workers with runworkers and measure order throughput '
+        'through create_order and the delivery of the resulting broadcasts to connected '
+        'admin dashboards. More than one worker needs REDIS_URL. Uses the configured '
+        'database; the benchmark users, products and orders are deleted afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            default='1,2,4,8',
+            help='Comma separated worker counts (default: 1,2,4,8)',
+        )
+        parser.add_argument(
+            '--orders',
+            type=int,
+            default=200,
+            help='Orders placed per round (default: 200)',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=16,
+            help='Students placing orders at the same time (default: 16)',
+        )
+        parser.add_argument(
+            '--dashboards',
+            type=int,
+            default=20,
+            help='Admin dashboards connected during a round (default: 20)',
+        )
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=8100,
+            help='Port the workers listen on (default: 8100)',
+        )
+
+    def handle(self, *args, **options):
+        shared = settings.CHANNEL_LAYERS['default']['BACKEND'] != IN_MEMORY_LAYER
+        fixture = self.create_fixture(options)
+        rows = []
+        try:
+            for workers in [int(count) for count in options['workers'].split(',')]:
+                if workers > 1 and not shared:
+                    self.stderr.write(f"Skipping {workers} workers: set REDIS_URL for a shared channel layer.")
+                    continue
+                self.stdout.write(f"Running with {workers} worker(s)...")
+                rows.append((workers, self.run_round(workers, fixture, options)))
+        finally:
+            self.delete_fixture(fixture)
+
+        self.stdout.write(
+            f"\n{'workers':>7} {'orders/s':>9} {'post p50':>9} {'post p95':>9} "
+            f"{'delivered':>10} {'bcast p50':>10} {'bcast p95':>10}"
+        )
+        for workers, result in rows:
+            self.stdout.write(
+                f"{workers:>7} {result['throughput']:>9.1f} {result['post_p50']:>7.0f}ms {result['post_p95']:>7.0f}ms "
+                f"{result['delivered']:>10.1%} {result['broadcast_p50']:>8.0f}ms {result['broadcast_p95']:>8.0f}ms"
+            )
+
+    # Fixture
+
+    def create_fixture(self, options):
+        prefix = f'bench_{secrets.token_hex(3)}'
+        bufe = Bufe.objects.first()
+        created_bufe = bufe is None
+        if created_bufe:
+            bufe = Bufe.objects.create(nev='Benchmark büfé')
+        # The orders go to the first büfé, so it is opened for the run and closed again afterwards
+        was_closed = bufe.rendkivuli_zarva
+        Bufe.objects.filter(id=bufe.id).update(rendkivuli_zarva=False)
+
+        kategoria = Kategoria.objects.create(nev=f'{prefix} kategória', bufe=bufe)
+        termek = Termek.objects.create(nev=f'{prefix} szendvics', kategoria=kategoria, ar=450, max_rendelesenkent=5)
+        students = [
+            User.objects.create_user(username=f'{prefix}_diak_{i}', email=f'{prefix}_diak_{i}@szlgbp.hu')
+            for i in range(options['concurrency'])
+        ]
+        admin = User.objects.create_user(username=f'{prefix}_admin', email=f'{prefix}_admin@szlgbp.hu')
+        bufe.bufeadmin.add(admin)
+
+        return {
+            'bufe': bufe,
+            'created_bufe': created_bufe,
+            'was_closed': was_closed,
+            'kategoria': kategoria,
+            'termek': termek,
+            'users': students + [admin],
+            'student_cookies': [self.session_cookie(student) for student in students],
+            'admin_cookie': self.session_cookie(admin),
+        }
+
+    def session_cookie(self, user):
+        """Session and CSRF cookies for raw HTTP and WebSocket requests"""
+        client = Client()
+        client.force_login(user)
+        csrf_token = secrets.token_hex(16)  # An unmasked 32 character secret is accepted as the token
+        session = client.cookies[settings.SESSION_COOKIE_NAME].value
+        return {
+            'header': f'{settings.SESSION_COOKIE_NAME}={session}; {settings.CSRF_COOKIE_NAME}={csrf_token}',
+            'csrf': csrf_token,
+        }
+
+    def delete_fixture(self, fixture):
+        Rendeles.objects.filter(user__in=fixture['users']).delete()
+        fixture['termek'].delete()
+        fixture['kategoria'].delete()
+        for user in fixture['users']:
+            user.delete()
+        if fixture['created_bufe']:
+            fixture['bufe'].delete()
+        elif fixture['was_closed']:
+            Bufe.objects.filter(id=fixture['bufe'].id).update(rendkivuli_zarva=True)
+
+    # One round
+
+    def run_round(self, workers, fixture, options):
+        port = options['port']
+        launcher = subprocess.Popen([
+            sys.executable, 'manage.py', 'runworkers', '--workers', str(workers), '--port', str(port)
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            self.wait_for_port(port)
+            return asyncio.run(self.measure(port, fixture, options))
+        finally:
+            launcher.terminate()
+            launcher.wait(timeout=20)
+
+    def wait_for_port(self, port, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError(f"Workers did not start listening on port {port}")
+
+    async def measure(self, port, fixture, options):
+        received = [{} for i in range(options['dashboards'])]
+        dashboards = [
+            await self.connect_dashboard(port, fixture['admin_cookie'], received[i])
+            for i in range(options['dashboards'])
+        ]
+        # Let the dashboards join their group on every worker
+        await asyncio.sleep(1)
+
+        loop = asyncio.get_running_loop()
+        placed = {}
+        post_latencies = []
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            start = time.monotonic()
+            results = await asyncio.gather(*[
+                loop.run_in_executor(
+                    executor, self.place_order, port, fixture,
+                    fixture['student_cookies'][i % options['concurrency']]
+                )
+                for i in range(options['orders'])
+            ])
+            elapsed = time.monotonic() - start
+        for order_id, sent, latency in results:
+            post_latencies.append(latency)
+            if order_id:
+                placed[order_id] = sent
+
+        # Wait for the broadcasts still in flight
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and any(len(seen) < len(placed) for seen in received):
+            await asyncio.sleep(0.1)
+        for dashboard in dashboards:
+            dashboard.cancel()
+
+        delays = [
+            (seen[order_id] - sent) * 1000
+            for seen in received
+            for order_id, sent in placed.items()
+            if order_id in seen
+        ]
+        expected = len(placed) * len(received)
+        return {
+            'throughput': len(placed) / elapsed,
+            'post_p50': self.percentile(post_latencies, 50),
+            'post_p95': self.percentile(post_latencies, 95),
+            'delivered': len(delays) / expected if expected else 0,
+            'broadcast_p50': self.percentile(delays, 50),
+            'broadcast_p95': self.percentile(delays, 95),
+        }
+
+    def place_order(self, port, fixture, cookie):
+        """POST one order the way the form does; returns (order id, start, latency in ms)"""
+        body = urlencode({
+            'csrfmiddlewaretoken': cookie['csrf'],
+            'idozitve': (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%dT%H:%M'),
+            'megjegyzes': '',
+            f"quantity_{fixture['termek'].id}": '1',
+        })
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        start = time.monotonic()
+        connection.request('POST', reverse('bufe:create_order'), body=body, headers={
+            'Cookie': cookie['header'],
+            'Content-Type': 'application/x-www-form-urlencoded',
+        })
+        response = connection.getresponse()
+        response.read()
+        latency = (time.monotonic() - start) * 1000
+        connection.close()
+
+        # A placed order redirects to its detail page: /bufe/rendeles/<id>/
+        location = response.getheader('Location', '')
+        parts = [part for part in location.split('/') if part]
+        order_id = int(parts[-1]) if response.status == 302 and parts and parts[-1].isdigit() else None
+        return order_id, start, latency
+
+    async def connect_dashboard(self, port, cookie, seen):
+        """
+        An admin dashboard recording when each new order arrived. A minimal
+        WebSocket client: daphne already runs autobahn on twisted in this process.
+        """
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write((
+            f"GET /ws/bufe/orders/ HTTP/1.1\r\n"
+            f"Host: 127.0.0.1:{port}\r\n"
+            f"Upgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {base64.b64encode(os.urandom(16)).decode()}\r\n"
+            f"Sec-WebSocket-Version: 13\r\n"
+            f"Cookie: {cookie['header']}\r\n\r\n"
+        ).encode())
+        status = await reader.readuntil(b'\r\n\r\n')
+        if not status.startswith(b'HTTP/1.1 101'):
+            raise RuntimeError(f"Dashboard connection refused: {status.splitlines()[0].decode()}")
+
+        async def listen():
+            try:
+                while True:
+                    text = await self.read_frame(reader, writer)
+                    if text is None:
+                        continue
+                    if text == 'ping':
+                        writer.write(self.text_frame('pong'))
+                        continue
+                    now = time.monotonic()
+                    data = json.loads(text)
+                    for event in data.get('events', []) if data.get('type') == 'batch' else []:
+                        if event.get('type') == 'order_update' and event.get('action') == 'new':
+                            seen.setdefault(event['order']['id'], now)
+            finally:
+                writer.close()
+
+        return asyncio.create_task(listen())
+
+    @staticmethod
+    async def read_frame(reader, writer):
+        """Next text frame from the server (unmasked, unfragmented); None for control frames"""
+        first, second = await reader.readexactly(2)
+        opcode, length = first & 0x0f, second & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', await reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', await reader.readexactly(8))[0]
+        payload = await reader.readexactly(length)
+        if opcode == 0x8:
+            raise ConnectionError("Closed by the server")
+        if opcode == 0x9:
+            writer.write(bytes([0x8a, 0x80 | len(payload)]) + Command.mask(payload))
+            return None
+        return payload.decode() if opcode == 0x1 else None
+
+    @staticmethod
+    def mask(payload, key=None):
+        key = key or os.urandom(4)
+        return key + bytes(byte ^ key[i % 4] for i, byte in enumerate(payload))
+
+    @classmethod
+    def text_frame(cls, text):
+        payload = text.encode()
+        return bytes([0x81, 0x80 | len(payload)]) + cls.mask(payload)
+
+    @staticmethod
+    def percentile(values, percent):
+        if not values:
+            return 0
+        if len(values) == 1:
+            return values[0]
+        return statistics.quantiles(values, n=100)[percent - 1]
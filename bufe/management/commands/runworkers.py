@@ -0,0 +1,99 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+IN_MEMORY_LAYER = 'channels.layers.InMemoryChannelLayer'
+
+
+class Command(BaseCommand):
+    help = (
+        'Run several daphne worker processes behind one port. The port is bound once '
+        'here and every worker accepts connections from the same socket. More than one '
+        'worker needs a shared channel layer and cache (set REDIS_URL).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Number of daphne processes (default: number of CPUs)',
+        )
+        parser.add_argument(
+            '--host',
+            default='127.0.0.1',
+            help='Address to listen on (default: 127.0.0.1)',
+        )
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=8000,
+            help='Port to listen on (default: 8000)',
+        )
+        parser.add_argument(
+            '--application',
+            default='nodews_project.asgi:application',
+            help='ASGI application (default: nodews_project.asgi:application)',
+        )
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        if workers < 1:
+            raise CommandError("--workers must be at least 1.")
+        if workers > 1 and settings.CHANNEL_LAYERS['default']['BACKEND'] == IN_MEMORY_LAYER:
+            raise CommandError(
+                "The in-memory channel layer only reaches sockets in its own process; "
+                "set REDIS_URL to run more than one worker."
+            )
+        if os.name != 'posix':
+            raise CommandError("Sharing the listening socket needs a POSIX system; run daphne directly.")
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((options['host'], options['port']))
+        listener.listen(1024)
+        listener.set_inheritable(True)
+
+        processes = [self.start_worker(listener, options['application']) for i in range(workers)]
+        self.stdout.write(self.style.SUCCESS(
+            f"{workers} daphne worker(s) listening on http://{options['host']}:{options['port']}/ "
+            f"(pids {', '.join(str(process.pid) for process in processes)})"
+        ))
+
+        def stop(signum, frame):
+            raise KeyboardInterrupt
+
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            # A worker that dies takes the others down too, so a supervisor can restart the set
+            while all(process.poll() is None for process in processes):
+                time.sleep(0.5)
+            self.stderr.write("A worker exited, stopping the others.")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop_workers(processes)
+            listener.close()
+
+    def start_worker(self, listener, application):
+        return subprocess.Popen(
+            [sys.executable, '-m', 'daphne', '--fd', str(listener.fileno()), application],
+            pass_fds=[listener.fileno()],
+        )
+
+    def stop_workers(self, processes):
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
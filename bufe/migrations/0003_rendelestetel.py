@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:29
+
+import django.core.validators
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_tetelek(apps, schema_editor):
+    """Create order lines from the JSON items of existing orders, using current prices"""
+    Rendeles = apps.get_model('bufe', 'Rendeles')
+    RendelesTetel = apps.get_model('bufe', 'RendelesTetel')
+    Termek = apps.get_model('bufe', 'Termek')
+    
+    termekek = Termek.objects.in_bulk()
+    tetelek = []
+    for rendeles in Rendeles.objects.only('id', 'items').iterator():
+        for item in rendeles.items or []:
+            termek = termekek.get(item.get('termek_id'))
+            tetelek.append(RendelesTetel(
+                rendeles_id=rendeles.id,
+                termek=termek,
+                termek_nev=termek.nev if termek else 'Ismeretlen termék',
+                mennyiseg=item.get('db', 1),
+                egysegar=termek.ar if termek else 0
+            ))
+    RendelesTetel.objects.bulk_create(tetelek, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bufe', '0002_bufe_bufeadmin'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RendelesTetel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('termek_nev', models.CharField(max_length=200, verbose_name='Termék neve')),
+                ('mennyiseg', models.IntegerField(validators=[django.core.validators.MinValueValidator(1)], verbose_name='Mennyiség')),
+                ('egysegar', models.IntegerField(validators=[django.core.validators.MinValueValidator(0)], verbose_name='Egységár (Ft)')),
+                ('rendeles', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tetelek', to='bufe.rendeles', verbose_name='Rendelés')),
+                ('termek', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='rendeles_tetelek', to='bufe.termek', verbose_name='Termék')),
+            ],
+            options={
+                'verbose_name': 'Rendelés tétel',
+                'verbose_name_plural': 'Rendelés tételek',
+                'ordering': ['id'],
+            },
+        ),
+        migrations.RunPython(backfill_tetelek, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bufe', '0003_rendelestetel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rendeles',
+            name='idempotency_key',
+            field=models.CharField(blank=True, editable=False, help_text='A rendelési űrlappal kiadott egyszer használatos kulcs, az ismételt beküldések kiszűrésére', max_length=64, null=True, unique=True, verbose_name='Idempotencia kulcs'),
+        ),
+    ]
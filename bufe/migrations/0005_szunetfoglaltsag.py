@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:34
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bufe', '0004_rendeles_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SzunetFoglaltsag',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('datum', models.DateField(verbose_name='Dátum')),
+                ('szunet', models.CharField(choices=[('09:10', '1. óra utáni szünet (9:10)'), ('10:05', '3. óra utáni szünet (10:05)'), ('11:05', '4. óra utáni szünet (11:05)'), ('12:00', '5. óra utáni szünet (12:00)'), ('13:05', '6. óra utáni szünet (13:05)'), ('14:10', '7. óra utáni szünet (14:10)')], max_length=5, verbose_name='Szünet')),
+                ('kapacitas', models.IntegerField(validators=[django.core.validators.MinValueValidator(0)], verbose_name='Kapacitás')),
+                ('foglalt', models.IntegerField(default=0, validators=[django.core.validators.MinValueValidator(0)], verbose_name='Foglalt')),
+            ],
+            options={
+                'verbose_name': 'Szünet foglaltság',
+                'verbose_name_plural': 'Szünet foglaltságok',
+                'ordering': ['datum', 'szunet'],
+                'constraints': [models.UniqueConstraint(fields=('datum', 'szunet'), name='unique_szunet_per_nap')],
+            },
+        ),
+    ]
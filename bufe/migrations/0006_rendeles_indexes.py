@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:37
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bufe', '0005_szunetfoglaltsag'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='rendeles',
+            index=models.Index(fields=['archived', '-leadva'], name='rendeles_archived_leadva_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rendeles',
+            index=models.Index(fields=['user', 'archived', '-leadva'], name='rendeles_user_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rendeles',
+            index=models.Index(fields=['archived', 'allapot'], name='rendeles_archived_allapot_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rendeles',
+            index=models.Index(fields=['archived', 'idozitve'], name='rendeles_archived_idozit_idx'),
+        ),
+    ]
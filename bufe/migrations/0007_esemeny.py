@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bufe', '0006_rendeles_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Esemeny',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tipus', models.CharField(choices=[('order_update', 'Rendelés frissítés'), ('orders_update', 'Több rendelés frissítése'), ('product_update', 'Termék frissítés')], max_length=20, verbose_name='Típus')),
+                ('adat', models.JSONField(verbose_name='Esemény adatai')),
+                ('letrehozva', models.DateTimeField(auto_now_add=True, verbose_name='Létrehozva')),
+                ('kikuldve', models.DateTimeField(blank=True, null=True, verbose_name='Kiküldve')),
+                ('seq', models.PositiveBigIntegerField(blank=True, null=True, unique=True, verbose_name='Sorszám')),
+            ],
+            options={
+                'verbose_name': 'Esemény',
+                'verbose_name_plural': 'Események',
+                'ordering': ['id'],
+                'indexes': [models.Index(condition=models.Q(('kikuldve__isnull', True)), fields=['id'], name='esemeny_kikuldetlen_idx')],
+            },
+        ),
+    ]
@@ -1,4 +1,8 @@
-from django.db import models
+from collections import Counter
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.utils import timezone
@@ -12,6 +16,17 @@ def get_full_name(self):
 
 User.get_full_name = get_full_name
 
+# Pickup breaks students can choose from when ordering
+SZUNET_CHOICES = [
+    ('09:10', '1. óra utáni szünet (9:10)'),
+    ('10:05', '3. óra utáni szünet (10:05)'),
+    ('11:05', '4. óra utáni szünet (11:05)'),
+    ('12:00', '5. óra utáni szünet (12:00)'),
+    ('13:05', '6. óra utáni szünet (13:05)'),
+    ('14:10', '7. óra utáni szünet (14:10)'),
+]
+
+
 class Bufe(models.Model):
     """
     Búfé - Uniobject model
@@ -156,6 +171,84 @@ class Termek(models.Model):
         return f"{self.nev} - {self.ar} Ft"
 
 
+class StaleTransition(Exception):
+    """Orders read for a transition were changed by another writer before the UPDATE"""
+
+
+class RendelesQuerySet(models.QuerySet):
+    
+    # Reads of a transition that are retried before giving up on a busy order
+    TRANSITION_ATTEMPTS = 3
+    
+    def transition(self, uj_allapot, elvart=None):
+        """
+        Move the selected orders to a new state with conditional UPDATEs.
+        Only rows whose current state allows the transition - and equals
+        ``elvart`` when given - are changed, so concurrent changes can't be
+        overwritten. The pickup break places follow in the same transaction:
+        an order entering a cancelled state gives its place back, one leaving
+        it takes a place again.
+        
+        The rows are read first and then updated by one UPDATE per state read,
+        conditional on that state. select_for_update only locks the rows where
+        the database supports it (not SQLite), so the UPDATEs' row counts are
+        the actual guard: if another writer moved any of the rows in between,
+        everything is rolled back and read again, and the break places are
+        only ever adjusted for orders this call changed itself.
+        
+        Returns:
+            list: IDs of the orders actually updated
+        
+        Raises:
+            StaleTransition: The orders kept changing under every attempt
+        """
+        elozo_allapotok = Rendeles.get_previous_states(uj_allapot)
+        if elvart is not None:
+            elozo_allapotok &= {elvart}
+        if not elozo_allapotok:
+            return []
+        
+        for attempt in range(self.TRANSITION_ATTEMPTS):
+            try:
+                with transaction.atomic():
+                    return self._transition_once(uj_allapot, elozo_allapotok)
+            except StaleTransition:
+                continue
+        raise StaleTransition(f"Orders kept changing while moving them to '{uj_allapot}'")
+    
+    def _transition_once(self, uj_allapot, elozo_allapotok):
+        rows = list(
+            self.filter(allapot__in=elozo_allapotok)
+            .select_for_update()
+            .values_list('id', 'allapot', 'idozitve')
+        )
+        if not rows:
+            return []
+        
+        by_allapot = {}
+        for order_id, allapot, idozitve in rows:
+            by_allapot.setdefault(allapot, []).append(order_id)
+        for allapot, ids in by_allapot.items():
+            updated = Rendeles.objects.filter(id__in=ids, allapot=allapot).update(allapot=uj_allapot)
+            if updated != len(ids):
+                raise StaleTransition(allapot)
+        
+        cancelling = uj_allapot in Rendeles.CANCELLED_STATES
+        helyek = Counter(
+            (idozitve.date(), Rendeles.szunet_of(idozitve))
+            for order_id, allapot, idozitve in rows
+            if (allapot in Rendeles.CANCELLED_STATES) != cancelling and Rendeles.szunet_of(idozitve)
+        )
+        for (datum, szunet), count in helyek.items():
+            if cancelling:
+                SzunetFoglaltsag.release(datum, szunet, count)
+            else:
+                # An admin bringing an order back keeps it even in a full break
+                SzunetFoglaltsag.reserve(datum, szunet, count, force=True)
+        
+        return [row[0] for row in rows]
+
+
 class Rendeles(models.Model):
     """
     Order model
@@ -169,6 +262,18 @@ class Rendeles(models.Model):
         ('atadva', 'Rendelés átadva'),
     ]
     
+    # Allowed state transitions: current state -> reachable states
+    ALLOWED_TRANSITIONS = {
+        'leadva': {'visszaigasolva', 'torolve', 'visszavonva'},
+        'visszaigasolva': {'atadva', 'torolve'},
+        'atadva': {'visszaigasolva'},
+        'torolve': {'visszaigasolva'},
+        'visszavonva': {'visszaigasolva'},
+    }
+    
+    # States that don't hold a place in their pickup break
+    CANCELLED_STATES = {'torolve', 'visszavonva'}
+    
     # JSONField format: [{"termek_id": 1, "db": 2}, ...]
     items = models.JSONField(
         verbose_name="Tételek",
@@ -200,31 +305,333 @@ class Rendeles(models.Model):
         related_name='rendelesek',
         verbose_name="Felhasználó"
     )
+    idempotency_key = models.CharField(
+        max_length=64,
+        unique=True,
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Idempotencia kulcs",
+        help_text="A rendelési űrlappal kiadott egyszer használatos kulcs, az ismételt beküldések kiszűrésére"
+    )
+    
+    objects = RendelesQuerySet.as_manager()
     
     class Meta:
         verbose_name = "Rendelés"
         verbose_name_plural = "Rendelések"
         ordering = ['-leadva']
+        indexes = [
+            # Admin dashboard and api_get_orders: active orders, newest first
+            models.Index(fields=['archived', '-leadva'], name='rendeles_archived_leadva_idx'),
+            # index and my_orders: a student's active orders, newest first
+            models.Index(fields=['user', 'archived', '-leadva'], name='rendeles_user_active_idx'),
+            # api_archive_all_done: active orders in finished states
+            models.Index(fields=['archived', 'allapot'], name='rendeles_archived_allapot_idx'),
+            # Pickup break views: active orders scheduled for a time window
+            models.Index(fields=['archived', 'idozitve'], name='rendeles_archived_idozit_idx'),
+        ]
     
     def __str__(self):
         return f"Rendelés #{self.id} - {self.user.username} - {self.vegosszeg} Ft"
     
-    def calculate_total(self):
-        """Calculate total price from items"""
+    @classmethod
+    def get_previous_states(cls, uj_allapot):
+        """States from which an order may move to ``uj_allapot``"""
+        return {
+            allapot for allapot, kovetkezo in cls.ALLOWED_TRANSITIONS.items()
+            if uj_allapot in kovetkezo
+        }
+    
+    def can_transition(self, uj_allapot):
+        return uj_allapot in self.ALLOWED_TRANSITIONS.get(self.allapot, set())
+    
+    @staticmethod
+    def szunet_of(idozitve):
+        """The pickup break ('HH:MM') a scheduled time falls on, if any"""
+        if not idozitve:
+            return None
+        szunet = idozitve.strftime('%H:%M')
+        return szunet if szunet in dict(SZUNET_CHOICES) else None
+    
+    def get_szunet(self):
+        """Return the pickup break ('HH:MM') the order is scheduled for, if any"""
+        return self.szunet_of(self.idozitve)
+    
+    def reserve_szunet(self):
+        """Take a place in the order's pickup break; False if the break is full"""
+        szunet = self.get_szunet()
+        return not szunet or SzunetFoglaltsag.reserve(self.idozitve.date(), szunet)
+    
+    def release_szunet(self):
+        """Give back the order's place in its pickup break"""
+        szunet = self.get_szunet()
+        if szunet:
+            SzunetFoglaltsag.release(self.idozitve.date(), szunet)
+    
+    def get_termek_ids(self):
+        """Return the distinct product ids referenced by the order items"""
+        return {item['termek_id'] for item in self.items}
+    
+    def get_termekek(self):
+        """
+        Load every product referenced by the order with a single IN query.
+        Returns a {termek_id: Termek} map; missing products are left out.
+        """
+        return Termek.objects.in_bulk(self.get_termek_ids())
+    
+    def calculate_total(self, termekek=None):
+        """
+        Calculate total price from items.
+        An already loaded {termek_id: Termek} map can be passed in to avoid
+        querying the products again; otherwise they are fetched in one query.
+        """
+        if termekek is None:
+            termekek = self.get_termekek()
+        
         total = 0
         for item in self.items:
-            try:
-                termek = Termek.objects.get(id=item['termek_id'])
+            termek = termekek.get(item['termek_id'])
+            if termek:
                 total += termek.ar * item['db']
-            except Termek.DoesNotExist:
-                pass
         return total
     
-    def save(self, *args, **kwargs):
+    def build_tetelek(self, termekek=None):
+        """
+        Build (unsaved) normalized order lines from the JSON items,
+        snapshotting product name and unit price at order time.
+        """
+        if termekek is None:
+            termekek = self.get_termekek()
+        
+        tetelek = []
+        for item in self.items:
+            termek = termekek.get(item['termek_id'])
+            tetelek.append(RendelesTetel(
+                rendeles=self,
+                termek=termek,
+                termek_nev=termek.nev if termek else 'Ismeretlen termék',
+                mennyiseg=item['db'],
+                egysegar=termek.ar if termek else 0
+            ))
+        return tetelek
+    
+    def create_tetelek(self, termekek=None):
+        """Create and save the order lines"""
+        return RendelesTetel.objects.bulk_create(self.build_tetelek(termekek))
+    
+    def save(self, *args, termekek=None, **kwargs):
+        """
+        An already loaded {termek_id: Termek} map can be passed as ``termekek``
+        so pricing and order line creation don't query the products again.
+        """
+        creating = self._state.adding
+        if termekek is None and (creating or self.vegosszeg == 0):
+            termekek = self.get_termekek()
+        
         # Auto-calculate vegosszeg if not set
         if self.vegosszeg == 0:
-            self.vegosszeg = self.calculate_total()
+            self.vegosszeg = self.calculate_total(termekek)
         super().save(*args, **kwargs)
+        
+        # Snapshot the order lines when the order is first saved
+        if creating:
+            self.create_tetelek(termekek)
+
+
+class RendelesTetel(models.Model):
+    """
+    Order line model
+    Stores product, quantity and unit price as they were at order time
+    """
+    rendeles = models.ForeignKey(
+        Rendeles,
+        on_delete=models.CASCADE,
+        related_name='tetelek',
+        verbose_name="Rendelés"
+    )
+    termek = models.ForeignKey(
+        Termek,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='rendeles_tetelek',
+        verbose_name="Termék"
+    )
+    termek_nev = models.CharField(max_length=200, verbose_name="Termék neve")
+    mennyiseg = models.IntegerField(
+        validators=[MinValueValidator(1)],
+        verbose_name="Mennyiség"
+    )
+    egysegar = models.IntegerField(
+        validators=[MinValueValidator(0)],
+        verbose_name="Egységár (Ft)"
+    )
+    
+    class Meta:
+        verbose_name = "Rendelés tétel"
+        verbose_name_plural = "Rendelés tételek"
+        ordering = ['id']
+    
+    def __str__(self):
+        return f"{self.mennyiseg}x {self.termek_nev} - {self.osszeg} Ft"
+    
+    @property
+    def osszeg(self):
+        """Line total"""
+        return self.egysegar * self.mennyiseg
+
+
+class SzunetFoglaltsag(models.Model):
+    """
+    Pickup break capacity counter
+    One row per break per day; reservations are taken with a single
+    conditional UPDATE so concurrent orders can never overfill a break
+    """
+    datum = models.DateField(verbose_name="Dátum")
+    szunet = models.CharField(max_length=5, choices=SZUNET_CHOICES, verbose_name="Szünet")
+    kapacitas = models.IntegerField(
+        validators=[MinValueValidator(0)],
+        verbose_name="Kapacitás"
+    )
+    foglalt = models.IntegerField(
+        default=0,
+        validators=[MinValueValidator(0)],
+        verbose_name="Foglalt"
+    )
+    
+    class Meta:
+        verbose_name = "Szünet foglaltság"
+        verbose_name_plural = "Szünet foglaltságok"
+        ordering = ['datum', 'szunet']
+        constraints = [
+            models.UniqueConstraint(fields=['datum', 'szunet'], name='unique_szunet_per_nap'),
+        ]
+    
+    def __str__(self):
+        return f"{self.datum} {self.szunet}: {self.foglalt}/{self.kapacitas}"
+    
+    @property
+    def szabad(self):
+        return max(self.kapacitas - self.foglalt, 0)
+    
+    @staticmethod
+    def get_capacity(szunet):
+        """
+        Configured capacity of a break, 0 meaning unlimited.
+        BUFE_BREAK_SLOT_CAPACITIES overrides BUFE_BREAK_SLOT_CAPACITY per break.
+        """
+        capacities = getattr(settings, 'BUFE_BREAK_SLOT_CAPACITIES', {})
+        return capacities.get(szunet, getattr(settings, 'BUFE_BREAK_SLOT_CAPACITY', 0))
+    
+    @classmethod
+    def reserve(cls, datum, szunet, count=1, force=False):
+        """
+        Take places in a break.
+        
+        Args:
+            count (int): Number of places
+            force (bool): Count them even beyond the capacity
+        
+        Returns:
+            bool: True if the places were reserved (or the break is unlimited)
+        """
+        kapacitas = cls.get_capacity(szunet)
+        if not kapacitas:
+            return True
+        
+        slot = cls.objects.filter(datum=datum, szunet=szunet)
+        if not force:
+            slot = slot.filter(foglalt__lte=F('kapacitas') - count)
+        if slot.update(foglalt=F('foglalt') + count):
+            return True
+        
+        # First reservation of the day creates the counter row
+        cls.objects.get_or_create(
+            datum=datum,
+            szunet=szunet,
+            defaults={'kapacitas': kapacitas}
+        )
+        return bool(slot.update(foglalt=F('foglalt') + count))
+    
+    @classmethod
+    def release(cls, datum, szunet, count=1):
+        """Give back places in a break"""
+        cls.objects.filter(datum=datum, szunet=szunet, foglalt__gt=0).update(
+            foglalt=Greatest(F('foglalt') - count, 0)
+        )
+    
+    @classmethod
+    def fill_levels(cls, datumok):
+        """
+        Fill level of every break on the given dates with a single query.
+        
+        Args:
+            datumok (dict): {szunet: date} - the day each break is looked at
+        
+        Returns:
+            dict: {szunet: {'datum', 'kapacitas', 'foglalt', 'szabad'}}
+        """
+        rows = {
+            (row.datum, row.szunet): row
+            for row in cls.objects.filter(datum__in=set(datumok.values()))
+        }
+        levels = {}
+        for szunet, datum in datumok.items():
+            row = rows.get((datum, szunet))
+            kapacitas = row.kapacitas if row else cls.get_capacity(szunet)
+            foglalt = row.foglalt if row else 0
+            levels[szunet] = {
+                'datum': datum,
+                'kapacitas': kapacitas,
+                'foglalt': foglalt,
+                'szabad': max(kapacitas - foglalt, 0) if kapacitas else None,
+            }
+        return levels
+
+
+class Esemeny(models.Model):
+    """
+    Outbox of WebSocket events
+    Written in the same transaction as the change it describes and
+    published to the channel layer after commit. The relay numbers the
+    events when it publishes them, so the sequence number follows commit
+    order without gaps and the table also serves as the replay log for
+    reconnecting admin dashboards.
+    """
+    EVENT_TYPES = [
+        ('order_update', 'Rendelés frissítés'),
+        ('orders_update', 'Több rendelés frissítése'),
+        ('product_update', 'Termék frissítés'),
+    ]
+    
+    tipus = models.CharField(max_length=20, choices=EVENT_TYPES, verbose_name="Típus")
+    adat = models.JSONField(verbose_name="Esemény adatai")
+    letrehozva = models.DateTimeField(auto_now_add=True, verbose_name="Létrehozva")
+    kikuldve = models.DateTimeField(null=True, blank=True, verbose_name="Kiküldve")
+    # Assigned by the relay; None until the event is about to be published
+    seq = models.PositiveBigIntegerField(null=True, blank=True, unique=True, verbose_name="Sorszám")
+    
+    class Meta:
+        verbose_name = "Esemény"
+        verbose_name_plural = "Események"
+        ordering = ['id']
+        indexes = [
+            # Only the few rows still waiting for the relay are indexed
+            models.Index(
+                fields=['id'],
+                name='esemeny_kikuldetlen_idx',
+                condition=Q(kikuldve__isnull=True)
+            ),
+        ]
+    
+    def __str__(self):
+        return f"#{self.id} {self.tipus}"
+    
+    def to_message(self):
+        """Channel layer / WebSocket message of the event"""
+        return {**self.adat, 'seq': self.seq}
+
 
 # Chatfunkció - később lesz implementálva
 # class Chatszoba(models.Model):
@@ -0,0 +1,192 @@
+"""
+Order placement shared by the create_order form and the student WebSocket.
+
+Both paths hand place_order the same form data (quantity_<termek_id> fields,
+szunet_valasztas, idozitve, megjegyzes, idempotency_key), so an order is
+checked by CartValidator and RendelesForm, takes its place in the pickup break
+and is written exactly the same way whichever way it arrived. The WebSocket
+consumer calls aplace_order, which can hand the write to the ingest writer
+(see ingest.py).
+"""
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction, IntegrityError
+
+from .forms import RendelesForm, CartValidator
+from .ingest import order_ingest_queue
+from .models import Rendeles
+from .serializers import serialize_order
+from .utils import (
+    broadcast_order_update, forget_idempotent_order, get_idempotent_order_id, remember_idempotent_order
+)
+
+
+class OrderRejected(Exception):
+    """
+    The order was not placed. Carries the messages to show the student and,
+    when the form itself was invalid, the bound form with its field errors.
+    """
+
+    def __init__(self, errors, form=None):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+        self.form = form
+
+
+def closed_reason(bufe):
+    """Why no orders are taken at the moment, or None"""
+    if not bufe:
+        return "A büfé jelenleg nem elérhető."
+    if bufe.rendkivuli_zarva:
+        return "A büfé rendkívüli okok miatt zárva tart. Kérjük, próbálja később."
+    return None
+
+
+def find_original_order(user, idempotency_key):
+    """
+    The order this user already placed with the given form key, or None.
+    The cache answers most retries; on a miss the key is looked up in the
+    database, so a retry is never validated and booked into its break again.
+    """
+    if not idempotency_key:
+        return None
+    original_id = get_idempotent_order_id(user, idempotency_key)
+    if original_id:
+        try:
+            return Rendeles.objects.get(id=original_id)
+        except Rendeles.DoesNotExist:
+            # Deleted since (archive cleanup, admin)
+            forget_idempotent_order(user, idempotency_key)
+
+    original = Rendeles.objects.filter(user=user, idempotency_key=idempotency_key).first()
+    if original:
+        remember_idempotent_order(user, idempotency_key, original.id)
+    return original
+
+
+def prepare_order(user, data):
+    """
+    Validate an order and take its place in the chosen pickup break.
+
+    Args:
+        user: Django User object placing the order
+        data: Form data (a QueryDict or a plain dict of strings)
+
+    Returns:
+        tuple: (rendeles, termekek). For an idempotency key this user already
+        placed an order with, rendeles is that order and termekek is None.
+        Otherwise rendeles is unsaved and termekek is the {termek_id: Termek}
+        map to save it with.
+
+    Raises:
+        OrderRejected: The cart or the form is invalid or the break is full
+    """
+    # A retried submission of an already placed order returns the original
+    original = find_original_order(user, data.get('idempotency_key') or None)
+    if original:
+        return original, None
+
+    # Validate every cart line against a single bulk product lookup
+    cart = CartValidator(data)
+    if not cart.is_valid():
+        raise OrderRejected(cart.errors)
+
+    form = RendelesForm(data)
+    if not form.is_valid():
+        raise OrderRejected(
+            [error for errors in form.errors.values() for error in errors],
+            form=form
+        )
+
+    rendeles = form.save(commit=False)
+    rendeles.user = user
+    rendeles.items = cart.cart_items
+    rendeles.idempotency_key = form.cleaned_data.get('idempotency_key') or None
+
+    # Atomically take a place in the chosen break
+    if not rendeles.reserve_szunet():
+        raise OrderRejected(["A választott szünet betelt, kérjük válasszon másik időpontot."])
+    return rendeles, cart.termekek
+
+
+def write_failed(user, rendeles, error):
+    """
+    Give back the break place of an order that was not written.
+
+    Returns:
+        tuple: (original, False) when a concurrent retry won the race on the
+        unique idempotency key
+
+    Raises:
+        OrderRejected: In every other case
+    """
+    rendeles.release_szunet()
+    if isinstance(error, IntegrityError):
+        original = Rendeles.objects.filter(user=user, idempotency_key=rendeles.idempotency_key).first()
+        if original:
+            remember_idempotent_order(user, rendeles.idempotency_key, original.id)
+            return original, False
+        raise OrderRejected(["Hiba történt a rendelés leadása során. Kérjük, próbálja újra."])
+    raise OrderRejected([f"Hiba történt a rendelés leadása során: {str(error)}"])
+
+
+def order_placed(user, rendeles):
+    """Remember the order under its idempotency key, for retries"""
+    remember_idempotent_order(user, rendeles.idempotency_key, rendeles.id)
+    return rendeles, True
+
+
+def place_order(user, data):
+    """
+    Validate and create an order.
+
+    Args:
+        user: Django User object placing the order
+        data: Form data (a QueryDict or a plain dict of strings)
+
+    Returns:
+        tuple: (Rendeles, created). created is False when the idempotency key
+        belongs to an order this user already placed; that order is returned.
+
+    Raises:
+        OrderRejected: The cart or the form is invalid, the break is full or
+        the order could not be saved
+    """
+    rendeles, termekek = prepare_order(user, data)
+    if termekek is None:
+        return rendeles, False
+
+    try:
+        with transaction.atomic():
+            rendeles.vegosszeg = 0  # Will be calculated in save()
+            rendeles.save(termekek=termekek)
+            # Broadcast new order to bufeadmin WebSocket clients once committed
+            broadcast_order_update(serialize_order(rendeles), action='new')
+    except Exception as e:
+        return write_failed(user, rendeles, e)
+    return order_placed(user, rendeles)
+
+
+async def aplace_order(user, data):
+    """
+    place_order for async callers. With BUFE_BATCHED_ORDER_INGEST the order is
+    validated on the sync thread and then written by the ingest writer; the
+    caller awaits it without holding the sync thread, so orders from other
+    connections are validated and join the same batch meanwhile.
+
+    Returns and raises like place_order.
+    """
+    if not settings.BUFE_BATCHED_ORDER_INGEST:
+        return await database_sync_to_async(place_order)(user, data)
+
+    rendeles, termekek = await database_sync_to_async(prepare_order)(user, data)
+    if termekek is None:
+        return rendeles, False
+
+    try:
+        # Coalesced with concurrent orders into one bulk write
+        await order_ingest_queue.submit(rendeles, termekek)
+    except Exception as e:
+        # Raised only once the order is certain not to have been written
+        return await database_sync_to_async(write_failed)(user, rendeles, e)
+    return await database_sync_to_async(order_placed)(user, rendeles)
@@ -6,4 +6,6 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/bufe/orders/$', consumers.OrderConsumer.as_asgi()),
+    re_path(r'ws/bufe/my-orders/$', consumers.StudentOrderConsumer.as_asgi()),
+    re_path(r'ws/bufe/catalog/$', consumers.CatalogConsumer.as_asgi()),
 ]
@@ -0,0 +1,156 @@
+"""
+Serialization helpers for orders and products sent over the JSON API and WebSocket.
+"""
+import json
+
+from django.db.models import QuerySet, prefetch_related_objects
+
+
+def serialize_order(rendeles):
+    """
+    Helper function to serialize order data for JSON responses.
+    Item names and prices come from the order line snapshots, so current
+    product data is never consulted.
+    
+    Args:
+        rendeles: Rendeles object, ideally with 'tetelek' prefetched
+    """
+    order_items = [{
+        'termek_id': tetel.termek_id,
+        'termek_nev': tetel.termek_nev,
+        'termek_ar': tetel.egysegar,
+        'mennyiseg': tetel.mennyiseg,
+        'osszeg': tetel.osszeg
+    } for tetel in rendeles.tetelek.all()]
+    
+    return {
+        'id': rendeles.id,
+        'user': {
+            'id': rendeles.user.id,
+            'username': rendeles.user.username,
+            'full_name': f"{rendeles.user.last_name} {rendeles.user.first_name}".strip() or rendeles.user.username,
+            'email': rendeles.user.email
+        },
+        'items': order_items,
+        'allapot': rendeles.allapot,
+        'allapot_display': rendeles.get_allapot_display(),
+        'leadva': rendeles.leadva.strftime('%Y-%m-%d %H:%M:%S'),
+        'idozitve': rendeles.idozitve.strftime('%Y-%m-%d %H:%M:%S') if rendeles.idozitve else None,
+        'megjegyzes': rendeles.megjegyzes,
+        'vegosszeg': rendeles.vegosszeg,
+        'archived': rendeles.archived
+    }
+
+
+def serialize_orders(orders):
+    """
+    Serialize many orders in a constant number of queries.
+    
+    Args:
+        orders: Rendeles queryset (users are joined with select_related and
+            order lines prefetched) or an already evaluated list of orders.
+    
+    Returns:
+        list: Serialized orders in the same order as the input
+    """
+    if isinstance(orders, QuerySet):
+        orders = list(orders.select_related('user').prefetch_related('tetelek'))
+    else:
+        prefetch_related_objects(orders, 'tetelek')
+    
+    return [serialize_order(rendeles) for rendeles in orders]
+
+
+def serialize_product(termek):
+    """
+    Product data sent to the admin pages over the WebSocket.
+    
+    Args:
+        termek: Termek object, ideally with 'kategoria' already loaded
+    """
+    return {
+        'id': termek.id,
+        'nev': termek.nev,
+        'kategoria_id': termek.kategoria.id,
+        'kategoria_nev': termek.kategoria.nev,
+        'ar': termek.ar,
+        'max_rendelesenkent': termek.max_rendelesenkent,
+        'hutve': termek.hutve,
+        'elerheto': termek.elerheto,
+        'kisult': termek.kisult
+    }
+
+
+# The only product fields the ordering page updates live
+CATALOG_FIELDS = ['id', 'ar', 'elerheto', 'kisult', 'max_rendelesenkent']
+
+
+def compact_product(product_data):
+    """Availability and price of a serialized product, for the catalog channel"""
+    return {field: product_data[field] for field in CATALOG_FIELDS}
+
+
+# Compact framing for the admin WebSocket, negotiated as a subprotocol.
+# Plain JSON stays the default for clients that do not ask for it.
+COMPACT_SUBPROTOCOL = 'bufe.compact.v1'
+
+# Full key -> short key. Clients get the reverse mapping as the first frame,
+# so keys can be added here without touching the JavaScript.
+COMPACT_KEYS = {
+    'type': 't',
+    'action': 'a',
+    'seq': 's',
+    'events': 'e',
+    'order': 'o',
+    'orders': 'os',
+    'product': 'p',
+    'id': 'i',
+    'user': 'u',
+    'username': 'un',
+    'full_name': 'fn',
+    'email': 'em',
+    'items': 'it',
+    'termek_id': 'ti',
+    'termek_nev': 'tn',
+    'termek_ar': 'ta',
+    'mennyiseg': 'm',
+    'osszeg': 'sz',
+    'allapot': 'al',
+    'allapot_display': 'ad',
+    'leadva': 'l',
+    'idozitve': 'iz',
+    'megjegyzes': 'mj',
+    'vegosszeg': 'v',
+    'archived': 'x',
+    'nev': 'n',
+    'kategoria_id': 'ki',
+    'kategoria_nev': 'kn',
+    'ar': 'r',
+    'max_rendelesenkent': 'mx',
+    'hutve': 'h',
+    'elerheto': 'el',
+    'kisult': 'k',
+}
+
+
+def compact_keys(value):
+    """Replace the known keys of a frame with their short form, recursively"""
+    if isinstance(value, list):
+        return [compact_keys(item) for item in value]
+    if isinstance(value, dict):
+        return {COMPACT_KEYS.get(key, key): compact_keys(item) for key, item in value.items()}
+    return value
+
+
+def encode_frame(frame, compact=False):
+    """
+    Encode a WebSocket text frame.
+    
+    Args:
+        frame (dict): What the client receives
+        compact (bool): Short keys, no whitespace and raw UTF-8 accents,
+            for clients that negotiated COMPACT_SUBPROTOCOL
+    """
+    if compact:
+        return json.dumps(compact_keys(frame), separators=(',', ':'), ensure_ascii=False)
+    return json.dumps(frame)
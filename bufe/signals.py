@@ -0,0 +1,54 @@
+"""
+Signal handlers keeping the bufeadmin membership cache (utils.py) and the
+menu snapshot (catalog.py) fresh and recording product changes for the admin
+pages and the live catalog.
+"""
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .catalog import invalidate_menu
+from .models import Bufe, Kategoria, Termek
+from .serializers import serialize_product
+from .utils import broadcast_product_update, clear_bufeadmin_cache
+
+
+@receiver(m2m_changed, sender=Bufe.bufeadmin.through)
+def bufeadmin_changed(sender, action, **kwargs):
+    """Admins added to or removed from a büfé, from either side of the relation"""
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        clear_bufeadmin_cache()
+
+
+@receiver(post_save, sender=Bufe)
+@receiver(post_delete, sender=Bufe)
+def bufe_changed(sender, **kwargs):
+    """Membership is checked against the first büfé, which may have changed"""
+    clear_bufeadmin_cache()
+    transaction.on_commit(invalidate_menu)
+
+
+@receiver(post_save, sender=Termek)
+def termek_saved(sender, instance, created, **kwargs):
+    """
+    Every product save - API, admin WebSocket or Django admin - goes to the
+    outbox in the saving transaction.
+    """
+    broadcast_product_update(serialize_product(instance), action='add' if created else 'update')
+    transaction.on_commit(invalidate_menu)
+
+
+@receiver(post_delete, sender=Termek)
+def termek_deleted(sender, instance, **kwargs):
+    broadcast_product_update({'id': instance.id}, action='delete')
+    transaction.on_commit(invalidate_menu)
+
+
+@receiver(post_save, sender=Kategoria)
+@receiver(post_delete, sender=Kategoria)
+def kategoria_changed(sender, **kwargs):
+    """
+    The menu is rebuilt only after the change has committed; a snapshot
+    read before that would otherwise be kept as the new one.
+    """
+    transaction.on_commit(invalidate_menu)
@@ -1,3 +1,1354 @@
-from django.test import TestCase
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, patch
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, transaction, IntegrityError, OperationalError
+from django.core.cache import cache
+from django.contrib.auth.models import AnonymousUser, User
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Bufe, Kategoria, Termek, Rendeles, RendelesTetel, SzunetFoglaltsag, Esemeny
+from . import events
+from .forms import CartValidator, RendelesForm
+from .ingest import OrderIngestQueue, write_batch
+from .ordering import OrderRejected, aplace_order
+from .events import (
+    CATALOG_GROUP, catalog_version, events_since, order_events_message, publish_pending, record_event,
+    student_group_name, text_message
+)
+from .catalog import _snapshots, get_menu
+from .consumers import CatalogConsumer, OrderConsumer, StudentOrderConsumer
+from .serializers import COMPACT_KEYS, COMPACT_SUBPROTOCOL, encode_frame, serialize_order, serialize_orders
+from .utils import BroadcastSender, broadcast_sender, connection_tracker, is_bufeadmin, clear_bufeadmin_cache
+
+
+class BufeTestMixin:
+    """Shared fixture: one buffet, one category and a handful of products"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='diak',
+            email='diak@szlgbp.hu',
+            password='jelszo12345',
+            first_name='Elek',
+            last_name='Teszt'
+        )
+        cls.bufe = Bufe.objects.create(nev="Iskolai Büfé")
+        cls.kategoria = Kategoria.objects.create(nev="Szendvicsek", bufe=cls.bufe)
+        cls.termekek = [
+            Termek.objects.create(
+                nev=f"Termék {i}",
+                kategoria=cls.kategoria,
+                ar=100 * (i + 1),
+                max_rendelesenkent=5
+            )
+            for i in range(6)
+        ]
+        # Menu snapshots of earlier test classes may share IDs with this fixture
+        cache.clear()
+
+
+class CalculateTotalTests(BufeTestMixin, TestCase):
+
+    def make_order(self, lines):
+        return Rendeles(
+            user=self.user,
+            items=[{'termek_id': t.id, 'db': 2} for t in self.termekek[:lines]]
+        )
+
+    def test_total_uses_current_prices(self):
+        rendeles = self.make_order(3)
+        self.assertEqual(rendeles.calculate_total(), 2 * (100 + 200 + 300))
+
+    def test_missing_product_is_ignored(self):
+        rendeles = self.make_order(1)
+        rendeles.items.append({'termek_id': 999999, 'db': 3})
+        self.assertEqual(rendeles.calculate_total(), 200)
+
+    def test_query_count_is_independent_of_line_count(self):
+        for lines in (1, 6):
+            rendeles = self.make_order(lines)
+            with self.assertNumQueries(1):
+                rendeles.calculate_total()
+
+    def test_preloaded_products_need_no_query(self):
+        rendeles = self.make_order(6)
+        termekek = rendeles.get_termekek()
+        with self.assertNumQueries(0):
+            rendeles.calculate_total(termekek)
+
+
+class RendelesTetelTests(BufeTestMixin, TestCase):
+
+    def test_lines_are_created_with_price_snapshot(self):
+        termek = self.termekek[0]
+        rendeles = Rendeles.objects.create(
+            user=self.user,
+            items=[{'termek_id': termek.id, 'db': 3}]
+        )
+        termek.ar = 999
+        termek.save()
+
+        tetel = rendeles.tetelek.get()
+        self.assertEqual(tetel.termek_nev, termek.nev)
+        self.assertEqual(tetel.egysegar, 100)
+        self.assertEqual(tetel.osszeg, 300)
+        self.assertEqual(serialize_order(rendeles)['items'][0]['termek_ar'], 100)
+
+    def test_lines_survive_product_deletion(self):
+        termek = self.termekek[1]
+        rendeles = Rendeles.objects.create(
+            user=self.user,
+            items=[{'termek_id': termek.id, 'db': 1}]
+        )
+        termek.delete()
+
+        tetel = RendelesTetel.objects.get(rendeles=rendeles)
+        self.assertIsNone(tetel.termek)
+        self.assertEqual(tetel.termek_nev, 'Termék 1')
+
+
+class SerializeOrdersTests(BufeTestMixin, TestCase):
+
+    def create_orders(self, count):
+        for i in range(count):
+            Rendeles.objects.create(
+                user=self.user,
+                items=[{'termek_id': t.id, 'db': 1} for t in self.termekek[:i % 6 + 1]]
+            )
+
+    def test_matches_single_order_serializer(self):
+        self.create_orders(3)
+        rendelesek = Rendeles.objects.order_by('id')
+        self.assertEqual(
+            serialize_orders(rendelesek),
+            [serialize_order(rendeles) for rendeles in rendelesek]
+        )
+
+    def test_query_count_is_independent_of_order_count(self):
+        self.create_orders(20)
+        # One query for the orders joined with their users, one for the order lines
+        with self.assertNumQueries(2):
+            data = serialize_orders(Rendeles.objects.filter(archived=False))
+        self.assertEqual(len(data), 20)
+        self.assertEqual(data[0]['user']['full_name'], 'Teszt Elek')
+
+    def test_admin_dashboard_embeds_serialized_orders(self):
+        self.create_orders(2)
+        self.bufe.bufeadmin.add(self.user)
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('bufe:admin_dashboard'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['orders_data']), 2)
+        self.assertContains(response, 'id="initialOrders"')
+
+
+class CreateOrderTests(BufeTestMixin, TestCase):
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def post_order(self, quantities, **extra):
+        data = {
+            'idozitve': (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%dT%H:%M'),
+            'megjegyzes': '',
+            **extra
+        }
+        for termek, db in quantities:
+            data[f'quantity_{termek.id}'] = str(db)
+        return self.client.post(reverse('bufe:create_order'), data)
+
+    def test_order_is_created_from_cart(self):
+        response = self.post_order([(self.termekek[0], 2), (self.termekek[2], 1)])
+        rendeles = Rendeles.objects.get()
+        self.assertRedirects(response, reverse('bufe:order_detail', args=[rendeles.id]))
+        self.assertEqual(rendeles.vegosszeg, 2 * 100 + 300)
+        self.assertEqual(rendeles.tetelek.count(), 2)
+
+    def test_all_line_errors_are_reported_and_nothing_is_saved(self):
+        self.termekek[1].elerheto = False
+        self.termekek[1].save()
+        response = self.post_order([
+            (self.termekek[0], 1),
+            (self.termekek[1], 1),
+            (self.termekek[2], 6),
+        ])
+        self.assertRedirects(response, reverse('bufe:create_order'))
+        self.assertFalse(Rendeles.objects.exists())
+        errors = [str(m) for m in response.wsgi_request._messages]
+        self.assertEqual(len(errors), 2)
+
+    def test_query_count_is_independent_of_cart_size(self):
+        counts = []
+        for lines in (1, 6):
+            with CaptureQueriesContext(connection) as ctx:
+                self.post_order([(t, 1) for t in self.termekek[:lines]])
+            counts.append(len(ctx.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_resubmitted_form_returns_original_order(self):
+        key = RendelesForm().initial['idempotency_key']
+        first = self.post_order([(self.termekek[0], 1)], idempotency_key=key)
+        second = self.post_order([(self.termekek[0], 1)], idempotency_key=key)
+
+        rendeles = Rendeles.objects.get()
+        self.assertEqual(rendeles.idempotency_key, key)
+        self.assertEqual(first.url, second.url)
+
+    def test_retry_missing_from_cache_is_found_before_validation(self):
+        key = 'a' * 32
+        self.post_order([(self.termekek[0], 1)], idempotency_key=key)
+        cache.clear()
+        # The retry would no longer pass validation; it is answered with the original all the same
+        Termek.objects.filter(id=self.termekek[0].id).update(elerheto=False)
+        response = self.post_order([(self.termekek[0], 1)], idempotency_key=key)
+
+        rendeles = Rendeles.objects.get()
+        self.assertRedirects(response, reverse('bufe:order_detail', args=[rendeles.id]))
+
+    def test_retry_of_deleted_order_places_it_again(self):
+        key = 'c' * 32
+        self.post_order([(self.termekek[0], 1)], idempotency_key=key)
+        Rendeles.objects.all().delete()
+        response = self.post_order([(self.termekek[0], 1)], idempotency_key=key)
+
+        rendeles = Rendeles.objects.get()
+        self.assertRedirects(response, reverse('bufe:order_detail', args=[rendeles.id]))
+
+
+class CartValidatorTests(BufeTestMixin, TestCase):
+
+    def test_single_product_query(self):
+        data = {f'quantity_{t.id}': '1' for t in self.termekek}
+        cart = CartValidator(data)
+        with self.assertNumQueries(1):
+            self.assertTrue(cart.is_valid())
+        self.assertEqual(len(cart.cart_items), 6)
+
+    def test_empty_and_invalid_quantities(self):
+        self.assertFalse(CartValidator({}).is_valid())
+        cart = CartValidator({f'quantity_{self.termekek[0].id}': 'abc'})
+        self.assertFalse(cart.is_valid())
+        self.assertIn("Érvénytelen mennyiség a kosárban.", cart.errors)
+
+
+class OrderIngestTests(BufeTestMixin, TestCase):
+
+    def make_entries(self, count, **fields):
+        return [
+            (Rendeles(user=self.user, items=[{'termek_id': self.termekek[i % 6].id, 'db': 2}], **fields),
+             {t.id: t for t in self.termekek},
+             Future())
+            for i in range(count)
+        ]
+
+    def test_batch_is_written_with_constant_queries(self):
+        counts = []
+        for size in (1, 10):
+            entries = self.make_entries(size)
+            with CaptureQueriesContext(connection) as ctx:
+                write_batch(entries)
+            counts.append(len(ctx.captured_queries))
+            for rendeles, termekek, future in entries:
+                self.assertEqual(future.result(), rendeles)
+                self.assertIsNotNone(rendeles.id)
+                self.assertEqual(rendeles.tetelek.count(), 1)
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(Rendeles.objects.get(id=entries[1][0].id).vegosszeg, 400)
+
+    def test_conflicting_order_does_not_fail_the_batch(self):
+        Rendeles.objects.create(user=self.user, items=[], idempotency_key='ismetelt')
+        entries = self.make_entries(2)
+        entries[1][0].idempotency_key = 'ismetelt'
+        write_batch(entries)
+
+        self.assertIsNotNone(entries[0][2].result().id)
+        with self.assertRaises(IntegrityError):
+            entries[1][2].result()
+
+
+@override_settings(BUFE_BATCHED_ORDER_INGEST=True, BUFE_WS_ORDER_PLACEMENT=True)
+class OrderIngestQueueTests(BufeTestMixin, TransactionTestCase):
+
+    def setUp(self):
+        self.setUpTestData()
+
+    def order_data(self, szunet=''):
+        idozitve = RendelesForm.next_break_datetime(szunet) if szunet else datetime.now() + timedelta(days=1)
+        return {
+            'szunet_valasztas': szunet,
+            'idozitve': idozitve.strftime('%Y-%m-%dT%H:%M'),
+            f'quantity_{self.termekek[0].id}': '3',
+        }
+
+    def test_concurrent_socket_orders_share_a_batch(self):
+        async def run():
+            communicators = []
+            for i in range(3):
+                communicator = WebsocketCommunicator(StudentOrderConsumer.as_asgi(), '/ws/bufe/my-orders/')
+                communicator.scope['user'] = self.user
+                await communicator.connect()
+                communicators.append(communicator)
+            for i, communicator in enumerate(communicators):
+                await communicator.send_json_to({
+                    'type': 'place_order',
+                    'ref': i,
+                    'cart': {str(self.termekek[0].id): 3},
+                    'idozitve': (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%dT%H:%M'),
+                })
+            replies = [await communicator.receive_json_from(timeout=5) for communicator in communicators]
+            for communicator in communicators:
+                await communicator.disconnect()
+            return replies
+
+        ingest_queue = OrderIngestQueue(batch_window=0.2, max_batch=10, timeout=5)
+        with patch('bufe.ordering.order_ingest_queue', ingest_queue), \
+                patch('bufe.ingest.write_batch', wraps=write_batch) as batch:
+            replies = async_to_sync(run)()
+
+        self.assertEqual([reply['type'] for reply in replies], ['order_placed'] * 3)
+        batch.assert_called_once()
+        self.assertEqual(len(batch.call_args.args[0]), 3)
+        self.assertEqual(sorted(Rendeles.objects.values_list('vegosszeg', flat=True)), [300] * 3)
+
+    def test_form_post_is_written_directly(self):
+        self.client.force_login(self.user)
+        with patch('bufe.ordering.order_ingest_queue') as ingest_queue:
+            response = self.client.post(reverse('bufe:create_order'), self.order_data())
+        rendeles = Rendeles.objects.get()
+        self.assertRedirects(response, reverse('bufe:order_detail', args=[rendeles.id]))
+        self.assertEqual(rendeles.vegosszeg, 300)
+        ingest_queue.submit.assert_not_called()
+
+    @override_settings(BUFE_BREAK_SLOT_CAPACITY=2)
+    def test_timeout_gives_the_break_place_back(self):
+        # No writer takes the order: it is withdrawn and its place freed
+        ingest_queue = OrderIngestQueue(batch_window=0, max_batch=1, timeout=0.05)
+        with patch('bufe.ordering.order_ingest_queue', ingest_queue), \
+                patch.object(ingest_queue, '_ensure_writer'), self.assertRaises(OrderRejected):
+            async_to_sync(aplace_order)(self.user, self.order_data('10:05'))
+        datum = RendelesForm.next_break_datetime('10:05').date()
+        self.assertEqual(SzunetFoglaltsag.objects.get(datum=datum, szunet='10:05').foglalt, 0)
+        self.assertTrue(ingest_queue._queue.get_nowait()[2].cancelled())
+
+    def test_order_taken_by_the_writer_outlives_the_timeout(self):
+        ingest_queue = OrderIngestQueue(batch_window=0, max_batch=1, timeout=0.05)
+        rendeles = Rendeles(user=self.user, items=[])
+
+        async def run():
+            with patch.object(ingest_queue, '_ensure_writer'):
+                submit = asyncio.ensure_future(ingest_queue.submit(rendeles, {}))
+                await asyncio.sleep(0.01)
+            future = ingest_queue._queue.get_nowait()[2]
+            self.assertTrue(future.set_running_or_notify_cancel())
+            await asyncio.sleep(0.1)
+            self.assertFalse(submit.done())
+            future.set_result(rendeles)
+            return await submit
+
+        self.assertIs(async_to_sync(run)(), rendeles)
+
+
+@override_settings(BUFE_WS_ORDER_PLACEMENT=True)
+class OrderPlacementTests(BufeTestMixin, TransactionTestCase):
+    """Orders placed over the student WebSocket, answered from another thread"""
+
+    def setUp(self):
+        self.setUpTestData()
+
+    def place(self, cart, **extra):
+        async def run():
+            communicator = WebsocketCommunicator(StudentOrderConsumer.as_asgi(), '/ws/bufe/my-orders/')
+            communicator.scope['user'] = self.user
+            await communicator.connect()
+            await communicator.send_json_to({
+                'type': 'place_order',
+                'ref': 1,
+                'cart': {str(termek.id): db for termek, db in cart},
+                'idozitve': (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%dT%H:%M'),
+                **extra
+            })
+            reply = await communicator.receive_json_from(timeout=5)
+            await communicator.disconnect()
+            return reply
+
+        return async_to_sync(run)()
+
+    def test_order_is_placed_with_one_reply(self):
+        reply = self.place([(self.termekek[0], 2), (self.termekek[2], 1)], key='b' * 32)
+        rendeles = Rendeles.objects.get()
+        self.assertEqual(reply, {'type': 'order_placed', 'ref': 1, 'order_id': rendeles.id, 'vegosszeg': 500})
+        self.assertEqual(rendeles.tetelek.count(), 2)
+
+        # A retry with the same key answers with the same order
+        self.assertEqual(self.place([(self.termekek[0], 2)], key='b' * 32)['order_id'], rendeles.id)
+        self.assertEqual(Rendeles.objects.count(), 1)
+
+    def test_order_follows_form_rules(self):
+        self.termekek[1].elerheto = False
+        self.termekek[1].save()
+        reply = self.place([(self.termekek[1], 1), (self.termekek[2], 6)])
+        self.assertEqual(reply['type'], 'order_rejected')
+        self.assertEqual(len(reply['errors']), 2)
+
+        reply = self.place(
+            [(self.termekek[0], 1)],
+            idozitve=(datetime.now() + timedelta(minutes=5)).strftime('%Y-%m-%dT%H:%M')
+        )
+        self.assertEqual(reply['errors'], ["Az időzítésnek legalább 10 perccel a rendelés leadása után kell lennie."])
+        self.assertFalse(Rendeles.objects.exists())
+
+    def test_unexpected_error_is_answered_and_keeps_the_connection(self):
+        async def run():
+            communicator = WebsocketCommunicator(StudentOrderConsumer.as_asgi(), '/ws/bufe/my-orders/')
+            communicator.scope['user'] = self.user
+            await communicator.connect()
+            with patch('bufe.consumers.aplace_order', side_effect=OperationalError('database is locked')):
+                await communicator.send_json_to({'type': 'place_order', 'ref': 7, 'cart': {}})
+                reply = await communicator.receive_json_from(timeout=5)
+            await communicator.send_json_to({'type': 'ping'})
+            pong = await communicator.receive_json_from(timeout=5)
+            await communicator.disconnect()
+            return reply, pong
+
+        reply, pong = async_to_sync(run)()
+        self.assertEqual(reply['type'], 'order_rejected')
+        self.assertEqual(reply['ref'], 7)
+        self.assertEqual(pong, {'type': 'pong'})
+
+    def test_socket_from_foreign_origin_is_refused(self):
+        from nodews_project.asgi import application
+
+        async def connects(path, origin):
+            communicator = WebsocketCommunicator(application, path, headers=[(b'origin', origin)])
+            connected, _ = await communicator.connect()
+            await communicator.disconnect()
+            return connected
+
+        self.assertFalse(async_to_sync(connects)('/ws/bufe/my-orders/', b'https://evil.example'))
+        self.assertFalse(async_to_sync(connects)('/ws/bufe/catalog/', b'https://evil.example'))
+        self.assertTrue(async_to_sync(connects)('/ws/bufe/catalog/', b'http://localhost:8000'))
+
+    @override_settings(BUFE_WS_ORDER_PLACEMENT=False)
+    def test_placement_is_ignored_when_disabled(self):
+        async def run():
+            communicator = WebsocketCommunicator(StudentOrderConsumer.as_asgi(), '/ws/bufe/my-orders/')
+            communicator.scope['user'] = self.user
+            await communicator.connect()
+            await communicator.send_json_to({'type': 'place_order', 'ref': 1, 'cart': {str(self.termekek[0].id): 1}})
+            nothing = await communicator.receive_nothing()
+            await communicator.disconnect()
+            return nothing
+
+        self.assertTrue(async_to_sync(run)())
+        self.assertFalse(Rendeles.objects.exists())
+
+
+@override_settings(BUFE_BREAK_SLOT_CAPACITY=2, BUFE_BREAK_SLOT_CAPACITIES={'12:00': 0})
+class SzunetFoglaltsagTests(BufeTestMixin, TestCase):
+
+    def test_reservation_stops_at_capacity(self):
+        datum = datetime.now().date()
+        self.assertTrue(SzunetFoglaltsag.reserve(datum, '10:05'))
+        with self.assertNumQueries(1):
+            self.assertTrue(SzunetFoglaltsag.reserve(datum, '10:05'))
+        self.assertFalse(SzunetFoglaltsag.reserve(datum, '10:05'))
+        self.assertEqual(SzunetFoglaltsag.objects.get(datum=datum, szunet='10:05').foglalt, 2)
+
+        SzunetFoglaltsag.release(datum, '10:05')
+        self.assertTrue(SzunetFoglaltsag.reserve(datum, '10:05'))
+
+    def test_unlimited_break_needs_no_counter(self):
+        with self.assertNumQueries(0):
+            self.assertTrue(SzunetFoglaltsag.reserve(datetime.now().date(), '12:00'))
+
+    def test_full_break_is_not_offered_and_rejected(self):
+        datum = RendelesForm.next_break_datetime('10:05').date()
+        SzunetFoglaltsag.objects.create(datum=datum, szunet='10:05', kapacitas=2, foglalt=2)
+
+        choices = dict(RendelesForm().fields['szunet_valasztas'].choices)
+        self.assertNotIn('10:05', choices)
+        self.assertIn('11:05', choices)
+
+        self.client.force_login(self.user)
+        self.client.post(reverse('bufe:create_order'), {
+            'szunet_valasztas': '10:05',
+            'idozitve': RendelesForm.next_break_datetime('10:05').strftime('%Y-%m-%dT%H:%M'),
+            f'quantity_{self.termekek[0].id}': '1',
+        })
+        self.assertFalse(Rendeles.objects.exists())
+
+    def test_break_slots_endpoint(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('bufe:create_order'), {
+            'szunet_valasztas': '11:05',
+            'idozitve': RendelesForm.next_break_datetime('11:05').strftime('%Y-%m-%dT%H:%M'),
+            f'quantity_{self.termekek[0].id}': '1',
+        })
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('bufe:api_break_slots'))
+        slots = {slot['szunet']: slot for slot in response.json()['slots']}
+        self.assertEqual(slots['11:05']['foglalt'], 1)
+        self.assertEqual(slots['11:05']['szabad'], 1)
+        self.assertIsNone(slots['12:00']['kapacitas'])
+
+    def order_at(self, szunet):
+        self.client.post(reverse('bufe:create_order'), {
+            'szunet_valasztas': szunet,
+            'idozitve': RendelesForm.next_break_datetime(szunet).strftime('%Y-%m-%dT%H:%M'),
+            f'quantity_{self.termekek[0].id}': '1',
+        })
+        return Rendeles.objects.order_by('-id').first()
+
+    def foglalt(self, szunet):
+        datum = RendelesForm.next_break_datetime(szunet).date()
+        return SzunetFoglaltsag.objects.get(datum=datum, szunet=szunet).foglalt
+
+    def set_status(self, rendeles, status):
+        return self.client.post(
+            reverse('bufe:api_update_order'),
+            json.dumps({'order_id': rendeles.id, 'status': status}),
+            content_type='application/json'
+        )
+
+    def test_admin_cancel_and_uncancel_follow_break_places(self):
+        self.bufe.bufeadmin.add(self.user)
+        self.client.force_login(self.user)
+        rendeles = self.order_at('10:05')
+        self.assertEqual(self.foglalt('10:05'), 1)
+
+        self.set_status(rendeles, 'torolve')
+        self.assertEqual(self.foglalt('10:05'), 0)
+        self.set_status(rendeles, 'visszaigasolva')
+        self.assertEqual(self.foglalt('10:05'), 1)
+
+        # Bulk changes count every order once, and only the ones that changed
+        masik = self.order_at('10:05')
+        for i in range(2):
+            self.client.post(
+                reverse('bufe:api_bulk_update_orders'),
+                json.dumps({'order_ids': [rendeles.id, masik.id], 'status': 'torolve'}),
+                content_type='application/json'
+            )
+        self.assertEqual(self.foglalt('10:05'), 0)
+
+    def test_transition_rereads_orders_changed_meanwhile(self):
+        self.client.force_login(self.user)
+        rendeles = self.order_at('10:05')
+        orders = Rendeles.objects.filter(id=rendeles.id)
+        update_filter = Rendeles.objects.filter
+
+        def cancel_before_first_update(*args, **kwargs):
+            if patched.call_count == 1:
+                # Another admin cancels the order between our read and our UPDATE
+                update_filter(id=rendeles.id).update(allapot='torolve')
+                SzunetFoglaltsag.release(RendelesForm.next_break_datetime('10:05').date(), '10:05')
+            return update_filter(*args, **kwargs)
+
+        with patch.object(Rendeles.objects, 'filter', side_effect=cancel_before_first_update) as patched:
+            self.assertEqual(orders.transition('visszaigasolva'), [rendeles.id])
+        # Read again as cancelled, so the order takes its place back
+        self.assertEqual(Rendeles.objects.get(id=rendeles.id).allapot, 'visszaigasolva')
+        self.assertEqual(self.foglalt('10:05'), 1)
+
+    def test_place_freed_by_admin_cancel_can_be_booked_again(self):
+        self.bufe.bufeadmin.add(self.user)
+        self.client.force_login(self.user)
+        elso = self.order_at('10:05')
+        self.order_at('10:05')
+        self.order_at('10:05')
+        self.assertEqual(Rendeles.objects.count(), 2)  # The break is full
+
+        self.assertEqual(self.set_status(elso, 'torolve').status_code, 200)
+        self.order_at('10:05')
+        self.assertEqual(Rendeles.objects.count(), 3)
+        self.assertEqual(self.foglalt('10:05'), 2)
+
+
+class OrderTransitionTests(BufeTestMixin, TestCase):
+
+    def setUp(self):
+        self.rendeles = Rendeles.objects.create(
+            user=self.user,
+            items=[{'termek_id': self.termekek[0].id, 'db': 1}]
+        )
+        self.bufe.bufeadmin.add(self.user)
+        self.client.force_login(self.user)
+
+    def update_status(self, status, **extra):
+        return self.client.post(
+            reverse('bufe:api_update_order'),
+            json.dumps({'order_id': self.rendeles.id, 'status': status, **extra}),
+            content_type='application/json'
+        )
+
+    def test_transition_is_a_conditional_update(self):
+        with CaptureQueriesContext(connection) as ctx:
+            updated = Rendeles.objects.filter(id=self.rendeles.id).transition('visszaigasolva')
+        self.assertEqual(updated, [self.rendeles.id])
+        [update] = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('UPDATE "bufe_rendeles"')]
+        self.assertIn('"allapot" = ', update.split('WHERE')[1])
+        self.rendeles.refresh_from_db()
+        self.assertEqual(self.rendeles.allapot, 'visszaigasolva')
+
+    def test_disallowed_transition_changes_nothing(self):
+        self.assertEqual(Rendeles.objects.filter(id=self.rendeles.id).transition('atadva'), [])
+        self.assertEqual(
+            Rendeles.objects.filter(id=self.rendeles.id).transition('visszaigasolva', elvart='torolve'),
+            []
+        )
+        self.rendeles.refresh_from_db()
+        self.assertEqual(self.rendeles.allapot, 'leadva')
+
+    def test_api_reports_conflict_with_current_state(self):
+        self.assertEqual(self.update_status('visszaigasolva', expected_status='leadva').status_code, 200)
+        response = self.update_status('torolve', expected_status='leadva')
+        self.assertEqual(response.status_code, 409)
+        self.assertTrue(response.json()['conflict'])
+        self.assertEqual(response.json()['order']['allapot'], 'visszaigasolva')
+
+    def test_student_cannot_cancel_confirmed_order(self):
+        Rendeles.objects.filter(id=self.rendeles.id).transition('visszaigasolva')
+        self.client.post(reverse('bufe:cancel_order', args=[self.rendeles.id]))
+        self.rendeles.refresh_from_db()
+        self.assertEqual(self.rendeles.allapot, 'visszaigasolva')
+
+        Rendeles.objects.filter(id=self.rendeles.id).update(allapot='leadva')
+        self.client.post(reverse('bufe:cancel_order', args=[self.rendeles.id]))
+        self.rendeles.refresh_from_db()
+        self.assertEqual(self.rendeles.allapot, 'visszavonva')
+
+    def test_archive_writes_only_the_flag(self):
+        def archive(order_id):
+            return self.client.post(
+                reverse('bufe:api_archive_order'),
+                json.dumps({'order_id': order_id}),
+                content_type='application/json'
+            )
+
+        with patch('bufe.views.broadcast_order_update') as broadcast, \
+                CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(archive(self.rendeles.id).status_code, 200)
+        [update] = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('UPDATE "bufe_rendeles"')]
+        self.assertNotIn('"allapot"', update.split('WHERE')[0])
+        broadcast.assert_called_once()
+
+        # Archiving again changes and broadcasts nothing
+        with patch('bufe.views.broadcast_order_update') as broadcast:
+            self.assertEqual(archive(self.rendeles.id).status_code, 200)
+        broadcast.assert_not_called()
+        self.assertEqual(archive(self.rendeles.id + 100).status_code, 404)
+
+
+class BulkUpdateOrdersTests(BufeTestMixin, TestCase):
+
+    def setUp(self):
+        self.rendelesek = [
+            Rendeles.objects.create(user=self.user, items=[{'termek_id': self.termekek[0].id, 'db': 1}])
+            for i in range(5)
+        ]
+        self.ids = [rendeles.id for rendeles in self.rendelesek]
+        self.bufe.bufeadmin.add(self.user)
+        self.client.force_login(self.user)
+
+    def bulk_update(self, **data):
+        return self.client.post(
+            reverse('bufe:api_bulk_update_orders'),
+            json.dumps(data),
+            content_type='application/json'
+        )
+
+    def test_status_change_skips_disallowed_orders(self):
+        with patch('bufe.views.broadcast_orders_update') as broadcast:
+            response = self.bulk_update(order_ids=self.ids, status='visszaigasolva')
+
+        data = response.json()
+        self.assertEqual(data['updated_count'], 5)
+        self.assertEqual(data['skipped_ids'], [])
+        broadcast.assert_called_once()
+
+        Rendeles.objects.filter(id=self.ids[0]).update(allapot='torolve')
+        response = self.bulk_update(order_ids=self.ids, status='atadva')
+        data = response.json()
+        self.assertEqual(data['updated_count'], 4)
+        self.assertEqual(data['skipped_ids'], [self.ids[0]])
+        self.assertEqual(Rendeles.objects.filter(allapot='atadva').count(), 4)
+
+    def test_archive(self):
+        response = self.bulk_update(order_ids=self.ids[:3], archive=True)
+        self.assertEqual(response.json()['updated_count'], 3)
+        self.assertEqual(Rendeles.objects.filter(archived=False).count(), 2)
+
+    def test_only_changed_orders_are_reported_and_broadcast(self):
+        Rendeles.objects.filter(id__in=self.ids[:2]).update(allapot='visszaigasolva')
+        with patch('bufe.views.broadcast_orders_update') as broadcast:
+            data = self.bulk_update(order_ids=self.ids, status='visszaigasolva').json()
+        self.assertEqual(data['updated_count'], 3)
+        self.assertEqual(sorted(order['id'] for order in data['orders']), self.ids[2:])
+        self.assertEqual(data['skipped_ids'], self.ids[:2])
+        self.assertEqual(sorted(order['id'] for order in broadcast.call_args.args[0]), self.ids[2:])
+
+        Rendeles.objects.filter(id=self.ids[0]).update(archived=True)
+        with patch('bufe.views.broadcast_orders_update') as broadcast:
+            data = self.bulk_update(order_ids=self.ids[:2] + [0], archive=True).json()
+        self.assertEqual(data['updated_count'], 1)
+        self.assertEqual(data['order_ids'], [self.ids[1]])
+        broadcast.assert_called_once_with([{'id': self.ids[1]}], action='archive')
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.bulk_update(order_ids=[], status='atadva').status_code, 400)
+        self.assertEqual(self.bulk_update(order_ids=self.ids, status='kesz').status_code, 400)
+        self.assertEqual(self.bulk_update(order_ids=['x'], archive=True).status_code, 400)
+
+
+class OutboxTests(BufeTestMixin, TestCase):
+
+    def setUp(self):
+        self.rendeles = Rendeles.objects.create(user=self.user, items=[{'termek_id': self.termekek[0].id, 'db': 1}])
+        self.bufe.bufeadmin.add(self.user)
+        self.client.force_login(self.user)
+        # Start from an empty outbox; the fixture products recorded events too
+        Esemeny.objects.all().delete()
+
+    def record(self, count):
+        return [
+            record_event({'type': 'order_update', 'action': 'update', 'order': {'id': i}})
+            for i in range(count)
+        ]
+
+    def published_seqs(self):
+        """Publish the pending events and return their sequence numbers"""
+        publish_pending()
+        return list(Esemeny.objects.values_list('seq', flat=True))
+
+    def test_event_is_published_after_commit(self):
+        # The background sender is woken up only once the change has committed
+        with patch.object(broadcast_sender, 'notify', side_effect=broadcast_sender.flush) as notify, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse('bufe:api_update_order'),
+                json.dumps({'order_id': self.rendeles.id, 'status': 'visszaigasolva'}),
+                content_type='application/json'
+            )
+            self.assertIsNone(Esemeny.objects.get().kikuldve)
+            notify.assert_not_called()
+
+        notify.assert_called_once()
+        esemeny = Esemeny.objects.get()
+        self.assertIsNotNone(esemeny.kikuldve)
+        self.assertEqual(esemeny.adat['order']['allapot'], 'visszaigasolva')
+
+    def test_rolled_back_change_leaves_no_event(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                Rendeles.objects.filter(id=self.rendeles.id).transition('visszaigasolva')
+                self.record(1)
+                raise ValueError
+        self.assertFalse(Esemeny.objects.exists())
+
+    def test_failed_publish_is_retried(self):
+        self.record(3)
+        sender = BroadcastSender(window=0)
+        with patch('channels.layers.InMemoryChannelLayer.group_send', side_effect=RuntimeError('layer down')):
+            self.assertFalse(sender.flush())
+        self.assertEqual(Esemeny.objects.filter(kikuldve__isnull=True).count(), 3)
+
+        self.assertTrue(sender.flush())
+        status = sender.get_status()
+        self.assertEqual(status['queue_depth'], 0)
+        self.assertEqual(status['sent_events'], 3)
+        self.assertEqual(status['failures'], 1)
+        self.assertIn('layer down', status['last_error'])
+
+    def test_pending_events_go_out_as_one_frame(self):
+        self.record(3)
+        with patch('channels.layers.InMemoryChannelLayer.group_send') as group_send:
+            self.assertEqual(publish_pending(), 3)
+
+        group_send.assert_called_once()
+        group, message = group_send.call_args.args
+        self.assertEqual(message['type'], 'order_events')
+        frame = json.loads(message['text'])
+        self.assertEqual(frame['type'], 'batch')
+        self.assertEqual([event['seq'] for event in frame['events']], [1, 2, 3])
+
+    def test_events_are_numbered_in_commit_order_without_gaps(self):
+        self.record(1)
+        self.assertIsNone(Esemeny.objects.get().seq)
+        self.published_seqs()
+        # A rolled back insert uses up a row ID but no sequence number
+        with self.assertRaises(ValueError), transaction.atomic():
+            self.record(1)
+            raise ValueError
+        # The lower ID commits last: hidden from the relay until then
+        commits_last, commits_first = self.record(2)
+        Esemeny.objects.filter(id=commits_last.id).update(kikuldve=timezone.now())
+        publish_pending()
+        Esemeny.objects.filter(id=commits_last.id).update(kikuldve=None)
+        publish_pending()
+
+        self.assertEqual(list(Esemeny.objects.order_by('seq').values_list('seq', flat=True)), [1, 2, 3])
+        self.assertEqual(
+            [event['order']['id'] for event in events_since(1)],
+            [commits_first.adat['order']['id'], commits_last.adat['order']['id']]
+        )
+
+    def test_relay_waits_for_other_worker(self):
+        self.record(2)
+        cache.add(events.RELAY_LOCK_KEY, 'other-worker', 30)
+        try:
+            with patch.object(events, 'SEND_TIMEOUT', 0.05), self.assertRaises(RuntimeError):
+                publish_pending()
+            self.assertEqual(Esemeny.objects.filter(kikuldve__isnull=True).count(), 2)
+        finally:
+            cache.delete(events.RELAY_LOCK_KEY)
+        self.assertEqual(publish_pending(), 2)
+
+    def test_relay_lock_is_extended_while_publishing(self):
+        with patch.object(events, 'RELAY_LOCK_TIMEOUT', 0.15):
+            with events.relay_lock() as lost:
+                time.sleep(0.4)
+                self.assertFalse(lost.is_set())
+                self.assertFalse(cache.add(events.RELAY_LOCK_KEY, 'other-worker', 30))
+        self.assertIsNone(cache.get(events.RELAY_LOCK_KEY))
+
+    def test_relay_lock_release_keeps_other_workers_lock(self):
+        with events.relay_lock():
+            # Our entry expired and another worker took the lock meanwhile
+            cache.set(events.RELAY_LOCK_KEY, 'other-worker', 30)
+        self.assertEqual(cache.get(events.RELAY_LOCK_KEY), 'other-worker')
+        cache.delete(events.RELAY_LOCK_KEY)
+
+    def test_sender_publishes_in_the_background(self):
+        sender = BroadcastSender(window=0.05)
+        flushed = threading.Event()
+        with patch.object(sender, 'flush', side_effect=lambda: flushed.set() or True) as flush:
+            for i in range(3):
+                sender.notify()
+            self.assertTrue(flushed.wait(timeout=2))
+        # Wakeups within the window are published together
+        flush.assert_called_once()
+
+    def test_broadcast_status_endpoint(self):
+        self.record(2)
+        data = self.client.get(reverse('bufe:api_broadcast_status')).json()
+        self.assertEqual(data['status']['queue_depth'], 2)
+        self.assertIn('connections', data)
+
+    def test_replay_from_outbox(self):
+        self.record(5)
+        ids = self.published_seqs()
+        start = ids[0] - 1
+
+        # Events the relay has not numbered yet are not replayed
+        self.record(1)
+
+        self.assertEqual([event['seq'] for event in events_since(ids[2])], ids[3:])
+        self.assertEqual(events_since(ids[-1]), [])
+        # Unknown or missing positions need a full snapshot
+        self.assertIsNone(events_since(None))
+        self.assertIsNone(events_since(ids[-1] + 1))
+        with override_settings(BUFE_SYNC_REPLAY_SIZE=3):
+            self.assertIsNone(events_since(start))
+        Esemeny.objects.filter(seq=ids[0]).delete()
+        self.assertIsNone(events_since(start))
+
+    def test_orders_api_returns_cursor(self):
+        self.record(2)
+        latest = self.published_seqs()[-1]
+        data = self.client.get(reverse('bufe:api_get_orders')).json()
+        self.assertEqual(data['sync'], {'seq': latest})
+
+
+class BufeadminCacheTests(BufeTestMixin, TestCase):
+
+    def setUp(self):
+        clear_bufeadmin_cache()
+        self.bufe.bufeadmin.add(self.user)
+
+    def fresh_user(self):
+        # A new object, as in the next request
+        return User.objects.get(id=self.user.id)
+
+    def test_membership_is_cached(self):
+        self.assertTrue(is_bufeadmin(self.fresh_user()))
+        user = self.fresh_user()
+        with self.assertNumQueries(0):
+            self.assertTrue(is_bufeadmin(user))
+            self.assertTrue(is_bufeadmin(user))
+
+    def test_cache_is_cleared_when_admins_change(self):
+        self.assertTrue(is_bufeadmin(self.fresh_user()))
+        self.bufe.bufeadmin.remove(self.user)
+        self.assertFalse(is_bufeadmin(self.fresh_user()))
+        self.user.managed_bufes.add(self.bufe)
+        self.assertTrue(is_bufeadmin(self.fresh_user()))
+
+    def test_admin_page_checks_without_queries_once_cached(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('bufe:admin_dashboard'))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('bufe:admin_dashboard'))
+        self.assertFalse([q for q in queries if 'bufe_bufe_bufeadmin' in q['sql']])
+
+
+class StudentOrderStatusTests(BufeTestMixin, TestCase):
+
+    def setUp(self):
+        self.other = User.objects.create_user(username='masik', email='masik@szlgbp.hu', password='jelszo12345')
+        self.rendeles = Rendeles.objects.create(user=self.user, items=[{'termek_id': self.termekek[0].id, 'db': 1}])
+        self.masik_rendeles = Rendeles.objects.create(user=self.other, items=[{'termek_id': self.termekek[1].id, 'db': 1}])
+        self.bufe.bufeadmin.add(self.user)
+        self.client.force_login(self.user)
+
+    def set_status(self, rendeles, status):
+        self.client.post(
+            reverse('bufe:api_update_order'),
+            json.dumps({'order_id': rendeles.id, 'status': status}),
+            content_type='application/json'
+        )
+
+    def test_status_change_is_pushed_to_owner_only(self):
+        self.set_status(self.rendeles, 'visszaigasolva')
+        self.set_status(self.rendeles, 'atadva')
+        self.set_status(self.masik_rendeles, 'torolve')
+
+        with patch('channels.layers.InMemoryChannelLayer.group_send') as group_send:
+            publish_pending()
+
+        pushes = {
+            call.args[0]: json.loads(call.args[1]['text'])['orders']
+            for call in group_send.call_args_list
+            if call.args[1]['type'] == 'order_status'
+        }
+        self.assertEqual(pushes[student_group_name(self.user.id)], [
+            {'id': self.rendeles.id, 'allapot': 'atadva', 'allapot_display': 'Rendelés átadva'}
+        ])
+        self.assertEqual(pushes[student_group_name(self.other.id)][0]['id'], self.masik_rendeles.id)
+
+    def test_consumer_joins_own_group(self):
+        async def run():
+            communicator = WebsocketCommunicator(StudentOrderConsumer.as_asgi(), '/ws/bufe/my-orders/')
+            communicator.scope['user'] = self.user
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await get_channel_layer().group_send(student_group_name(self.user.id), text_message('order_status', {
+                'type': 'order_status',
+                'orders': [{'id': 1, 'allapot': 'atadva', 'allapot_display': 'Átadva'}]
+            }))
+            message = await communicator.receive_json_from()
+            self.assertEqual(message['orders'][0]['allapot'], 'atadva')
+            await communicator.disconnect()
+
+            anonymous = WebsocketCommunicator(StudentOrderConsumer.as_asgi(), '/ws/bufe/my-orders/')
+            anonymous.scope['user'] = AnonymousUser()
+            connected, _ = await anonymous.connect()
+            self.assertFalse(connected)
+
+        async_to_sync(run)()
+
+
+class CatalogTests(BufeTestMixin, TestCase):
+
+    def setUp(self):
+        self.termek = self.termekek[0]
+
+    def test_product_save_is_recorded(self):
+        self.termek.elerheto = False
+        self.termek.save()
+        publish_pending()
+        esemeny = Esemeny.objects.latest('id')
+        self.assertEqual(esemeny.tipus, 'product_update')
+        self.assertEqual(esemeny.adat['action'], 'update')
+        self.assertFalse(esemeny.adat['product']['elerheto'])
+        self.assertEqual(catalog_version(), esemeny.seq)
+
+    def test_changes_are_pushed_as_one_compact_frame(self):
+        Esemeny.objects.update(kikuldve=timezone.now())
+        deleted_id = self.termekek[1].id
+        self.termek.kisult = True
+        self.termek.save()
+        self.termek.ar = 450
+        self.termek.save()
+        self.termekek[1].delete()
+
+        with patch('channels.layers.InMemoryChannelLayer.group_send') as group_send:
+            publish_pending()
+
+        frames = [json.loads(call.args[1]['text']) for call in group_send.call_args_list if call.args[0] == CATALOG_GROUP]
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(frames[0]['version'], catalog_version())
+        self.assertEqual(frames[0]['products'], [
+            {'id': self.termek.id, 'ar': 450, 'elerheto': True, 'kisult': True, 'max_rendelesenkent': 5},
+            {'id': deleted_id, 'elerheto': False}
+        ])
+
+    def test_snapshot_only_when_out_of_date(self):
+        async def run():
+            communicator = WebsocketCommunicator(CatalogConsumer.as_asgi(), '/ws/bufe/catalog/')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+
+            await communicator.send_json_to({'type': 'hello', 'version': version})
+            self.assertTrue(await communicator.receive_nothing())
+
+            await communicator.send_json_to({'type': 'hello', 'version': 0})
+            message = await communicator.receive_json_from()
+            self.assertEqual(message['type'], 'catalog_snapshot')
+            self.assertEqual(message['version'], version)
+            self.assertEqual(len(message['products']), len(self.termekek))
+            await communicator.disconnect()
+
+        publish_pending()
+        version = catalog_version()
+        async_to_sync(run)()
+
+    def test_frame_is_encoded_once_for_all_connections(self):
+        async def run():
+            communicators = []
+            for i in range(3):
+                communicator = WebsocketCommunicator(CatalogConsumer.as_asgi(), '/ws/bufe/catalog/')
+                await communicator.connect()
+                communicators.append(communicator)
+
+            with patch('bufe.events.encode_frame', wraps=encode_frame) as encode:
+                await database_sync_to_async(publish_pending)()
+            # One encoding per frame and framing, not per connection
+            self.assertEqual(
+                [(call.args[0]['type'], call.kwargs.get('compact', False)) for call in encode.call_args_list],
+                [('batch', False), ('batch', True), ('catalog_update', False)]
+            )
+
+            frames = [await communicator.receive_from() for communicator in communicators]
+            self.assertEqual(len(set(frames)), 1)
+            self.assertEqual(json.loads(frames[0])['type'], 'catalog_update')
+            for communicator in communicators:
+                await communicator.disconnect()
+
+        Esemeny.objects.update(kikuldve=timezone.now())
+        self.termek.kisult = True
+        self.termek.save()
+        async_to_sync(run)()
+
+    def test_order_page_embeds_catalog_version(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('bufe:create_order'))
+        self.assertEqual(response.context['catalog_version'], catalog_version())
+
+
+@patch.object(OrderConsumer, 'is_bufeadmin', AsyncMock(return_value=True))
+class CompactFramingTests(BufeTestMixin, TestCase):
+
+    def setUp(self):
+        rendeles = Rendeles.objects.create(user=self.user, items=[{'termek_id': self.termekek[0].id, 'db': 2}])
+        self.frame = {'type': 'batch', 'events': [
+            {'type': 'order_update', 'action': 'new', 'order': serialize_order(rendeles), 'seq': 1}
+        ]}
+
+    def expand(self, value, keys):
+        if isinstance(value, list):
+            return [self.expand(item, keys) for item in value]
+        if isinstance(value, dict):
+            return {keys.get(key, key): self.expand(item, keys) for key, item in value.items()}
+        return value
+
+    def test_short_keys_are_unambiguous(self):
+        shorts = list(COMPACT_KEYS.values())
+        self.assertEqual(len(shorts), len(set(shorts)))
+        self.assertFalse(set(shorts) & set(COMPACT_KEYS))
+
+    def test_compact_frame_is_smaller_and_lossless(self):
+        text = encode_frame(self.frame)
+        compact = encode_frame(self.frame, compact=True)
+        self.assertLess(len(compact.encode()), len(text.encode()) * 0.75)
+        keys = {short: key for key, short in COMPACT_KEYS.items()}
+        self.assertEqual(self.expand(json.loads(compact), keys), self.frame)
+
+    def test_framing_is_negotiated(self):
+        async def connect(subprotocols):
+            communicator = WebsocketCommunicator(OrderConsumer.as_asgi(), '/ws/bufe/orders/', subprotocols=subprotocols)
+            communicator.scope['user'] = self.user
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            return communicator, subprotocol
+
+        async def run():
+            plain, subprotocol = await connect([])
+            self.assertIsNone(subprotocol)
+            compact, subprotocol = await connect([COMPACT_SUBPROTOCOL])
+            self.assertEqual(subprotocol, COMPACT_SUBPROTOCOL)
+            dictionary = await compact.receive_json_from()
+            self.assertEqual(dictionary['type'], 'dictionary')
+
+            await get_channel_layer().group_send('bufe_orders', order_events_message(self.frame['events']))
+            self.assertEqual(await plain.receive_json_from(), self.frame)
+            self.assertEqual(self.expand(await compact.receive_json_from(), dictionary['keys']), self.frame)
+
+            await compact.send_json_to({'type': 'ping'})
+            self.assertEqual(await compact.receive_json_from(), {'t': 'pong'})
+            await plain.disconnect()
+            await compact.disconnect()
+
+        async_to_sync(run)()
+
+
+@override_settings(BUFE_WS_HEARTBEAT_INTERVAL=0.05, BUFE_WS_HEARTBEAT_TIMEOUT=0.12)
+class HeartbeatTests(TestCase):
+
+    def test_answered_heartbeat_keeps_connection(self):
+        async def run():
+            communicator = WebsocketCommunicator(CatalogConsumer.as_asgi(), '/ws/bufe/catalog/')
+            await communicator.connect()
+            self.assertEqual(connection_tracker.get_status()['catalog']['count'], count + 1)
+            for i in range(4):
+                self.assertEqual(await communicator.receive_from(), 'ping')
+                await communicator.send_to(text_data='pong')
+            await communicator.disconnect()
+
+        count = connection_tracker.get_status().get('catalog', {}).get('count', 0)
+        async_to_sync(run)()
+        self.assertEqual(connection_tracker.get_status()['catalog']['count'], count)
+
+    def test_silent_connection_is_reaped(self):
+        async def run():
+            communicator = WebsocketCommunicator(CatalogConsumer.as_asgi(), '/ws/bufe/catalog/')
+            await communicator.connect()
+            self.assertIn(CATALOG_GROUP, get_channel_layer().groups)
+            while (await communicator.receive_output(timeout=1))['type'] != 'websocket.close':
+                pass
+            # Removed from the group without waiting for the close handshake
+            self.assertFalse(get_channel_layer().groups.get(CATALOG_GROUP))
+            await communicator.disconnect()
+
+        reaped = connection_tracker.get_status().get('catalog', {}).get('reaped', 0)
+        async_to_sync(run)()
+        self.assertEqual(connection_tracker.get_status()['catalog']['reaped'], reaped + 1)
+
+
+@override_settings(BUFE_WS_MAX_IN_FLIGHT=1, BUFE_WS_MAX_BACKLOG=2)
+@patch.object(OrderConsumer, 'is_bufeadmin', AsyncMock(return_value=True))
+class FlowControlTests(TestCase):
+
+    def order_event(self, seq, order_id, action='update'):
+        return {'type': 'order_update', 'action': action, 'order': {'id': order_id, 'allapot': 'leadva'}, 'seq': seq}
+
+    async def broadcast(self, *events):
+        await get_channel_layer().group_send('bufe_orders', order_events_message(list(events)))
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(OrderConsumer.as_asgi(), '/ws/bufe/orders/')
+        communicator.scope['user'] = AnonymousUser()
+        await communicator.connect()
+        # Acknowledging turns on flow control for the connection
+        await communicator.send_json_to({'type': 'ack', 'seq': 0})
+        return communicator
+
+    def counters(self):
+        return connection_tracker.get_status().get('admin', {})
+
+    def test_slow_client_gets_latest_state_per_order(self):
+        async def run():
+            communicator = await self.connect()
+            await self.broadcast(self.order_event(1, 1, 'new'))
+            self.assertEqual((await communicator.receive_json_from())['events'][0]['seq'], 1)
+
+            # Frame 1 is not acknowledged yet: these are held back
+            await self.broadcast(self.order_event(2, 1))
+            await self.broadcast(self.order_event(3, 2, 'new'))
+            await self.broadcast(self.order_event(4, 2))
+            self.assertTrue(await communicator.receive_nothing())
+
+            await communicator.send_json_to({'type': 'ack', 'seq': 1})
+            frame = await communicator.receive_json_from()
+            self.assertTrue(frame['coalesced'])
+            self.assertEqual(frame['seq'], 4)
+            self.assertEqual(
+                [(event['order']['id'], event['action'], event['seq']) for event in frame['events']],
+                [(1, 'update', 2), (2, 'new', 4)]
+            )
+            await communicator.disconnect()
+
+        coalesced = self.counters().get('coalesced', 0)
+        async_to_sync(run)()
+        self.assertEqual(self.counters()['coalesced'], coalesced + 1)
+
+    def test_resync_past_backlog_limit(self):
+        async def run():
+            communicator = await self.connect()
+            await self.broadcast(self.order_event(1, 1, 'new'))
+            await communicator.receive_json_from()
+
+            await self.broadcast(self.order_event(2, 2, 'new'), self.order_event(3, 3, 'new'), self.order_event(4, 4, 'new'))
+            self.assertEqual(await communicator.receive_json_from(), {'type': 'resync'})
+            await self.broadcast(self.order_event(5, 5, 'new'))
+            self.assertTrue(await communicator.receive_nothing())
+
+            # The reloaded page syncs and receives normally again
+            await communicator.send_json_to({'type': 'sync', 'seq': None})
+            self.assertEqual((await communicator.receive_json_from())['type'], 'sync_snapshot')
+            await self.broadcast(self.order_event(6, 6, 'new'))
+            self.assertEqual((await communicator.receive_json_from())['events'][0]['seq'], 6)
+            await communicator.disconnect()
+
+        before = self.counters()
+        async_to_sync(run)()
+        after = self.counters()
+        self.assertEqual(after['resyncs'], before.get('resyncs', 0) + 1)
+        self.assertEqual(after['dropped'], before.get('dropped', 0) + 4)
+
+    def test_client_without_acks_is_not_held_back(self):
+        async def run():
+            communicator = WebsocketCommunicator(OrderConsumer.as_asgi(), '/ws/bufe/orders/')
+            communicator.scope['user'] = AnonymousUser()
+            await communicator.connect()
+            for seq in range(1, 4):
+                await self.broadcast(self.order_event(seq, 1))
+            for seq in range(1, 4):
+                self.assertEqual((await communicator.receive_json_from())['events'][0]['seq'], seq)
+            await communicator.disconnect()
+
+        with patch.object(OrderConsumer, 'reset_flow', autospec=True, side_effect=OrderConsumer.reset_flow) as reset:
+            async_to_sync(run)()
+        # Nothing is kept for acks that never come
+        self.assertEqual(reset.call_args.args[0].in_flight, deque())
+
+
+class OrderStreamTests(BufeTestMixin, TestCase):
+
+    def setUp(self):
+        self.bufe.bufeadmin.add(self.user)
+        Esemeny.objects.all().delete()
+
+    def read_event(self, content):
+        """Next server-sent event as a dict of its fields"""
+        async def read():
+            chunk = (await anext(content)).decode()
+            return dict(line.split(': ', 1) for line in chunk.strip().split('\n'))
+        return read()
+
+    def record(self, count):
+        """Record and publish events; returns their sequence numbers"""
+        for i in range(count):
+            record_event({'type': 'order_update', 'action': 'update', 'order': {'id': i}})
+        publish_pending()
+        return list(Esemeny.objects.values_list('seq', flat=True))
+
+    def test_stream_resumes_from_last_event_id(self):
+        ids = self.record(3)
+
+        async def run():
+            await self.async_client.aforce_login(self.user)
+            response = await self.async_client.get(
+                reverse('bufe:api_order_stream'),
+                headers={'Last-Event-ID': str(ids[0])}
+            )
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            content = aiter(response.streaming_content)
+            self.assertEqual(await self.read_event(content), {'retry': '3000'})
+
+            replay = await self.read_event(content)
+            self.assertEqual(replay['id'], str(ids[-1]))
+            self.assertEqual(json.loads(replay['data'])['type'], 'sync_replay')
+            self.assertEqual([event['seq'] for event in json.loads(replay['data'])['events']], ids[1:])
+
+            # Live events follow, numbered by their last sequence
+            await get_channel_layer().group_send('bufe_orders', order_events_message([
+                {'type': 'order_update', 'action': 'new', 'order': {'id': 9}, 'seq': ids[-1] + 1}
+            ]))
+            event = await self.read_event(content)
+            self.assertEqual(event['id'], str(ids[-1] + 1))
+            self.assertEqual(json.loads(event['data'])['events'][0]['order'], {'id': 9})
+
+            # A client going away cancels the response, which leaves the group
+            reading = asyncio.ensure_future(anext(content))
+            await asyncio.sleep(0)
+            reading.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await reading
+            self.assertFalse(get_channel_layer().groups.get('bufe_orders'))
+
+        async_to_sync(run)()
+
+    def test_stream_from_pruned_position_sends_snapshot(self):
+        ids = self.record(2)
+        Esemeny.objects.filter(seq=ids[0]).delete()
+
+        async def run():
+            await self.async_client.aforce_login(self.user)
+            response = await self.async_client.get(reverse('bufe:api_order_stream'), {'seq': ids[0] - 1})
+            content = aiter(response.streaming_content)
+            await self.read_event(content)
+            snapshot = await self.read_event(content)
+            self.assertEqual(json.loads(snapshot['data'])['type'], 'sync_snapshot')
+
+        async_to_sync(run)()
+
+    def test_stream_requires_bufeadmin(self):
+        other = User.objects.create_user(username='masik', email='masik@szlgbp.hu')
+
+        async def run():
+            await self.async_client.aforce_login(other)
+            response = await self.async_client.get(reverse('bufe:api_order_stream'))
+            self.assertEqual(response.status_code, 302)
+
+        async_to_sync(run)()
+
+
+class MenuSnapshotTests(BufeTestMixin, TestCase):
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def catalog_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        tables = ('"bufe_termek"', '"bufe_kategoria"', '"bufe_esemeny"')
+        return response, [q['sql'] for q in ctx.captured_queries if any(table in q['sql'] for table in tables)]
+
+    def test_menu_pages_run_no_catalog_queries(self):
+        self.client.get(reverse('bufe:create_order'))
+        for url in (reverse('bufe:create_order'), reverse('bufe:index')):
+            response, queries = self.catalog_queries(url)
+            self.assertEqual(queries, [])
+        [kategoria] = response.context['kategoriak']
+        self.assertEqual(len(kategoria.termekek), 6)
+
+    def test_product_and_category_changes_rebuild_menu(self):
+        self.bufe.bufeadmin.add(self.user)
+        self.client.get(reverse('bufe:create_order'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse('bufe:api_update_product'),
+                json.dumps({'product_id': self.termekek[0].id, 'elerheto': False}),
+                content_type='application/json'
+            )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.kategoria.nev = 'Pékáru'
+            self.kategoria.save()
+
+        response = self.client.get(reverse('bufe:create_order'))
+        [kategoria] = response.context['kategoriak']
+        self.assertEqual(kategoria.nev, 'Pékáru')
+        self.assertNotIn(self.termekek[0].id, [termek.id for termek in kategoria.termekek])
+        self.assertEqual(response.context['catalog_version'], catalog_version())
+
+    def test_other_process_reads_shared_snapshot(self):
+        snapshot = get_menu(self.bufe)
+        _snapshots.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_menu(self.bufe), snapshot)
@@ -19,11 +19,15 @@ urlpatterns = [
     # API endpoints - Public
     path('api/check-access/', views.api_check_access, name='api_check_access'),
     path('api/opening-hours/', views.api_opening_hours, name='api_opening_hours'),
+    path('api/break-slots/', views.api_break_slots, name='api_break_slots'),
     
     # API endpoints - Bufeadmin only
     path('admin/api/orders/', views.api_get_orders, name='api_get_orders'),
+    path('admin/api/orders/stream/', views.api_order_stream, name='api_order_stream'),
+    path('admin/api/broadcast-status/', views.api_broadcast_status, name='api_broadcast_status'),
     path('admin/api/update-order/', views.api_update_order_status, name='api_update_order'),
     path('admin/api/archive-order/', views.api_archive_order, name='api_archive_order'),
+    path('admin/api/bulk-update-orders/', views.api_bulk_update_orders, name='api_bulk_update_orders'),
     path('admin/api/archive-all-done/', views.api_archive_all_done, name='api_archive_all_done'),
     path('admin/api/update-product/', views.api_update_product, name='api_update_product'),
     path('admin/api/add-product/', views.api_add_product, name='api_add_product'),
@@ -1,15 +1,20 @@
 """
 Domain verification utilities for the Büfé app.
 """
+from asgiref.sync import iscoroutinefunction, sync_to_async
 from django.conf import settings
 from django.shortcuts import redirect
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.http import HttpResponseForbidden
 from django.template.response import TemplateResponse
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.utils import timezone
 from functools import wraps
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+import threading
+import time
+from .events import record_event, publish_pending
 
 
 # Allowed email domains for Büfé access
@@ -151,9 +156,35 @@ class DomainPermissionMixin:
         return super().dispatch(request, *args, **kwargs)
 
 
+# Process-level bufeadmin membership cache: {user_id: (is_bufeadmin, expires_at)}
+# Cleared by the signal handlers in signals.py whenever Bufe.bufeadmin changes;
+# the timeout bounds how long other processes may keep a stale answer.
+_bufeadmin_cache = {}
+_bufeadmin_cache_lock = threading.Lock()
+
+
+def clear_bufeadmin_cache():
+    with _bufeadmin_cache_lock:
+        _bufeadmin_cache.clear()
+
+
+def _query_bufeadmin(user):
+    from .models import Bufe
+    try:
+        bufe = Bufe.objects.first()
+        if not bufe:
+            return False
+        return bufe.bufeadmin.filter(id=user.id).exists()
+    except Exception:
+        return False
+
+
 def is_bufeadmin(user):
     """
     Check if a user is a bufeadmin.
+    The answer is remembered on the user object for the rest of the request
+    (the decorator, the template filter and the base template all ask) and in
+    a process-level cache, so steady-state checks cost no queries.
     
     Args:
         user: Django User object
@@ -164,20 +195,38 @@ def is_bufeadmin(user):
     if not user or not user.is_authenticated:
         return False
     
-    from .models import Bufe
-    try:
-        bufe = Bufe.objects.first()
-        if not bufe:
-            return False
-        return bufe.bufeadmin.filter(id=user.id).exists()
-    except Exception:
-        return False
+    cached = getattr(user, '_is_bufeadmin', None)
+    if cached is not None:
+        return cached
+    
+    now = time.monotonic()
+    entry = _bufeadmin_cache.get(user.id)
+    if entry and entry[1] > now:
+        result = entry[0]
+    else:
+        result = _query_bufeadmin(user)
+        with _bufeadmin_cache_lock:
+            _bufeadmin_cache[user.id] = (result, now + settings.BUFE_ADMIN_CACHE_TIMEOUT)
+    
+    user._is_bufeadmin = result
+    return result
 
 
 def bufeadmin_required(view_func):
     """
     Decorator that restricts access to bufeadmin users only.
+    Works on async views too.
     """
+    if iscoroutinefunction(view_func):
+        @wraps(view_func)
+        @login_required
+        async def _wrapped_async_view(request, *args, **kwargs):
+            if not await sync_to_async(is_bufeadmin)(request.user):
+                messages.error(request, 'Nincs jogosultsága a büfé adminisztrációs felület eléréséhez.')
+                return redirect('bufe:index')
+            return await view_func(request, *args, **kwargs)
+        return _wrapped_async_view
+    
     @wraps(view_func)
     @login_required
     def _wrapped_view(request, *args, **kwargs):
@@ -188,27 +237,233 @@ def bufeadmin_required(view_func):
     return _wrapped_view
 
 
+# How long a submitted order form key is remembered in the cache (seconds)
+IDEMPOTENCY_CACHE_TIMEOUT = 60 * 60
+
+
+def _idempotency_cache_key(user, key):
+    return f"bufe:idempotency:{user.id}:{key}"
+
+
+def get_idempotent_order_id(user, key):
+    """
+    Fast cache lookup for an order already placed with the given form key.
+    A miss is not conclusive (expired entry, another process's cache), so
+    ordering.find_original_order then looks the key up in the database.
+    
+    Args:
+        user: Django User object who submitted the form
+        key (str): Idempotency key issued with the order form
+        
+    Returns:
+        int or None: ID of the original order, if known
+    """
+    if not key:
+        return None
+    return cache.get(_idempotency_cache_key(user, key))
+
+
+def remember_idempotent_order(user, key, order_id):
+    """
+    Cache the order created for a form key, so retries are answered
+    without touching the database.
+    """
+    if key:
+        cache.set(_idempotency_cache_key(user, key), order_id, IDEMPOTENCY_CACHE_TIMEOUT)
+
+
+def forget_idempotent_order(user, key):
+    """Drop a cached form key whose order no longer exists"""
+    if key:
+        cache.delete(_idempotency_cache_key(user, key))
+
+
+class BroadcastSender:
+    """
+    Background thread that publishes committed outbox events.
+    Views only wake it up after commit and return immediately - the fan-out
+    to the dashboards never runs in the request thread. Once woken, the sender
+    waits BUFE_BROADCAST_COALESCE_MS so that everything committed in the
+    meantime goes out to the admin group as a single frame, so consumers
+    encode and write one message instead of one per event.
+    """
+    
+    # Seconds before events left unsent by a failure are tried again
+    RETRY_DELAY = 1
+    
+    def __init__(self, window=None):
+        self.window = window
+        self.loop = None
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.sent_events = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_sent = None
+    
+    def get_window(self):
+        if self.window is not None:
+            return self.window
+        return settings.BUFE_BROADCAST_COALESCE_MS / 1000
+    
+    def bind_loop(self, loop):
+        """
+        Remember the ASGI server's event loop. The in-memory channel layer
+        only delivers to consumers waiting in the loop it is called from,
+        so the sends are handed back to it.
+        """
+        self.loop = loop
+    
+    def _ensure_thread(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run,
+                name='bufe-broadcast-sender',
+                daemon=True
+            )
+            self._thread.start()
+    
+    def notify(self):
+        """Called after commit: publish pending events in the background"""
+        self._ensure_thread()
+        self._wakeup.set()
+    
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            time.sleep(self.get_window())
+            self._wakeup.clear()
+            try:
+                if not self.flush():
+                    time.sleep(self.RETRY_DELAY)
+                    self._wakeup.set()
+            finally:
+                close_old_connections()
+    
+    def flush(self):
+        """
+        Publish everything pending now.
+        
+        Returns:
+            bool: False if some events were left unsent by an error
+        """
+        try:
+            self.sent_events += publish_pending(loop=self.loop)
+        except Exception as e:
+            self.failures += 1
+            self.last_error = f"{timezone.now():%Y-%m-%d %H:%M:%S} {e}"
+            print(f"Error publishing broadcast frame: {e}")
+            return False
+        self.last_sent = timezone.now()
+        return True
+    
+    def get_status(self):
+        """Counters and queue depth for monitoring"""
+        from .models import Esemeny
+        return {
+            'running': bool(self._thread and self._thread.is_alive()),
+            'queue_depth': Esemeny.objects.filter(kikuldve__isnull=True).count(),
+            'sent_events': self.sent_events,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'last_sent': self.last_sent.strftime('%Y-%m-%d %H:%M:%S') if self.last_sent else None,
+        }
+
+
+broadcast_sender = BroadcastSender()
+
+
+class ConnectionTracker:
+    """
+    Open WebSocket connections of this process by consumer kind
+    ('admin', 'student', 'catalog'; 'stream' for the admin Server-Sent Events
+    fallback), with their age, how many were reaped by
+    the heartbeat for not answering, and the flow control counters of slow
+    clients ('coalesced', 'dropped', 'resyncs').
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connections = {}
+        self.reaped_count = {}
+        self.counters = {}
+    
+    def register(self, kind, channel_name):
+        with self._lock:
+            self.connections.setdefault(kind, {})[channel_name] = time.time()
+    
+    def unregister(self, kind, channel_name):
+        with self._lock:
+            self.connections.get(kind, {}).pop(channel_name, None)
+    
+    def reaped(self, kind):
+        with self._lock:
+            self.reaped_count[kind] = self.reaped_count.get(kind, 0) + 1
+    
+    def count(self, kind, name, amount=1):
+        with self._lock:
+            counters = self.counters.setdefault(kind, {})
+            counters[name] = counters.get(name, 0) + amount
+    
+    def get_status(self):
+        """Connection counts and ages in seconds, for monitoring"""
+        now = time.time()
+        status = {}
+        with self._lock:
+            for kind in set(self.connections) | set(self.reaped_count) | set(self.counters):
+                ages = [now - connected for connected in self.connections.get(kind, {}).values()]
+                status[kind] = {
+                    'count': len(ages),
+                    'oldest_age': round(max(ages)) if ages else 0,
+                    'average_age': round(sum(ages) / len(ages)) if ages else 0,
+                    'reaped': self.reaped_count.get(kind, 0),
+                    **self.counters.get(kind, {}),
+                }
+        return status
+
+
+connection_tracker = ConnectionTracker()
+
+
 def broadcast_order_update(order_data, action='new'):
     """
     Broadcast order update to all connected bufeadmin WebSocket clients.
+    The event is written to the outbox as part of the caller's transaction
+    and published with the other events of the coalescing window once that
+    commits (see events.py).
     
     Args:
         order_data (dict): Order data to broadcast
         action (str): Action type - 'new', 'update', 'delete'
     """
-    channel_layer = get_channel_layer()
-    if channel_layer:
-        try:
-            async_to_sync(channel_layer.group_send)(
-                'bufe_orders',
-                {
-                    'type': 'order_update',
-                    'action': action,
-                    'order': order_data
-                }
-            )
-        except Exception as e:
-            print(f"Error broadcasting order update: {e}")
+    record_event({
+        'type': 'order_update',
+        'action': action,
+        'order': order_data
+    })
+
+
+def broadcast_orders_update(orders_data, action='update'):
+    """
+    Broadcast a change affecting many orders as a single WebSocket message.
+    
+    Args:
+        orders_data (list): Serialized orders (or {'id': ...} stubs for archiving)
+        action (str): Action type - 'update', 'archive'
+    """
+    if not orders_data:
+        return
+    
+    record_event({
+        'type': 'orders_update',
+        'action': action,
+        'orders': orders_data
+    })
 
 
 def broadcast_product_update(product_data, action='update'):
@@ -219,16 +474,8 @@ def broadcast_product_update(product_data, action='update'):
         product_data (dict): Product data to broadcast
         action (str): Action type - 'add', 'update', 'delete'
     """
-    channel_layer = get_channel_layer()
-    if channel_layer:
-        try:
-            async_to_sync(channel_layer.group_send)(
-                'bufe_orders',
-                {
-                    'type': 'product_update',
-                    'action': action,
-                    'product': product_data
-                }
-            )
-        except Exception as e:
-            print(f"Error broadcasting product update: {e}")
\ No newline at end of file
+    record_event({
+        'type': 'product_update',
+        'action': action,
+        'product': product_data
+    })
\ No newline at end of file
@@ -1,15 +1,23 @@
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.utils import timezone
 from django.db import transaction
+from django.conf import settings
+import asyncio
 import json
-from .utils import domain_required, check_domain_access, get_user_domain, bufeadmin_required, is_bufeadmin, broadcast_order_update, broadcast_product_update
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from .utils import domain_required, check_domain_access, get_user_domain, bufeadmin_required, is_bufeadmin, broadcast_order_update, broadcast_orders_update, broadcast_sender, connection_tracker
 from .models import *
 from .forms import RendelesForm
+from .serializers import encode_frame, serialize_order, serialize_orders, serialize_product
+from .ordering import OrderRejected, closed_reason, place_order
+from .catalog import get_menu
+from .events import ORDERS_GROUP, sync_cursor, sync_reply
 
 @login_required
 @domain_required()
@@ -31,16 +39,8 @@ def index(request):
     except Exception as e:
         bufe = None
     
-    # Get categories with available products
-    kategoriak = Kategoria.objects.filter(bufe=bufe).prefetch_related('termekek') if bufe else []
-    
-    # Get available products grouped by category
-    termekek_by_kategoria = {}
-    if bufe:
-        for kategoria in kategoriak:
-            termekek = kategoria.termekek.filter(elerheto=True)
-            if termekek.exists():
-                termekek_by_kategoria[kategoria] = termekek
+    # Categories with available products, from the cached menu snapshot
+    menu = get_menu(bufe) if bufe else None
     
     # Get user's recent orders
     recent_orders = Rendeles.objects.filter(
@@ -57,8 +57,8 @@ def index(request):
         'user_full_name': f"{user.last_name} {user.first_name}".strip() or user.username,
         'welcome_message': f"Üdvözöljük a Büfé alkalmazásban, {user.first_name}!" or "Üdvözöljük a Büfé alkalmazásban!",
         'bufe': bufe,
-        'kategoriak': kategoriak,
-        'termekek_by_kategoria': termekek_by_kategoria,
+        'kategoriak': menu.kategoriak if menu else [],
+        'termekek_by_kategoria': menu.termekek_by_kategoria if menu else {},
         'recent_orders': recent_orders,
         'is_open': is_open,
     }
@@ -78,95 +78,63 @@ def create_order(request):
     
     # Get the buffet
     bufe = Bufe.objects.first()
-    if not bufe:
-        messages.error(request, "A büfé jelenleg nem elérhető.")
-        return redirect('bufe:index')
-    
-    # Check if buffet is exceptionally closed
-    if bufe.rendkivuli_zarva:
-        messages.error(request, "A büfé rendkívüli okok miatt zárva tart. Kérjük, próbálja később.")
+    reason = closed_reason(bufe)
+    if reason:
+        messages.error(request, reason)
         return redirect('bufe:index')
     
-    # Check if buffet is open
-    is_open = bufe.is_open_now()
-    
-    # Get categories with available products
-    kategoriak = Kategoria.objects.filter(bufe=bufe).prefetch_related('termekek')
-    termekek_by_kategoria = {}
-    for kategoria in kategoriak:
-        termekek = kategoria.termekek.filter(elerheto=True)
-        if termekek.exists():
-            termekek_by_kategoria[kategoria] = termekek
-    
     if request.method == 'POST':
-        form = RendelesForm(request.POST)
-        
-        # Get cart items from POST data
-        cart_items = []
-        for key, value in request.POST.items():
-            if key.startswith('quantity_'):
-                termek_id = int(key.replace('quantity_', ''))
-                quantity = int(value) if value else 0
-                
-                if quantity > 0:
-                    try:
-                        termek = Termek.objects.get(id=termek_id, elerheto=True)
-                        if quantity <= termek.max_rendelesenkent:
-                            cart_items.append({
-                                'termek_id': termek_id,
-                                'db': quantity
-                            })
-                        else:
-                            messages.error(
-                                request,
-                                f"{termek.nev}: Maximum {termek.max_rendelesenkent} darab rendelhető."
-                            )
-                    except Termek.DoesNotExist:
-                        pass
-        
-        if not cart_items:
-            messages.error(request, "Kérem válasszon ki legalább egy terméket!")
-            return redirect('bufe:create_order')
-        
-        if form.is_valid():
-            try:
-                with transaction.atomic():
-                    # Create the order
-                    rendeles = form.save(commit=False)
-                    rendeles.user = user
-                    rendeles.items = cart_items
-                    rendeles.vegosszeg = 0  # Will be calculated in save()
-                    rendeles.save()
-                    
-                    # Broadcast new order to bufeadmin WebSocket clients
-                    order_data = serialize_order(rendeles)
-                    broadcast_order_update(order_data, action='new')
-                    
-                    messages.success(
-                        request,
-                        f"Rendelés sikeresen leadva! Rendelésszám: #{rendeles.id}, Végösszeg: {rendeles.vegosszeg} Ft"
-                    )
-                    return redirect('bufe:order_detail', order_id=rendeles.id)
-            except Exception as e:
-                messages.error(request, f"Hiba történt a rendelés leadása során: {str(e)}")
+        try:
+            rendeles, created = place_order(user, request.POST)
+        except OrderRejected as e:
+            if e.form is None:
+                for error in e.errors:
+                    messages.error(request, error)
                 return redirect('bufe:create_order')
+            # Shown again with the field errors
+            form = e.form
+        else:
+            if not created:
+                return redirect_to_original_order(request, rendeles.id)
+            messages.success(
+                request,
+                f"Rendelés sikeresen leadva! Rendelésszám: #{rendeles.id}, Végösszeg: {rendeles.vegosszeg} Ft"
+            )
+            return redirect('bufe:order_detail', order_id=rendeles.id)
     else:
         form = RendelesForm()
     
+    # Check if buffet is open
+    is_open = bufe.is_open_now()
+    
+    # Categories with available products, from the cached menu snapshot
+    menu = get_menu(bufe)
+    
     context = {
         'user': user,
         'user_domain': user_domain,
         'user_full_name': f"{user.first_name} {user.last_name}".strip() or user.username,
         'bufe': bufe,
         'is_open': is_open,
-        'kategoriak': kategoriak,
-        'termekek_by_kategoria': termekek_by_kategoria,
+        'kategoriak': menu.kategoriak,
+        'termekek_by_kategoria': menu.termekek_by_kategoria,
         'form': form,
+        # Lets the live catalog channel tell whether the page is out of date
+        'catalog_version': menu.version,
+        'ws_order_placement': settings.BUFE_WS_ORDER_PLACEMENT,
     }
     
     return render(request, 'bufe/create_order.html', context)
 
 
+def redirect_to_original_order(request, order_id):
+    """
+    Answer a repeated order submission with the order it already created.
+    """
+    messages.info(request, f"Ez a rendelés már le lett adva. Rendelésszám: #{order_id}")
+    return redirect('bufe:order_detail', order_id=order_id)
+
+
 @login_required
 @domain_required()
 def order_detail(request, order_id):
@@ -176,23 +144,8 @@ def order_detail(request, order_id):
     """
     rendeles = get_object_or_404(Rendeles, id=order_id, user=request.user)
     
-    # Build order items with product details
-    order_items = []
-    for item in rendeles.items:
-        try:
-            termek = Termek.objects.get(id=item['termek_id'])
-            order_items.append({
-                'termek': termek,
-                'mennyiseg': item['db'],
-                'osszeg': termek.ar * item['db']
-            })
-        except Termek.DoesNotExist:
-            order_items.append({
-                'termek': None,
-                'termek_id': item['termek_id'],
-                'mennyiseg': item['db'],
-                'osszeg': 0
-            })
+    # Order lines carry their own name and price snapshots
+    order_items = rendeles.tetelek.all()
     
     context = {
         'rendeles': rendeles,
@@ -229,14 +182,16 @@ def cancel_order(request, order_id):
     """
     Cancel an order if it's still in 'leadva' state.
     """
-    rendeles = get_object_or_404(Rendeles, id=order_id, user=request.user)
+    rendeles = get_object_or_404(Rendeles.objects.select_related('user'), id=order_id, user=request.user)
     
-    if rendeles.allapot == 'leadva':
-        rendeles.allapot = 'visszavonva'
-        rendeles.save()
-        messages.success(request, f"Rendelés #{rendeles.id} sikeresen visszavonva.")
-    else:
-        messages.error(request, "Ez a rendelés már nem vonható vissza.")
+    # Only succeeds if no admin has confirmed the order in the meantime
+    with transaction.atomic():
+        if Rendeles.objects.filter(id=rendeles.id).transition('visszavonva', elvart='leadva'):
+            rendeles.allapot = 'visszavonva'
+            broadcast_order_update(serialize_order(rendeles), action='update')
+            messages.success(request, f"Rendelés #{rendeles.id} sikeresen visszavonva.")
+        else:
+            messages.error(request, "Ez a rendelés már nem vonható vissza.")
     
     return redirect('bufe:my_orders')
 
@@ -323,6 +278,32 @@ def api_opening_hours(request):
     })
 
 
+@require_http_methods(["GET"])
+def api_break_slots(request):
+    """
+    API endpoint reporting the fill level of every pickup break.
+    Cheap enough to be polled by the order page: a single query.
+    """
+    levels = RendelesForm.break_fill_levels()
+    
+    slots = []
+    for szunet, label in SZUNET_CHOICES:
+        level = levels[szunet]
+        slots.append({
+            'szunet': szunet,
+            'label': label,
+            'datum': level['datum'].isoformat(),
+            'kapacitas': level['kapacitas'] or None,
+            'foglalt': level['foglalt'],
+            'szabad': level['szabad'],
+            'betelt': level['szabad'] == 0
+        })
+    
+    return JsonResponse({
+        'slots': slots
+    })
+
+
 # ============================================================================
 # BUFEADMIN VIEWS
 # ============================================================================
@@ -336,13 +317,20 @@ def admin_dashboard(request):
     """
     bufe = Bufe.objects.first()
     
+    # Taken before the query, so no event between the two is skipped
+    cursor = sync_cursor()
+    
     # Get non-archived orders grouped by status
-    active_orders = Rendeles.objects.filter(archived=False).order_by('-leadva')
+    active_orders = list(
+        Rendeles.objects.filter(archived=False).select_related('user').order_by('-leadva')
+    )
     
     context = {
         'user': request.user,
         'bufe': bufe,
         'active_orders': active_orders,
+        'orders_data': serialize_orders(active_orders),
+        'sync_cursor': cursor,
         'user_full_name': f"{request.user.first_name} {request.user.last_name}".strip() or request.user.username,
     }
     
@@ -415,22 +403,33 @@ def api_update_order_status(request):
                 'error': 'Hiányzó paraméterek'
             }, status=400)
         
-        rendeles = get_object_or_404(Rendeles, id=order_id)
-        
         # Validate status transition
-        valid_statuses = ['leadva', 'visszavonva', 'visszaigasolva', 'torolve', 'atadva']
-        if new_status not in valid_statuses:
+        if new_status not in dict(Rendeles.ORDER_STATES):
             return JsonResponse({
                 'success': False,
                 'error': 'Érvénytelen állapot'
             }, status=400)
         
-        rendeles.allapot = new_status
-        rendeles.save()
-        
-        # Broadcast update to connected WebSocket clients
-        order_data = serialize_order(rendeles)
-        broadcast_order_update(order_data, action='update')
+        with transaction.atomic():
+            # Single conditional UPDATE - fails instead of overwriting a concurrent change
+            updated = Rendeles.objects.filter(id=order_id).transition(
+                new_status,
+                elvart=data.get('expected_status')
+            )
+            
+            rendeles = get_object_or_404(Rendeles.objects.select_related('user'), id=order_id)
+            order_data = serialize_order(rendeles)
+            
+            if not updated:
+                return JsonResponse({
+                    'success': False,
+                    'conflict': True,
+                    'error': f'A rendelés ({rendeles.get_allapot_display().lower()}) nem állítható ebbe az állapotba.',
+                    'order': order_data
+                }, status=409)
+            
+            # Broadcast update to connected WebSocket clients
+            broadcast_order_update(order_data, action='update')
         
         return JsonResponse({
             'success': True,
@@ -462,14 +461,22 @@ def api_archive_order(request):
                 'error': 'Hiányzó rendelés azonosító'
             }, status=400)
         
-        rendeles = get_object_or_404(Rendeles, id=order_id)
-        rendeles.archived = True
-        rendeles.save()
+        with transaction.atomic():
+            # Only the flag is written, so a concurrent status change is kept
+            archived = Rendeles.objects.filter(id=order_id, archived=False).update(archived=True)
+            
+            if archived:
+                # Broadcast update to connected WebSocket clients
+                order_data = serialize_order(Rendeles.objects.get(id=order_id))
+                broadcast_order_update(order_data, action='archive')
         
-        # Broadcast update to connected WebSocket clients
-        order_data = serialize_order(rendeles)
-        broadcast_order_update(order_data, action='archive')
+        if not archived and not Rendeles.objects.filter(id=order_id).exists():
+            return JsonResponse({
+                'success': False,
+                'error': 'Rendelés nem található'
+            }, status=404)
         
+        # An already archived order is left as it is
         return JsonResponse({
             'success': True,
             'order_id': order_id
@@ -482,6 +489,90 @@ def api_archive_order(request):
         }, status=500)
 
 
+@login_required
+@bufeadmin_required
+@csrf_exempt
+@require_http_methods(["POST"])
+def api_bulk_update_orders(request):
+    """
+    API endpoint to update the status of, or archive, many orders at once.
+    Expects {"order_ids": [...], "status": "..."} or {"order_ids": [...], "archive": true}.
+    The change is applied with a single UPDATE and broadcast as one message.
+    """
+    try:
+        data = json.loads(request.body)
+        order_ids = data.get('order_ids')
+        new_status = data.get('status')
+        archive = bool(data.get('archive'))
+        
+        if not order_ids or not isinstance(order_ids, list) or not (new_status or archive):
+            return JsonResponse({
+                'success': False,
+                'error': 'Hiányzó paraméterek'
+            }, status=400)
+        
+        try:
+            order_ids = [int(order_id) for order_id in order_ids]
+        except (TypeError, ValueError):
+            return JsonResponse({
+                'success': False,
+                'error': 'Érvénytelen rendelés azonosító'
+            }, status=400)
+        
+        if archive:
+            with transaction.atomic():
+                # Already archived or missing orders are neither reported nor broadcast
+                archived_ids = list(
+                    Rendeles.objects.filter(id__in=order_ids, archived=False)
+                    .select_for_update()
+                    .values_list('id', flat=True)
+                )
+                Rendeles.objects.filter(id__in=archived_ids).update(archived=True)
+                
+                if archived_ids:
+                    broadcast_orders_update([{'id': order_id} for order_id in archived_ids], action='archive')
+            
+            return JsonResponse({
+                'success': True,
+                'updated_count': len(archived_ids),
+                'order_ids': archived_ids
+            })
+        
+        if new_status not in dict(Rendeles.ORDER_STATES):
+            return JsonResponse({
+                'success': False,
+                'error': 'Érvénytelen állapot'
+            }, status=400)
+        
+        with transaction.atomic():
+            # Orders whose current state doesn't allow the transition are left untouched
+            changed_ids = set(Rendeles.objects.filter(
+                id__in=order_ids,
+                archived=False
+            ).transition(new_status))
+            
+            orders_data = serialize_orders(
+                Rendeles.objects.filter(id__in=changed_ids).order_by('-leadva')
+            )
+            skipped_ids = [order_id for order_id in order_ids if order_id not in changed_ids]
+            
+            if orders_data:
+                broadcast_orders_update(orders_data, action='update')
+        
+        return JsonResponse({
+            'success': True,
+            'updated_count': len(changed_ids),
+            'orders': orders_data,
+            'skipped_ids': skipped_ids
+        })
+    
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+
 @login_required
 @bufeadmin_required
 @csrf_exempt
@@ -491,13 +582,14 @@ def api_archive_all_done(request):
     API endpoint to archive all orders with status 'atadva', 'torolve', or 'visszavonva'.
     """
     try:
-        archived_count = Rendeles.objects.filter(
-            allapot__in=['atadva', 'torolve', 'visszavonva'],
-            archived=False
-        ).update(archived=True)
-        
-        # Broadcast update to refresh all clients
-        broadcast_order_update({}, action='archive_all')
+        with transaction.atomic():
+            archived_count = Rendeles.objects.filter(
+                allapot__in=['atadva', 'torolve', 'visszavonva'],
+                archived=False
+            ).update(archived=True)
+            
+            # Broadcast update to refresh all clients
+            broadcast_order_update({}, action='archive_all')
         
         return JsonResponse({
             'success': True,
@@ -519,12 +611,14 @@ def api_get_orders(request):
     API endpoint to get all non-archived orders.
     """
     try:
+        cursor = sync_cursor()
         orders = Rendeles.objects.filter(archived=False).order_by('-leadva')
-        orders_data = [serialize_order(order) for order in orders]
+        orders_data = serialize_orders(orders)
         
         return JsonResponse({
             'success': True,
-            'orders': orders_data
+            'orders': orders_data,
+            'sync': cursor
         })
     
     except Exception as e:
@@ -534,6 +628,80 @@ def api_get_orders(request):
         }, status=500)
 
 
+async def order_event_stream(seq):
+    """
+    Server-Sent Events carrying the admin group's batch frames. Each frame's
+    last sequence number is its event ID, so a reconnecting EventSource
+    resumes with Last-Event-ID. The group is joined before the replay is read;
+    events seen twice are skipped by the client's cursor.
+    """
+    channel_layer = get_channel_layer()
+    channel_name = await channel_layer.new_channel()
+    await channel_layer.group_add(ORDERS_GROUP, channel_name)
+    broadcast_sender.bind_loop(asyncio.get_running_loop())
+    connection_tracker.register('stream', channel_name)
+    try:
+        yield "retry: 3000\n\n"  # Reconnect delay of the browser's EventSource
+        if seq is not None:
+            reply = await sync_to_async(sync_reply)(seq)
+            last = reply['events'][-1]['seq'] if reply.get('events') else reply.get('seq', seq)
+            yield f"id: {last}\ndata: {encode_frame(reply)}\n\n"
+        
+        while True:
+            try:
+                message = await asyncio.wait_for(
+                    channel_layer.receive(channel_name),
+                    timeout=settings.BUFE_WS_HEARTBEAT_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                # A comment line keeps proxies from closing an idle response
+                yield ": ping\n\n"
+                continue
+            if message['type'] == 'order_events':
+                yield f"id: {message['seq']}\ndata: {message['text']}\n\n"
+    finally:
+        connection_tracker.unregister('stream', channel_name)
+        await channel_layer.group_discard(ORDERS_GROUP, channel_name)
+
+
+@login_required
+@bufeadmin_required
+@require_http_methods(["GET"])
+async def api_order_stream(request):
+    """
+    Server-Sent Events fallback of the admin order WebSocket, for networks
+    that block WebSocket upgrades. Streams the same order and product events;
+    the position to resume from is the Last-Event-ID header or, on the first
+    connection, the seq query parameter.
+    """
+    seq = request.headers.get('Last-Event-ID') or request.GET.get('seq')
+    try:
+        seq = int(seq) if seq else None
+    except ValueError:
+        seq = None
+    
+    response = StreamingHttpResponse(order_event_stream(seq), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # nginx would otherwise hold the events back
+    return response
+
+
+@login_required
+@bufeadmin_required
+@require_http_methods(["GET"])
+def api_broadcast_status(request):
+    """
+    API endpoint reporting the background broadcast sender:
+    events waiting to be sent, events sent and failures since startup,
+    and the open WebSocket connections of this process with their ages.
+    """
+    return JsonResponse({
+        'success': True,
+        'status': broadcast_sender.get_status(),
+        'connections': connection_tracker.get_status()
+    })
+
+
 @login_required
 @bufeadmin_required
 @csrf_exempt
@@ -566,7 +734,9 @@ def api_update_product(request):
         if 'max_rendelesenkent' in data:
             termek.max_rendelesenkent = int(data['max_rendelesenkent'])
         
-        termek.save()
+        # The change is pushed to admin and ordering pages by signals.py
+        with transaction.atomic():
+            termek.save()
         
         return JsonResponse({
             'success': True,
@@ -610,31 +780,20 @@ def api_add_product(request):
         
         kategoria = get_object_or_404(Kategoria, id=data['kategoria_id'])
         
-        # Create new product
-        termek = Termek.objects.create(
-            nev=data['nev'],
-            kategoria=kategoria,
-            ar=int(data['ar']),
-            max_rendelesenkent=int(data.get('max_rendelesenkent', 1)),
-            hutve=bool(data.get('hutve', False)),
-            elerheto=bool(data.get('elerheto', True)),
-            kisult=bool(data.get('kisult', False))
-        )
-        
-        # Broadcast to websocket clients
-        from .utils import broadcast_product_update
-        product_data = {
-            'id': termek.id,
-            'nev': termek.nev,
-            'kategoria_id': termek.kategoria.id,
-            'kategoria_nev': termek.kategoria.nev,
-            'ar': termek.ar,
-            'max_rendelesenkent': termek.max_rendelesenkent,
-            'hutve': termek.hutve,
-            'elerheto': termek.elerheto,
-            'kisult': termek.kisult
-        }
-        broadcast_product_update(product_data, action='add')
+        # Broadcast to websocket clients happens in the same transaction (signals.py)
+        with transaction.atomic():
+            # Create new product
+            termek = Termek.objects.create(
+                nev=data['nev'],
+                kategoria=kategoria,
+                ar=int(data['ar']),
+                max_rendelesenkent=int(data.get('max_rendelesenkent', 1)),
+                hutve=bool(data.get('hutve', False)),
+                elerheto=bool(data.get('elerheto', True)),
+                kisult=bool(data.get('kisult', False))
+            )
+        
+        product_data = serialize_product(termek)
         
         return JsonResponse({
             'success': True,
@@ -721,50 +880,6 @@ def api_get_categories(request):
         }, status=500)
 
 
-def serialize_order(rendeles):
-    """
-    Helper function to serialize order data for JSON responses.
-    """
-    # Get order items with product details
-    order_items = []
-    for item in rendeles.items:
-        try:
-            termek = Termek.objects.get(id=item['termek_id'])
-            order_items.append({
-                'termek_id': termek.id,
-                'termek_nev': termek.nev,
-                'termek_ar': termek.ar,
-                'mennyiseg': item['db'],
-                'osszeg': termek.ar * item['db']
-            })
-        except Termek.DoesNotExist:
-            order_items.append({
-                'termek_id': item['termek_id'],
-                'termek_nev': 'Ismeretlen termék',
-                'termek_ar': 0,
-                'mennyiseg': item['db'],
-                'osszeg': 0
-            })
-    
-    return {
-        'id': rendeles.id,
-        'user': {
-            'id': rendeles.user.id,
-            'username': rendeles.user.username,
-            'full_name': f"{rendeles.user.last_name} {rendeles.user.first_name}".strip() or rendeles.user.username,
-            'email': rendeles.user.email
-        },
-        'items': order_items,
-        'allapot': rendeles.allapot,
-        'allapot_display': rendeles.get_allapot_display(),
-        'leadva': rendeles.leadva.strftime('%Y-%m-%d %H:%M:%S'),
-        'idozitve': rendeles.idozitve.strftime('%Y-%m-%d %H:%M:%S') if rendeles.idozitve else None,
-        'megjegyzes': rendeles.megjegyzes,
-        'vegosszeg': rendeles.vegosszeg,
-        'archived': rendeles.archived
-    }
-
-
 @csrf_exempt
 @require_http_methods(["POST"])
 @bufeadmin_required
@@ -820,3 +935,4 @@ def api_update_opening_hours(request):
 
 
 
+
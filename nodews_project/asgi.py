@@ -19,6 +19,7 @@ django_asgi_app = get_asgi_application()
 # Import these after get_asgi_application() to ensure apps are loaded
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
+from channels.security.websocket import AllowedHostsOriginValidator
 from bufe.routing import websocket_urlpatterns
 
 # For ASGI applications with Daphne, Django's staticfiles handler works with WhiteNoise middleware
@@ -27,9 +28,13 @@ from bufe.routing import websocket_urlpatterns
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
-    "websocket": AuthMiddlewareStack(
-        URLRouter(
-            websocket_urlpatterns
+    # Session-authenticated sockets accept orders and admin commands, so only
+    # pages served from our own hosts may open them (no CSRF token here)
+    "websocket": AllowedHostsOriginValidator(
+        AuthMiddlewareStack(
+            URLRouter(
+                websocket_urlpatterns
+            )
         )
     ),
 })
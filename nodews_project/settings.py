@@ -167,23 +167,74 @@ WHITENOISE_MAX_AGE = 31536000 if not config('DEBUG', default=True, cast=bool) el
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Channels configuration
-# Use InMemoryChannelLayer for development (no Redis required)
-# For production with multiple servers, switch to Redis
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer'
+# Without REDIS_URL: InMemoryChannelLayer for development (no Redis required), one server process.
+# With REDIS_URL (e.g. redis://localhost:6379): the channel layer and the cache are shared through Redis,
+# so several daphne workers can run behind one port (python manage.py runworkers --workers 4)
+REDIS_URL = config('REDIS_URL', default='')
+
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                "hosts": [REDIS_URL],
+            },
+        },
+    }
+    # Idempotency keys and the outbox relay lock must be seen by every worker
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer'
+        }
     }
-}
 
-# For production with Redis, use this configuration:
-# CHANNEL_LAYERS = {
-#     'default': {
-#         'BACKEND': 'channels_redis.core.RedisChannelLayer',
-#         'CONFIG': {
-#             "hosts": [config('REDIS_URL', default='redis://localhost:6379')],
-#         },
-#     },
-# }
+# Büfé order ingestion
+# When enabled, orders placed over the student WebSocket are coalesced by a single writer thread
+# into one bulk insert every few milliseconds (see bufe/ingest.py). Only that path is batched, so this
+# needs BUFE_WS_ORDER_PLACEMENT; create_order form POSTs are always written one order per request
+BUFE_BATCHED_ORDER_INGEST = config('BUFE_BATCHED_ORDER_INGEST', default=False, cast=bool)
+BUFE_INGEST_BATCH_WINDOW_MS = config('BUFE_INGEST_BATCH_WINDOW_MS', default=5, cast=int)
+BUFE_INGEST_MAX_BATCH = config('BUFE_INGEST_MAX_BATCH', default=100, cast=int)
+BUFE_INGEST_TIMEOUT = config('BUFE_INGEST_TIMEOUT', default=10, cast=int)  # seconds an order may wait for the writer
+
+# Büfé pickup break capacity (orders per break per day, 0 = unlimited)
+# BUFE_BREAK_SLOT_CAPACITIES overrides the default for individual breaks, e.g. {'10:05': 30}
+BUFE_BREAK_SLOT_CAPACITY = config('BUFE_BREAK_SLOT_CAPACITY', default=0, cast=int)
+BUFE_BREAK_SLOT_CAPACITIES = {}
+
+# Admin WebSocket event outbox (see bufe/events.py)
+# BUFE_SYNC_REPLAY_SIZE: how many missed events a reconnecting dashboard is sent instead of a full reload
+# BUFE_OUTBOX_RETENTION: how many of the latest sent events are kept in the table
+BUFE_SYNC_REPLAY_SIZE = config('BUFE_SYNC_REPLAY_SIZE', default=500, cast=int)
+BUFE_OUTBOX_RETENTION = config('BUFE_OUTBOX_RETENTION', default=5000, cast=int)
+# Events committed within BUFE_BROADCAST_COALESCE_MS are sent to the dashboards as one frame (0 = immediately)
+BUFE_BROADCAST_COALESCE_MS = config('BUFE_BROADCAST_COALESCE_MS', default=50, cast=int)
+BUFE_BROADCAST_MAX_BATCH = config('BUFE_BROADCAST_MAX_BATCH', default=100, cast=int)
+
+# Seconds a process may reuse a cached bufeadmin membership check (changes in this process clear it at once)
+BUFE_ADMIN_CACHE_TIMEOUT = config('BUFE_ADMIN_CACHE_TIMEOUT', default=60, cast=int)
+
+# Server heartbeat on every WebSocket: a bare 'ping' frame every BUFE_WS_HEARTBEAT_INTERVAL seconds;
+# connections that send nothing (not even 'pong') for BUFE_WS_HEARTBEAT_TIMEOUT seconds are closed
+BUFE_WS_HEARTBEAT_INTERVAL = config('BUFE_WS_HEARTBEAT_INTERVAL', default=20, cast=int)
+BUFE_WS_HEARTBEAT_TIMEOUT = config('BUFE_WS_HEARTBEAT_TIMEOUT', default=45, cast=int)
+
+# Admin WebSocket flow control for dashboards that acknowledge what they applied:
+# at most BUFE_WS_MAX_IN_FLIGHT unacknowledged frames per connection; beyond that updates are collapsed
+# to the latest state per order, and past BUFE_WS_MAX_BACKLOG orders the dashboard is told to reload
+BUFE_WS_MAX_IN_FLIGHT = config('BUFE_WS_MAX_IN_FLIGHT', default=8, cast=int)
+BUFE_WS_MAX_BACKLOG = config('BUFE_WS_MAX_BACKLOG', default=300, cast=int)
+
+# Students' create_order pages place orders over their WebSocket (ws/bufe/my-orders/) and get one small
+# reply frame; the page falls back to the form POST whenever the socket is not available
+BUFE_WS_ORDER_PLACEMENT = config('BUFE_WS_ORDER_PLACEMENT', default=False, cast=bool)
 
 # Security settings for production (future auth.szlg.info)
 # Uncomment and configure these for production deployment
@@ -6,15 +6,25 @@
 const WS_PROTOCOL = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
 const WS_HOST = window.location.host;
 const WS_URL = `${WS_PROTOCOL}//${WS_HOST}/ws/bufe/orders/`;
+const STREAM_URL = '/bufe/admin/api/orders/stream/';
 
 // State
 let ws = null;
+let wsOpened = false; // false until a WebSocket has connected once
+let eventSource = null; // Server-Sent Events fallback, once the WebSocket is given up
+const COMPACT_PROTOCOL = 'bufe.compact.v1';
+let compactKeys = null; // short key -> full key, while the connection is compact
 let reconnectAttempts = 0;
 const MAX_RECONNECT_ATTEMPTS = 5;
 let reconnectTimeout = null;
 let orders = new Map();
 let currentFilter = 'all';
 let lastOrderCount = 0;
+let selectedOrders = new Set();
+let syncCursor = null; // {seq} of the last applied broadcast event
+let syncing = false;
+let pendingEvents = [];
+let renderScheduled = false;
 
 // DOM Elements
 const ordersGrid = document.getElementById('ordersGrid');
@@ -30,11 +40,15 @@ const archiveCancelBtn = document.getElementById('archiveCancelBtn');
 const archiveConfirmBtn = document.getElementById('archiveConfirmBtn');
 const filterTabs = document.querySelectorAll('.filter-tab');
 const notificationSound = document.getElementById('notificationSound');
+const bulkBar = document.getElementById('bulkBar');
+const bulkCount = document.getElementById('bulkCount');
+const selectAllBtn = document.getElementById('selectAllBtn');
+const clearSelectionBtn = document.getElementById('clearSelectionBtn');
 
 // Initialize
 document.addEventListener('DOMContentLoaded', () => {
     initWebSocket();
-    loadOrders();
+    loadInitialOrders();
     setupEventListeners();
     setupFilters();
 });
@@ -42,16 +56,24 @@ document.addEventListener('DOMContentLoaded', () => {
 // WebSocket Functions
 function initWebSocket() {
     try {
-        ws = new WebSocket(WS_URL);
+        compactKeys = null;
+        ws = new WebSocket(WS_URL, [COMPACT_PROTOCOL]);
         
         ws.onopen = () => {
             console.log('WebSocket connected');
             updateConnectionStatus('connected');
+            wsOpened = true;
             reconnectAttempts = 0;
+            requestSync();
         };
         
         ws.onmessage = (event) => {
-            handleWebSocketMessage(JSON.parse(event.data));
+            if (event.data === 'ping') {
+                // Server heartbeat, answered without JSON on either side
+                event.target.send('pong');
+                return;
+            }
+            handleWebSocketMessage(decodeFrame(event.data));
         };
         
         ws.onerror = (error) => {
@@ -62,6 +84,11 @@ function initWebSocket() {
         ws.onclose = () => {
             console.log('WebSocket disconnected');
             updateConnectionStatus('disconnected');
+            if (!wsOpened) {
+                // The upgrade never went through - likely a proxy that blocks WebSockets
+                startEventStream();
+                return;
+            }
             scheduleReconnect();
         };
     } catch (error) {
@@ -70,12 +97,83 @@ function initWebSocket() {
     }
 }
 
+// Server-Sent Events fallback for networks that block WebSocket upgrades:
+// the same frames, resumed by the browser with Last-Event-ID after a drop
+function startEventStream() {
+    if (eventSource) {
+        eventSource.close();
+    }
+    compactKeys = null;
+    const seq = syncCursor ? syncCursor.seq : '';
+    eventSource = new EventSource(`${STREAM_URL}?seq=${seq}`);
+    
+    eventSource.onopen = () => {
+        console.log('Event stream connected');
+        updateConnectionStatus('connected');
+    };
+    
+    eventSource.onmessage = (event) => {
+        handleWebSocketMessage(JSON.parse(event.data));
+    };
+    
+    eventSource.onerror = () => {
+        // The browser reconnects by itself unless the server refused the stream
+        updateConnectionStatus(eventSource.readyState === EventSource.CLOSED ? 'failed' : 'disconnected');
+    };
+}
+
+// Compact framing: the server shortens known keys when it accepts this subprotocol
+// and sends the key dictionary as the first frame
+function decodeFrame(text) {
+    const data = JSON.parse(text);
+    if (data.type === 'dictionary') {
+        compactKeys = data.keys;
+        return data;
+    }
+    return compactKeys ? expandKeys(data) : data;
+}
+
+function expandKeys(value) {
+    if (Array.isArray(value)) {
+        return value.map(expandKeys);
+    }
+    if (value === null || typeof value !== 'object') {
+        return value;
+    }
+    const expanded = {};
+    for (const [key, item] of Object.entries(value)) {
+        expanded[compactKeys[key] || key] = expandKeys(item);
+    }
+    return expanded;
+}
+
 function handleWebSocketMessage(data) {
     console.log('WebSocket message:', data);
     
     switch (data.type) {
-        case 'order_update':
-            handleOrderUpdate(data.action, data.order);
+        case 'batch':
+            if (data.coalesced) {
+                applyCoalesced(data);
+            } else {
+                // Events coalesced by the server into one frame
+                data.events.forEach(handleSequencedEvent);
+            }
+            acknowledge();
+            break;
+        case 'sync_replay':
+            finishSync(data.events);
+            acknowledge();
+            break;
+        case 'sync_snapshot':
+            // Too far behind for a replay - reload everything, then apply what arrived meanwhile
+            loadOrders().then(() => {
+                finishSync([]);
+                acknowledge();
+            });
+            break;
+        case 'resync':
+            // This page fell too far behind and the server stopped sending - reload, then resume
+            loadOrders().then(() => requestSync());
             break;
         case 'pong':
             // Heartbeat response
@@ -86,6 +184,90 @@ function handleWebSocketMessage(data) {
     }
 }
 
+// Broadcast events are numbered by the server; apply them strictly in order
+function handleSequencedEvent(data) {
+    if (syncing) {
+        pendingEvents.push(data);
+        return;
+    }
+    if (!syncCursor || data.seq === syncCursor.seq + 1) {
+        applyEvent(data);
+    } else if (data.seq > syncCursor.seq) {
+        // Missed something in between - catch up before applying
+        pendingEvents.push(data);
+        requestSync();
+    }
+}
+
+function applyEvent(data) {
+    switch (data.type) {
+        case 'order_update':
+            handleOrderUpdate(data.action, data.order);
+            break;
+        case 'orders_update':
+            handleOrdersUpdate(data.action, data.orders);
+            break;
+    }
+    if (syncCursor) {
+        syncCursor.seq = data.seq;
+    }
+}
+
+// A backlog the server collapsed into the latest state per order while this
+// page was behind; it stands for every event up to data.seq
+function applyCoalesced(data) {
+    if (syncing) {
+        // The pending sync reply covers these
+        return;
+    }
+    data.events.forEach(applyEvent);
+    if (syncCursor) {
+        syncCursor.seq = Math.max(syncCursor.seq, data.seq);
+    }
+}
+
+// Tell the server how far this page has got, so it can hold back and
+// collapse updates while the page is falling behind
+function acknowledge() {
+    if (ws && ws.readyState === WebSocket.OPEN && syncCursor) {
+        ws.send(JSON.stringify({
+            type: 'ack',
+            seq: syncCursor.seq
+        }));
+    }
+}
+
+// Ask the server for the events missed since the last applied one
+function requestSync() {
+    if (eventSource) {
+        // A new stream from the current position starts with the replay
+        syncing = true;
+        startEventStream();
+        return;
+    }
+    if (!ws || ws.readyState !== WebSocket.OPEN) {
+        return;
+    }
+    syncing = true;
+    ws.send(JSON.stringify({
+        type: 'sync',
+        seq: syncCursor ? syncCursor.seq : null
+    }));
+}
+
+function finishSync(events) {
+    syncing = false;
+    const queued = pendingEvents;
+    pendingEvents = [];
+    events.concat(queued)
+        .sort((a, b) => a.seq - b.seq)
+        .forEach(event => {
+            if (!syncCursor || event.seq > syncCursor.seq) {
+                applyEvent(event);
+            }
+        });
+}
+
 function handleOrderUpdate(action, order) {
     switch (action) {
         case 'new':
@@ -106,6 +288,19 @@ function handleOrderUpdate(action, order) {
     updateOrderCount();
 }
 
+// Bulk changes arrive as one message and are rendered once
+function handleOrdersUpdate(action, changedOrders) {
+    changedOrders.forEach(order => {
+        if (action === 'archive') {
+            orders.delete(order.id);
+            selectedOrders.delete(order.id);
+        } else {
+            orders.set(order.id, order);
+        }
+    });
+    scheduleRender();
+}
+
 function scheduleReconnect() {
     if (reconnectAttempts < MAX_RECONNECT_ATTEMPTS) {
         reconnectAttempts++;
@@ -116,8 +311,8 @@ function scheduleReconnect() {
             initWebSocket();
         }, delay);
     } else {
-        console.error('Max reconnection attempts reached');
-        updateConnectionStatus('failed');
+        console.error('Max reconnection attempts reached, switching to the event stream');
+        startEventStream();
     }
 }
 
@@ -148,12 +343,36 @@ function updateConnectionStatus(status) {
 }
 
 // API Functions
+// Orders serialized by the server with the page - saves the initial API round trip
+function loadInitialOrders() {
+    const initialOrders = document.getElementById('initialOrders');
+    if (!initialOrders) {
+        loadOrders();
+        return;
+    }
+    
+    const initialCursor = document.getElementById('syncCursor');
+    if (initialCursor) {
+        syncCursor = JSON.parse(initialCursor.textContent);
+    }
+    
+    orders.clear();
+    JSON.parse(initialOrders.textContent).forEach(order => {
+        orders.set(order.id, order);
+    });
+    renderOrders();
+    updateOrderCount();
+}
+
 async function loadOrders() {
     try {
         const response = await fetch('/bufe/admin/api/orders/');
         const data = await response.json();
         
         if (data.success) {
+            if (data.sync) {
+                syncCursor = data.sync;
+            }
             orders.clear();
             data.orders.forEach(order => {
                 orders.set(order.id, order);
@@ -175,10 +394,19 @@ async function updateOrderStatus(orderId, status) {
             },
             body: JSON.stringify({
                 order_id: orderId,
-                status: status
+                status: status,
+                expected_status: orders.has(orderId) ? orders.get(orderId).allapot : undefined
             })
         });
         
+        if (response.status === 409) {
+            // Someone else changed the order first - show its current state
+            const data = await response.json();
+            updateOrder(data.order);
+            alert(data.error);
+            return;
+        }
+        
         if (!response.ok) {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
@@ -225,6 +453,44 @@ async function archiveOrder(orderId) {
     }
 }
 
+async function bulkUpdateOrders(payload) {
+    const orderIds = Array.from(selectedOrders);
+    if (orderIds.length === 0) return;
+    
+    try {
+        const response = await fetch('/bufe/admin/api/bulk-update-orders/', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(Object.assign({ order_ids: orderIds }, payload))
+        });
+        
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        
+        const data = await response.json();
+        
+        if (data.success) {
+            selectedOrders.clear();
+            if (payload.archive) {
+                handleOrdersUpdate('archive', data.order_ids.map(id => ({ id })));
+            } else {
+                handleOrdersUpdate('update', data.orders);
+                if (data.skipped_ids.length > 0) {
+                    alert(`${data.skipped_ids.length} rendelés állapota nem módosítható erre: ${data.skipped_ids.map(id => '#' + id).join(', ')}`);
+                }
+            }
+        } else {
+            alert('Hiba: ' + data.error);
+        }
+    } catch (error) {
+        console.error('Failed to bulk update orders:', error);
+        alert('Hiba történt a rendelések frissítése során.');
+    }
+}
+
 async function archiveAllDone() {
     try {
         const response = await fetch('/bufe/admin/api/archive-all-done/', {
@@ -272,7 +538,7 @@ function renderOrders() {
         let tapTimer = null;
         
         card.addEventListener('click', (e) => {
-            if (e.target.closest('.btn-action')) return;
+            if (e.target.closest('.btn-action') || e.target.closest('.order-select')) return;
             
             tapCount++;
             
@@ -304,6 +570,20 @@ function renderOrders() {
         });
     });
     
+    // Attach selection checkbox listeners
+    ordersGrid.querySelectorAll('.order-select').forEach(checkbox => {
+        checkbox.addEventListener('change', () => {
+            const orderId = parseInt(checkbox.dataset.orderId);
+            if (checkbox.checked) {
+                selectedOrders.add(orderId);
+            } else {
+                selectedOrders.delete(orderId);
+            }
+            checkbox.closest('.order-card').classList.toggle('selected', checkbox.checked);
+            updateBulkBar();
+        });
+    });
+    
     // Attach button event listeners
     document.querySelectorAll('.btn-action').forEach(btn => {
         btn.addEventListener('click', (e) => {
@@ -358,9 +638,9 @@ function createOrderCard(order) {
     }
     
     return `
-        <div class="order-card" data-order-id="${order.id}" data-status="${order.allapot}">
+        <div class="order-card${selectedOrders.has(order.id) ? ' selected' : ''}" data-order-id="${order.id}" data-status="${order.allapot}">
             <div class="order-header">
-                <div class="order-number">#${order.id}</div>
+                <div class="order-number"><input type="checkbox" class="order-select" data-order-id="${order.id}"${selectedOrders.has(order.id) ? ' checked' : ''}>#${order.id}</div>
                 <div class="order-status ${statusClass}">${order.allapot_display}</div>
             </div>
             <div class="order-body">
@@ -377,18 +657,52 @@ function createOrderCard(order) {
 
 function addNewOrder(order) {
     orders.set(order.id, order);
-    renderOrders();
+    scheduleRender();
 }
 
 function updateOrder(order) {
     orders.set(order.id, order);
-    renderOrders();
+    scheduleRender();
 }
 
 function removeOrder(orderId) {
     orders.delete(orderId);
+    selectedOrders.delete(orderId);
+    scheduleRender();
+}
+
+// Changes arriving together (e.g. one batch frame) are drawn in a single pass
+function scheduleRender() {
+    if (renderScheduled) {
+        return;
+    }
+    renderScheduled = true;
+    requestAnimationFrame(() => {
+        renderScheduled = false;
+        renderOrders();
+        updateOrderCount();
+        updateBulkBar();
+    });
+}
+
+function updateBulkBar() {
+    bulkBar.style.display = selectedOrders.size > 0 ? 'flex' : 'none';
+    bulkCount.textContent = `${selectedOrders.size} kijelölve`;
+}
+
+// Select every order visible under the current filter, e.g. a whole break's batch
+function selectAllVisible() {
+    ordersGrid.querySelectorAll('.order-card').forEach(card => {
+        selectedOrders.add(parseInt(card.dataset.orderId));
+    });
     renderOrders();
-    updateOrderCount();
+    updateBulkBar();
+}
+
+function clearSelection() {
+    selectedOrders.clear();
+    renderOrders();
+    updateBulkBar();
 }
 
 function flashOrder(orderId) {
@@ -494,6 +808,21 @@ function setupEventListeners() {
         loadOrders();
     });
     
+    selectAllBtn.addEventListener('click', selectAllVisible);
+    clearSelectionBtn.addEventListener('click', clearSelection);
+    
+    bulkBar.querySelectorAll('[data-bulk-status]').forEach(btn => {
+        btn.addEventListener('click', () => {
+            bulkUpdateOrders({ status: btn.dataset.bulkStatus });
+        });
+    });
+    
+    bulkBar.querySelectorAll('[data-bulk-archive]').forEach(btn => {
+        btn.addEventListener('click', () => {
+            bulkUpdateOrders({ archive: true });
+        });
+    });
+    
     archiveAllBtn.addEventListener('click', () => {
         archiveModal.style.display = 'flex';
     });
@@ -621,10 +950,3 @@ function getCSRFToken() {
     
     return token;
 }
-
-// Heartbeat to keep connection alive
-setInterval(() => {
-    if (ws && ws.readyState === WebSocket.OPEN) {
-        ws.send(JSON.stringify({ type: 'ping' }));
-    }
-}, 30000); // Every 30 seconds
@@ -9,6 +9,8 @@ const WS_URL = `${WS_PROTOCOL}//${WS_HOST}/ws/bufe/orders/`;
 
 // State
 let ws = null;
+const COMPACT_PROTOCOL = 'bufe.compact.v1';
+let compactKeys = null; // short key -> full key, while the connection is compact
 let reconnectAttempts = 0;
 const MAX_RECONNECT_ATTEMPTS = 5;
 let categories = window.CATEGORIES || [];
@@ -31,7 +33,8 @@ document.addEventListener('DOMContentLoaded', () => {
 // WebSocket Functions
 function initWebSocket() {
     try {
-        ws = new WebSocket(WS_URL);
+        compactKeys = null;
+        ws = new WebSocket(WS_URL, [COMPACT_PROTOCOL]);
         
         ws.onopen = () => {
             console.log('WebSocket connected');
@@ -40,7 +43,12 @@ function initWebSocket() {
         };
         
         ws.onmessage = (event) => {
-            handleWebSocketMessage(JSON.parse(event.data));
+            if (event.data === 'ping') {
+                // Server heartbeat, answered without JSON on either side
+                event.target.send('pong');
+                return;
+            }
+            handleWebSocketMessage(decodeFrame(event.data));
         };
         
         ws.onerror = (error) => {
@@ -59,10 +67,44 @@ function initWebSocket() {
     }
 }
 
+// Compact framing: the server shortens known keys when it accepts this subprotocol
+// and sends the key dictionary as the first frame
+function decodeFrame(text) {
+    const data = JSON.parse(text);
+    if (data.type === 'dictionary') {
+        compactKeys = data.keys;
+        return data;
+    }
+    return compactKeys ? expandKeys(data) : data;
+}
+
+function expandKeys(value) {
+    if (Array.isArray(value)) {
+        return value.map(expandKeys);
+    }
+    if (value === null || typeof value !== 'object') {
+        return value;
+    }
+    const expanded = {};
+    for (const [key, item] of Object.entries(value)) {
+        expanded[compactKeys[key] || key] = expandKeys(item);
+    }
+    return expanded;
+}
+
 function handleWebSocketMessage(data) {
     console.log('WebSocket message:', data);
     
     switch (data.type) {
+        case 'batch':
+            // Events coalesced by the server into one frame
+            data.events.forEach(handleWebSocketMessage);
+            acknowledge(data.coalesced ? data.seq : data.events[data.events.length - 1].seq);
+            break;
+        case 'resync':
+            // This page fell too far behind and the server stopped sending
+            window.location.reload();
+            break;
         case 'product_update':
             if (data.action === 'add') {
                 addProductToTable(data.product);
@@ -81,6 +123,14 @@ function handleWebSocketMessage(data) {
     }
 }
 
+// Tell the server this page keeps up, so it can hold back and collapse
+// updates while the page is falling behind
+function acknowledge(seq) {
+    if (ws && ws.readyState === WebSocket.OPEN) {
+        ws.send(JSON.stringify({ type: 'ack', seq: seq }));
+    }
+}
+
 function scheduleReconnect() {
     if (reconnectAttempts < MAX_RECONNECT_ATTEMPTS) {
         reconnectAttempts++;
@@ -542,10 +592,3 @@ function getCSRFToken() {
     }
     return token;
 }
-
-// Heartbeat to keep connection alive
-setInterval(() => {
-    if (ws && ws.readyState === WebSocket.OPEN) {
-        ws.send(JSON.stringify({ type: 'ping' }));
-    }
-}, 30000); // Every 30 seconds